@@ -0,0 +1,83 @@
+import re
+from collections import defaultdict
+from typing import Dict
+
+# Upper bounds of histograms buckets, secs. Same as the parser's.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+SERIES_REGEX = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})?$')
+LE_REGEX = re.compile(r'le="([^"]*)"')
+
+
+def series(name: str, labels: dict) -> str:
+    """Series name in the Prometheus text format: name{label="value",...}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """Metrics of the API process. Kept in memory and rendered together with the parser's ones."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[series(name, labels)] += value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add a value to a histogram. Buckets are cumulative, like Prometheus expects them."""
+        for le in DEFAULT_BUCKETS:
+            if value <= le:
+                self.counters[series(f"{name}_bucket", {**labels, 'le': le})] += 1
+        self.counters[series(f"{name}_bucket", {**labels, 'le': '+Inf'})] += 1
+        self.counters[series(f"{name}_sum", labels)] += value
+        self.counters[series(f"{name}_count", labels)] += 1
+
+
+def metric_type(family: str, names: set) -> str:
+    if f"{family}_bucket" in names:
+        return "histogram"
+    if family.endswith("_total"):
+        return "counter"
+    return "gauge"
+
+
+def render(values: Dict[str, float]) -> str:
+    """
+    Render series in the Prometheus text format. Series are grouped into families with a TYPE line each.
+    Types follow the naming: `_bucket`, `_sum` and `_count` series of a histogram, counters end with `_total`,
+    the rest are gauges.
+    """
+    parsed = []
+    for field, value in values.items():
+        match = SERIES_REGEX.match(field)
+        if match:
+            parsed.append((match['name'], match['labels'] or '', float(value)))
+    names = {name for name, _, _ in parsed}
+
+    families = defaultdict(list)
+    for name, labels, value in parsed:
+        family = name
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and f"{name[:-len(suffix)]}_bucket" in names:
+                family = name[:-len(suffix)]
+        families[family].append((name, labels, value))
+
+    def order(sample: tuple) -> tuple:
+        # Buckets go in the order of their bounds, +Inf last
+        name, labels, _ = sample
+        le = LE_REGEX.search(labels)
+        return name, LE_REGEX.sub('', labels), float(le.group(1)) if le else 0.0
+
+    lines = []
+    for family in sorted(families):
+        lines.append(f"# TYPE {family} {metric_type(family, names)}")
+        for name, labels, value in sorted(families[family], key=order):
+            value = int(value) if value.is_integer() else value
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Registry of the API process
+metrics = Metrics()
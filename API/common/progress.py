@@ -0,0 +1,95 @@
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Optional, Tuple
+
+
+def to_int(value: Optional[str]) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class ProgressTracker:
+    """
+    Derives throughput and ETA of the running task from the progress counters of the parsing_task hash.
+    Throughput is measured over the counters seen during the last `window` secs, so it follows
+    the current speed of the parser. Until there are two samples it's averaged since the task started.
+    """
+
+    def __init__(self, window: float = 60) -> None:
+        """
+        :param window: Throughput is measured over that many secs.
+        """
+        self.window = window
+        self.task_id = None
+        self.samples: Deque[Tuple[float, int, int]] = deque()  # (time, pages done, cards written)
+
+    def add_sample(self, task_id: str, now: float, pages_done: int, cards_written: int) -> Tuple[float, int, int]:
+        """Remember the counters and return the oldest sample of the window."""
+        if task_id != self.task_id:
+            self.task_id = task_id
+            self.samples.clear()
+        self.samples.append((now, pages_done, cards_written))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        return self.samples[0]
+
+    @staticmethod
+    def started_at(started: Optional[str]) -> Optional[float]:
+        """Unix time of `started`, which the parser writes in UTC without a timezone."""
+        try:
+            return datetime.fromisoformat(started).replace(tzinfo=timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def estimate(self, task: dict, now: float = None) -> Optional[dict]:
+        """
+        :param task: The parsing_task hash.
+        :param now: Unix time of the sample, the current time by default.
+        :return: Pages and cards per sec, estimated number of cards to write, percent done,
+        secs left and the expected end (UTC). None if the task isn't running.
+        ETA is None while there is work left but nothing is being done.
+        """
+        if not task or task.get('status') != 'in_progress':
+            return None
+        now = time.time() if now is None else now
+        num_pages, pages_done = to_int(task.get('num_pages')), to_int(task.get('pages_done'))
+        cards_queued, cards_written = to_int(task.get('cards_queued')), to_int(task.get('cards_written'))
+
+        since, pages_before, cards_before = self.add_sample(task.get('task_id'), now, pages_done, cards_written)
+        if since == now:
+            # Nothing to compare with yet
+            since, pages_before, cards_before = self.started_at(task.get('started')) or now, 0, 0
+        elapsed = now - since
+        pages_per_sec = (pages_done - pages_before) / elapsed if elapsed > 0 else 0.0
+        cards_per_sec = (cards_written - cards_before) / elapsed if elapsed > 0 else 0.0
+
+        # Cards are found while pages are parsed, so their total is extrapolated from the parsed pages
+        cards_total = cards_queued
+        if 0 < pages_done < num_pages:
+            cards_total = round(cards_queued * num_pages / pages_done)
+        pages_left = max(num_pages - pages_done, 0)
+        cards_left = max(cards_total - cards_written, 0)
+
+        eta_seconds = 0.0
+        for left, rate in ((pages_left, pages_per_sec), (cards_left, cards_per_sec)):
+            if left and not rate:
+                eta_seconds = None
+                break
+            if left:
+                eta_seconds = max(eta_seconds, left / rate)
+
+        if cards_total:
+            percent = 100 * min(cards_written / cards_total, 1)
+        else:
+            percent = 100 * pages_done / num_pages if num_pages else 0.0
+        return {
+            'pages_per_sec': round(pages_per_sec, 3),
+            'cards_per_sec': round(cards_per_sec, 3),
+            'cards_total': cards_total,
+            'percent': round(percent, 1),
+            'eta_seconds': None if eta_seconds is None else round(eta_seconds),
+            'eta': None if eta_seconds is None else str(datetime.utcfromtimestamp(now + eta_seconds)),
+        }
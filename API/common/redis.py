@@ -88,8 +88,26 @@ class ParsingTask(RedisHash):
         'started': None,       # str | None
         'ended': None,         # str | None
         'num_results': None,   # int | None
-        'details': None        # str | None
+        'details': None,       # str | None
+        'resume_from': None,   # str | None. Id of the failed task whose checkpoints this task continues
+        'mode': 'full',        # str. 'full' fetches every card, 'delta' only new ones and a refresh sample
+        'concurrency_limit': 0,              # int. Sum of in-flight limits of all workers
+        'concurrency_adjustments': 0,        # int
+        'last_concurrency_adjustment': None,  # str | None
+        'missing_card_fields': 0,  # int. Card labels not found on pages. Such cards are written with nulls
+        'unknown_card_fields': 0,  # int. Labels on cards pages the schema doesn't know
+        'rows_inserted': 0,        # int. New licenses written into the database
+        'rows_updated': 0,         # int. Stored licenses whose fields changed
+        'rows_unchanged': 0,       # int. Stored licenses fetched again without changes
+        'num_pages': 0,      # int. Search pages of the registry
+        'pages_done': 0,     # int. Parsed search pages, including ones parsed by the resumed task
+        'cards_queued': 0,   # int. Cards found on parsed pages that have to be fetched
+        'cards_fetched': 0,  # int
+        'cards_written': 0,  # int. Cards written into the database
+        'errors': 0          # int. Failed requests and pages that couldn't be handled
     }
+    # The API pushes the id of every started task here, so the parser doesn't have to poll the status
+    events = "parsing_task_events"
 
     def __init__(self, r_client):
         super(ParsingTask, self).__init__(
@@ -104,11 +122,16 @@ class ParsingTask(RedisHash):
         chars = string.ascii_uppercase + string.digits
         return ''.join(random.choice(chars) for _ in range(size))
 
-    async def start(self):
+    async def start(self, resume_from: str = None, mode: str = 'full'):
         task_id = await self.generate_task_id()
         try:
             await self.set_value("task_id", task_id)
+            await self.set_value("resume_from", resume_from or "")
+            await self.set_value("mode", mode)
             await self.set_value("status", "active")
+            # Wake the parser up. Keep the list short in case the parser isn't running.
+            await self.redis_client.lpush(self.events, task_id)
+            await self.redis_client.ltrim(self.events, 0, 99)
         except Exception as e:
             logger.error(f"Failed to set task as started in {self.hname}\n{e}")
             await self.redis_client.init_redis_connect()
@@ -125,5 +148,15 @@ class ParsingTask(RedisHash):
         return await self.get_hash()
 
 
+async def get_db_writers_stats(r_client: RedisCli) -> list:
+    """Stats of the last flush of every DB writer of the parser. Writers keep them in `db_writer_stats:<name>`."""
+    writers = []
+    async for key in r_client.scan_iter(match="db_writer_stats:*"):
+        stats = await r_client.hgetall(key)
+        if stats:
+            writers.append({'writer': key.split(':', 1)[1], **stats})
+    return sorted(writers, key=lambda writer: writer['writer'])
+
+
 redis_client = RedisCli()
 parsing_task = ParsingTask(redis_client)
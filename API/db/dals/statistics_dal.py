@@ -1,3 +1,5 @@
+from typing import List
+
 from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
@@ -21,6 +23,17 @@ class StatisticsDAL:
         if res:
             return statistics_schema.StatisticsDB(**res.scalars().first().__dict__)
 
+    async def get_history(self, table: str, limit: int) -> List[statistics_schema.StatisticsDB]:
+        """Latest runs first."""
+        stmt = (
+            select(ParsingStatistics)
+            .where(ParsingStatistics.table == table)
+            .order_by(ParsingStatistics.started.desc().nulls_last(), ParsingStatistics.id.desc())
+            .limit(limit)
+        )
+        res = await self.db_session.execute(stmt)
+        return [statistics_schema.StatisticsDB(**run.__dict__) for run in res.scalars().all()]
+
     async def set_csv_file(self, task_id: str, csv_filename: str):
         stmt = (
             update(ParsingStatistics)
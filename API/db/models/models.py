@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import BigInteger, Column, Float, Integer, String, ForeignKey
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 
@@ -35,6 +35,9 @@ class License(Base):
     revoke_decision = Column(String, nullable=True)
     officials_information = Column(String, nullable=True)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    removed_at = Column(TIMESTAMP(timezone=True), nullable=True)  # When the license disappeared from the registry
+    content_hash = Column(String, nullable=True)  # Hash of the parsed fields. The row is rewritten only if it changes
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=True)  # When the parsed fields changed last time
 
 
 class ParsingStatistics(Base):
@@ -48,6 +51,43 @@ class ParsingStatistics(Base):
     csv_file = Column(String, nullable=True, unique=True)
     started = Column(TIMESTAMP(timezone=True), nullable=True)
     ended = Column(TIMESTAMP(timezone=True), nullable=True)
+    rows_inserted = Column(Integer, nullable=True)
+    rows_updated = Column(Integer, nullable=True)
+    rows_unchanged = Column(Integer, nullable=True)
+    # Performance of the run
+    pages_per_sec = Column(Float, nullable=True)
+    cards_per_sec = Column(Float, nullable=True)
+    fetch_p50 = Column(Float, nullable=True)
+    fetch_p95 = Column(Float, nullable=True)
+    fetch_p99 = Column(Float, nullable=True)
+    retries = Column(Integer, nullable=True)
+    http_5xx = Column(Integer, nullable=True)
+    bytes_downloaded = Column(BigInteger, nullable=True)
+    parse_cpu_seconds = Column(Float, nullable=True)
+    db_rows_per_sec = Column(Float, nullable=True)
+    peak_rss_bytes = Column(BigInteger, nullable=True)
+
+
+# Columns added after the tables were first created. create_all doesn't alter existing tables.
+SCHEMA_UPGRADES = (
+    "ALTER TABLE active_licenses ADD COLUMN IF NOT EXISTS removed_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE active_licenses ADD COLUMN IF NOT EXISTS content_hash VARCHAR",
+    "ALTER TABLE active_licenses ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS rows_inserted INTEGER",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS rows_updated INTEGER",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS rows_unchanged INTEGER",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS pages_per_sec DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS cards_per_sec DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS fetch_p50 DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS fetch_p95 DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS fetch_p99 DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS retries INTEGER",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS http_5xx INTEGER",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS bytes_downloaded BIGINT",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS parse_cpu_seconds DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS db_rows_per_sec DOUBLE PRECISION",
+    "ALTER TABLE parsing_statistics ADD COLUMN IF NOT EXISTS peak_rss_bytes BIGINT",
+)
 
 
 class DBLicenseFields:
@@ -1,11 +1,16 @@
 import json
+import time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 
+from sqlalchemy import text
+
 from db.config import engine, Base
-from routers import license, user, auth, files, parser
+from db.models.models import SCHEMA_UPGRADES
+from routers import license, user, auth, files, parser, metrics
+from common.metrics import metrics as api_metrics
 from common.redis import redis_client, parsing_task
 from settings import env
 
@@ -27,6 +32,8 @@ async def startup():
     # Create tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for stmt in SCHEMA_UPGRADES:
+            await conn.execute(text(stmt))
 
 
 @app.on_event("shutdown")
@@ -49,6 +56,19 @@ app.include_router(files.router)
 app.include_router(auth.router)
 app.include_router(parser.router)
 app.include_router(user.router)
+app.include_router(metrics.router)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Count requests and their latency by route. Paths are route templates, so ids don't blow up the series."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route else "unmatched"
+    api_metrics.observe("api_request_seconds", time.perf_counter() - start, method=request.method, path=path)
+    api_metrics.inc("api_responses_total", method=request.method, path=path, status=response.status_code)
+    return response
 
 
 @app.get("/")
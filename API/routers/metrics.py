@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from common.metrics import metrics, render
+from common.redis import redis_client
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, tags=["Metrics"])
+async def get_metrics():
+    """Метрики парсера и API в формате Prometheus."""
+    # The parser's workers and DB writers merge their metrics into this hash
+    values = await redis_client.hgetall("metrics") or {}
+    values.update(metrics.counters)
+    return PlainTextResponse(render(values), media_type="text/plain; version=0.0.4")
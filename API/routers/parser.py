@@ -1,8 +1,16 @@
-from fastapi import status, Depends, APIRouter, HTTPException
+import asyncio
+from typing import List
+
+from fastapi import status, Depends, APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
 from common import oauth2
-from common.redis import parsing_task
-from schemas.parsing_task_schema import ParsingTask
+from common.progress import ProgressTracker
+from common.redis import parsing_task, redis_client, get_db_writers_stats
+from db.dals.statistics_dal import StatisticsDAL
+from db.dependencies import get_statistics_dal
+from schemas.parsing_task_schema import ParsingTask, CrawlMode, DBWriterStats
+from schemas.statistics_schema import RunComparison, PERFORMANCE_FIELDS
 
 router = APIRouter(
     prefix="/parser"
@@ -10,7 +18,13 @@ router = APIRouter(
 
 
 @router.post("/run/", status_code=status.HTTP_201_CREATED, tags=["Run Parser"])
-async def run_parser(validation=Depends(oauth2.validate_user)):
+async def run_parser(resume: bool = Query(default=False,
+                                          description="Продолжить прерванную задачу, не загружая повторно "
+                                                      "уже сохраненные страницы и лицензии"),
+                     mode: CrawlMode = Query(default=CrawlMode.full,
+                                             description="full -- загрузить все лицензии, delta -- только новые "
+                                                         "и случайную выборку сохраненных"),
+                     validation=Depends(oauth2.validate_user)):
     # Before starting new parsing task check if previous one not running.
     task_status = await parsing_task.get_status()
     if task_status in ('active', 'in_progress'):
@@ -18,11 +32,84 @@ async def run_parser(validation=Depends(oauth2.validate_user)):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail=f"Task {task_id} is already running")
 
-    task_id = await parsing_task.start()
-    return {"task_id": task_id}
+    resume_from = None
+    if resume:
+        previous_task_id = await parsing_task.get_task_id()
+        if not previous_task_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Failed task to resume was not found")
+        if task_status != 'failed':
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"Task {previous_task_id} can't be resumed, its status is {task_status}")
+        resume_from = previous_task_id
 
+    task_id = await parsing_task.start(resume_from=resume_from, mode=mode.value)
+    return {"task_id": task_id, "resume_from": resume_from, "mode": mode.value}
 
-@router.get("/status/", response_model=ParsingTask, tags=["Get Parsing Status"])
-async def get_parsing_task_status(validation=Depends(oauth2.validate_user)):
+
+progress_tracker = ProgressTracker()
+
+
+async def get_task_with_progress() -> dict | None:
     task = await parsing_task.get_task()
+    if task:
+        task['progress'] = progress_tracker.estimate(task)
     return task
+
+
+@router.get("/status/", response_model=ParsingTask, tags=["Get Parsing Status"])
+async def get_parsing_task_status(validation=Depends(oauth2.validate_user)):
+    """Состояние задачи. Пока задача выполняется, progress содержит текущую скорость и оценку времени окончания."""
+    return await get_task_with_progress()
+
+
+@router.get("/status/stream/", response_class=StreamingResponse, tags=["Get Parsing Status"])
+async def stream_parsing_task_status(request: Request,
+                                     interval: float = Query(default=2, ge=0.5, le=60,
+                                                             description="Интервал между событиями, секунды"),
+                                     validation=Depends(oauth2.validate_user)):
+    """Server-Sent Events: состояние задачи в формате /parser/status/ каждые interval секунд."""
+    async def events():
+        while not await request.is_disconnected():
+            task = await get_task_with_progress()
+            if task:
+                yield f"data: {ParsingTask(**task).json()}\n\n"
+            else:
+                yield ": no task\n\n"  # Comment line keeps the connection alive
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/writers/", response_model=List[DBWriterStats], tags=["Get Parsing Status"])
+async def get_db_writers(validation=Depends(oauth2.validate_user)):
+    """Размер, объем и время последней записи каждого процесса, сохраняющего лицензии в базу данных."""
+    return await get_db_writers_stats(redis_client)
+
+
+def percent_change(new: float | None, old: float | None) -> float | None:
+    if new is None or not old:
+        return None
+    return round((new - old) / old * 100, 1)
+
+
+@router.get("/history/", response_model=List[RunComparison], tags=["Get Parsing Status"])
+async def get_parsing_history(limit: int = Query(default=10, le=100, ge=1, description="Количество последних запусков"),
+                              table: str = Query(default='active_licenses', description="Загружаемая таблица"),
+                              statistics_dal: StatisticsDAL = Depends(get_statistics_dal),
+                              validation=Depends(oauth2.validate_user)):
+    """
+    Производительность последних запусков: пропускная способность, задержки загрузки страниц, повторы,
+    ответы 5xx, объем загруженных данных, время CPU на разбор, скорость записи в базу и пиковая память.
+    changes -- изменение каждого показателя относительно предыдущего запуска в процентах.
+    """
+    runs = await statistics_dal.get_history(table=table, limit=limit + 1)
+    history = []
+    for run, previous in zip(runs, runs[1:] + [None]):
+        changes = {}
+        if previous:
+            changes = {field: percent_change(getattr(run, field), getattr(previous, field))
+                       for field in PERFORMANCE_FIELDS}
+        history.append(RunComparison(**run.dict(), changes=changes))
+    return history[:limit]
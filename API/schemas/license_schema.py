@@ -34,3 +34,5 @@ class License(LicenseBase):
 class LicenseFromDB(License):
     id: int
     created_at: datetime
+    removed_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
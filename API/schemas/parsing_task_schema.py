@@ -1,8 +1,23 @@
+from enum import Enum
 from typing import Optional
 
 from pydantic import BaseModel
 
 
+class CrawlMode(str, Enum):
+    full = 'full'    # Fetch every card
+    delta = 'delta'  # Fetch only new cards and a sample of stored ones
+
+
+class Progress(BaseModel):
+    pages_per_sec: float
+    cards_per_sec: float
+    cards_total: int  # Cards expected to be written, extrapolated from the parsed pages
+    percent: float
+    eta_seconds: Optional[int] = None
+    eta: Optional[str] = None  # UTC
+
+
 class ParsingTask(BaseModel):
     task_id: Optional[str] = None
     status: str
@@ -10,3 +25,34 @@ class ParsingTask(BaseModel):
     ended: Optional[str] = None
     num_results: Optional[str] = None
     details: Optional[str] = None
+    resume_from: Optional[str] = None
+    mode: Optional[str] = None
+    concurrency_limit: Optional[str] = None
+    concurrency_adjustments: Optional[str] = None
+    last_concurrency_adjustment: Optional[str] = None
+    missing_card_fields: Optional[str] = None
+    unknown_card_fields: Optional[str] = None
+    rows_inserted: Optional[str] = None
+    rows_updated: Optional[str] = None
+    rows_unchanged: Optional[str] = None
+    num_pages: Optional[str] = None
+    pages_done: Optional[str] = None
+    cards_queued: Optional[str] = None
+    cards_fetched: Optional[str] = None
+    cards_written: Optional[str] = None
+    errors: Optional[str] = None
+    progress: Optional[Progress] = None  # Derived from the counters while the task is in progress
+
+
+class DBWriterStats(BaseModel):
+    writer: str
+    flushes: Optional[str] = None
+    last_rows: Optional[str] = None
+    last_committed: Optional[str] = None
+    last_bytes: Optional[str] = None
+    last_latency: Optional[str] = None
+    last_reason: Optional[str] = None
+    target_rows: Optional[str] = None
+    rows_written: Optional[str] = None
+    db_time: Optional[str] = None
+    updated: Optional[str] = None
@@ -1,9 +1,14 @@
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 
 from pydantic import BaseModel
 
 
+# Fields of StatisticsDB compared between runs
+PERFORMANCE_FIELDS = ('pages_per_sec', 'cards_per_sec', 'fetch_p50', 'fetch_p95', 'fetch_p99', 'retries', 'http_5xx',
+                      'bytes_downloaded', 'parse_cpu_seconds', 'db_rows_per_sec', 'peak_rss_bytes')
+
+
 class StatisticsBase(BaseModel):
     pass
 
@@ -18,6 +23,26 @@ class StatisticsDB(StatisticsBase):
     csv_file: Optional[str] = None
     started: Optional[datetime] = None
     ended: Optional[datetime] = None
+    rows_inserted: Optional[int] = None
+    rows_updated: Optional[int] = None
+    rows_unchanged: Optional[int] = None
+    # Performance of the run
+    pages_per_sec: Optional[float] = None
+    cards_per_sec: Optional[float] = None
+    fetch_p50: Optional[float] = None
+    fetch_p95: Optional[float] = None
+    fetch_p99: Optional[float] = None
+    retries: Optional[int] = None
+    http_5xx: Optional[int] = None
+    bytes_downloaded: Optional[int] = None
+    parse_cpu_seconds: Optional[float] = None
+    db_rows_per_sec: Optional[float] = None
+    peak_rss_bytes: Optional[int] = None
 
     class Config:
         orm_mode = True
+
+
+class RunComparison(StatisticsDB):
+    # Change of every performance field against the previous run, percent
+    changes: Dict[str, Optional[float]] = {}
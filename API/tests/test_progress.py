@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+
+from common.progress import ProgressTracker
+
+STARTED = datetime(2026, 10, 18, tzinfo=timezone.utc).timestamp()
+
+
+def make_task(**counters) -> dict:
+    task = {'task_id': 'TASK0001', 'status': 'in_progress', 'started': '2026-10-18 00:00:00',
+            'num_pages': '100', 'pages_done': '0', 'cards_queued': '0', 'cards_written': '0'}
+    task.update({key: str(value) for key, value in counters.items()})
+    return task
+
+
+def test_zero_elapsed_time():
+    progress = ProgressTracker().estimate(make_task(pages_done=10, cards_queued=100), now=STARTED)
+    assert progress['pages_per_sec'] == progress['cards_per_sec'] == 0
+    # There is work left and no rate to finish it at
+    assert progress['eta_seconds'] is None and progress['eta'] is None
+
+
+def test_zero_progress():
+    progress = ProgressTracker().estimate(make_task(), now=STARTED + 60)
+    assert progress['percent'] == 0 and progress['cards_total'] == 0
+    assert progress['eta_seconds'] is None
+
+
+def test_finished_run():
+    task = make_task(pages_done=100, cards_queued=500, cards_written=500)
+    progress = ProgressTracker().estimate(task, now=STARTED + 100)
+    assert progress['percent'] == 100 and progress['cards_total'] == 500
+    assert progress['eta_seconds'] == 0
+    assert ProgressTracker().estimate({**task, 'status': 'done'}, now=STARTED + 100) is None
+
+
+def test_eta_follows_stable_rate():
+    tracker = ProgressTracker(window=60)
+    # 1 page and 5 cards a second, 5 cards per page
+    for secs in range(10, 90, 10):
+        progress = tracker.estimate(make_task(pages_done=secs, cards_queued=secs * 5, cards_written=secs * 5),
+                                    now=STARTED + secs)
+    assert progress['pages_per_sec'] == 1 and progress['cards_per_sec'] == 5
+    # Cards found on 80 pages of 100 are extrapolated to the whole registry
+    assert progress['cards_total'] == 500
+    assert progress['percent'] == 80
+    assert progress['eta_seconds'] == 20
+    assert progress['eta'] == '2026-10-18 00:01:40'
+
+
+def test_new_task_resets_samples():
+    tracker = ProgressTracker()
+    tracker.estimate(make_task(pages_done=50), now=STARTED + 50)
+    progress = tracker.estimate({**make_task(pages_done=5), 'task_id': 'TASK0002'}, now=STARTED + 100)
+    # Averaged since the start of the new task
+    assert progress['pages_per_sec'] == 0.05
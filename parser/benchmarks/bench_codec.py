@@ -0,0 +1,88 @@
+"""
+Compare the old str(dict)/literal_eval cards queue format with CardsCodec.
+
+    $ python -m benchmarks.bench_codec [--cards N] [--batch-size N] [--redis]
+
+Cards are made from the synthetic card page in tests/pages with random ids and numbers.
+With --redis every format is also pushed into a temporary Redis list to measure the memory it takes.
+"""
+
+import argparse
+import os
+import random
+import time
+import uuid
+from ast import literal_eval
+from typing import Callable, List
+
+from src.codec import CardsCodec, zstandard
+from src.extractor import CardExtractor, CardRow
+from src.redis import RedisCli
+
+CARD_PAGE = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "pages", "card_page.html")
+
+
+def make_cards(num_cards: int) -> List[CardRow]:
+    with open(CARD_PAGE, encoding="utf-8") as file:
+        card, _, _ = CardExtractor().extract(file.read(), "")
+    return [card._replace(license_id=str(uuid.uuid4()), ogrn=str(random.randrange(10 ** 12, 10 ** 13)),
+                          inn=str(random.randrange(10 ** 9, 10 ** 10)))
+            for _ in range(num_cards)]
+
+
+def batches(cards: List[CardRow], batch_size: int) -> List[List[CardRow]]:
+    return [cards[i:i + batch_size] for i in range(0, len(cards), batch_size)]
+
+
+def redis_memory(r_client: RedisCli, messages: list) -> int:
+    key = "bench_codec_queue"
+    r_client.delete(key)
+    before = r_client.info("memory")["used_memory"]
+    for i in range(0, len(messages), 1000):
+        r_client.lpush(key, *messages[i:i + 1000])
+    used = r_client.info("memory")["used_memory"] - before
+    r_client.delete(key)
+    return used
+
+
+def bench(name: str, encode: Callable, decode: Callable, items: list, num_cards: int, r_client: RedisCli) -> None:
+    start = time.perf_counter()
+    messages = [encode(item) for item in items]
+    encoded = time.perf_counter()
+    for message in messages:
+        decode(message)
+    decoded = time.perf_counter()
+
+    size = sum(len(message) for message in messages)
+    line = (f"{name:<28} encode {(encoded - start) / num_cards * 1e6:7.2f} us/card  "
+            f"decode {(decoded - encoded) / num_cards * 1e6:7.2f} us/card  "
+            f"{size / num_cards:7.1f} bytes/card  {size / 2 ** 20:7.1f} MiB")
+    if r_client:
+        line += f"  redis {redis_memory(r_client, messages) / 2 ** 20:7.1f} MiB"
+    print(line)
+
+
+def main(num_cards: int, batch_size: int, use_redis: bool) -> None:
+    cards = make_cards(num_cards)
+    r_client = RedisCli() if use_redis else None
+    print(f"{num_cards} cards, batches of {batch_size}")
+
+    bench("str/literal_eval", lambda card: str(card._asdict()).encode(),
+          lambda message: literal_eval(message.decode()), cards, num_cards, r_client)
+
+    codecs = [("msgpack", CardsCodec())]
+    if zstandard:
+        codecs.append(("msgpack+zstd", CardsCodec('zstd')))
+    for name, codec in codecs:
+        bench(name, lambda card: codec.encode([card]), codec.decode, cards, num_cards, r_client)
+        bench(f"{name} batch", codec.encode, codec.decode, batches(cards, batch_size), num_cards, r_client)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark cards queue formats.")
+    arg_parser.add_argument("--cards", type=int, default=100_000, help="Number of cards to encode.")
+    arg_parser.add_argument("--batch-size", type=int, default=100, help="Cards per message in batch formats.")
+    arg_parser.add_argument("--redis", action="store_true", help="Measure memory the messages take in Redis.")
+    args = arg_parser.parse_args()
+
+    main(args.cards, args.batch_size, args.redis)
@@ -0,0 +1,109 @@
+"""
+Compare the Redis and the embedded pipeline modes: how fast cards and log records get
+from worker processes to the process that writes them. The database and the log file are left out,
+so only the transport is measured.
+
+    $ python -m benchmarks.bench_pipeline [--cards N] [--logs N] [--workers N] [--batch-size N]
+
+Every worker sends its share of cards in messages of --batch-size cards and its share of log records.
+A single reader reads them like a DB writer and the log server do.
+"""
+
+import argparse
+import logging
+import multiprocessing as mp
+import time
+from typing import List
+
+from benchmarks.bench_codec import make_cards, batches
+from logs.handlers.redis_handler import RedisHandler
+from src.codec import CardsCodec
+from src.embedded import LocalCardsStream, LocalList
+from src.extractor import CardRow
+from src.redis import RedisCli, CardsStream
+
+STREAM = "bench_pipeline_stream"
+LOGS = "bench_pipeline_logs"
+
+
+def send_cards(stream, messages: List[List[CardRow]]) -> None:
+    codec = CardsCodec()
+    for cards in messages:
+        stream.add(codec.encode(cards))
+
+
+def send_logs(r_client, num_records: int) -> None:
+    handler = RedisHandler(LOGS, r_client=r_client)
+    handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)-8s | %(name)s:%(funcName)s - %(message)s"))
+    for i in range(num_records):
+        record = logging.LogRecord("bench", logging.INFO, __file__, 0, f"Log record {i} of the benchmark", None, None)
+        handler.emit(record)
+
+
+def run_workers(target, args_list: list) -> List[mp.Process]:
+    workers = [mp.Process(target=target, args=args) for args in args_list]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def bench_cards(name: str, stream, cards: List[CardRow], num_workers: int, batch_size: int) -> None:
+    messages = batches(cards, batch_size)
+    codec = CardsCodec()
+    start = time.perf_counter()
+    workers = run_workers(send_cards, [(stream, messages[i::num_workers]) for i in range(num_workers)])
+    received = 0
+    while received < len(cards):
+        entries = stream.read("reader", 10, block=1)
+        for _, fields in entries:
+            received += len(codec.decode(fields[b'cards']))
+        stream.ack([entry_id for entry_id, _ in entries])
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    print(f"{name:<10} cards {received / elapsed:10.0f} cards/s  {elapsed:6.2f}s")
+
+
+def bench_logs(name: str, r_client, num_records: int, num_workers: int, batch_size: int = 500) -> None:
+    start = time.perf_counter()
+    workers = run_workers(send_logs, [(r_client, num_records // num_workers)] * num_workers)
+    expected, received = num_records // num_workers * num_workers, 0
+    while received < expected:
+        records = r_client.rpop(LOGS, batch_size)
+        if not records:
+            record = r_client.brpop(LOGS, timeout=1)
+            records = [record[1]] if record else []
+        received += len(records)
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    print(f"{name:<10} logs  {received / elapsed:10.0f} records/s  {elapsed:6.2f}s")
+
+
+def main(num_cards: int, num_logs: int, num_workers: int, batch_size: int) -> None:
+    cards = make_cards(num_cards)
+    print(f"{num_cards} cards in batches of {batch_size}, {num_logs} log records, {num_workers} workers")
+
+    r_client = RedisCli()
+    stream = CardsStream(r_client, STREAM, group="bench")
+    stream.clear()
+    stream.create_group()
+    bench_cards("redis", stream, cards, num_workers, batch_size)
+    stream.clear()
+    r_client.delete(LOGS)
+    bench_logs("redis", r_client, num_logs, num_workers)
+    r_client.delete(LOGS)
+
+    bench_cards("embedded", LocalCardsStream(), cards, num_workers, batch_size)
+    bench_logs("embedded", LocalList(), num_logs, num_workers)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark cards and logs transports.")
+    arg_parser.add_argument("--cards", type=int, default=100_000, help="Number of cards to send.")
+    arg_parser.add_argument("--logs", type=int, default=100_000, help="Number of log records to send.")
+    arg_parser.add_argument("--workers", type=int, default=4, help="Number of sending processes.")
+    arg_parser.add_argument("--batch-size", type=int, default=100, help="Cards per message.")
+    args = arg_parser.parse_args()
+
+    main(args.cards, args.logs, args.workers, args.batch_size)
@@ -1,10 +1,12 @@
-from typing import List
+from typing import AsyncIterator, Dict, List, Sequence
 
 from loguru import logger
+from sqlalchemy import update, func, literal_column
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
 from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import text
 
 from db.models.models import License
 from schemas import card_schema
@@ -29,6 +31,79 @@ class CardDAL:
         await self.db_session.execute(stmt)
         await self.db_session.commit()
 
+    async def create_staging_table(self, staging: str, columns: Sequence[str]) -> None:
+        """
+        Create an unlogged text table to bulk load cards into. It isn't written to WAL, so loading is cheap.
+        A table left by a crashed writer is recreated, its columns could be outdated.
+        seq keeps the order cards were copied in, so the one copied last wins among duplicates.
+        """
+        columns_def = ", ".join(f"{column} VARCHAR" for column in columns)
+        await self.db_session.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        await self.db_session.execute(text(f"CREATE UNLOGGED TABLE {staging} (seq BIGSERIAL, {columns_def})"))
+        await self.db_session.commit()
+
+    async def drop_staging_table(self, staging: str) -> None:
+        await self.db_session.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        await self.db_session.commit()
+
+    async def copy_cards(self, cards: Sequence[tuple], columns: Sequence[str], staging: str) -> Dict[str, int]:
+        """
+        Bulk load cards in one transaction: COPY them into the staging table, then upsert them
+        into active_licenses with one statement. Stored cards are rewritten only if their content hash changed.
+        :param cards: Cards values in the order of `columns`.
+        :param columns: Columns of active_licenses. Must contain license_id and content_hash.
+        :param staging: Staging table made by create_staging_table. It mustn't be shared with other writers.
+        :return: Numbers of inserted, updated and unchanged cards.
+        """
+        await self.db_session.execute(text(f"TRUNCATE {staging}"))
+        # COPY isn't available through SQLAlchemy, asyncpg connection of the session is used.
+        # It's inside the transaction the session has just begun.
+        connection = await (await self.db_session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(staging, records=cards, columns=columns)
+
+        columns_list = ", ".join(columns)
+        set_list = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column != 'license_id')
+        table = License.__tablename__
+        # xmax of a just inserted row is 0, of an updated one it's the id of the updating transaction
+        result = await self.db_session.execute(text(
+            f"WITH upserted AS ("
+            f"  INSERT INTO {table} ({columns_list}) "
+            f"  SELECT DISTINCT ON (license_id) {columns_list} FROM {staging} ORDER BY license_id, seq DESC "
+            f"  ON CONFLICT (license_id) DO UPDATE SET {set_list}, updated_at = now() "
+            f"  WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash "
+            f"  RETURNING xmax = 0 AS inserted"
+            f") "
+            f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted"
+        ))
+        inserted, updated = result.one()
+        await self.db_session.commit()
+
+        license_id = columns.index('license_id')
+        unchanged = len({card[license_id] for card in cards}) - inserted - updated
+        return {'inserted': inserted, 'updated': updated, 'unchanged': unchanged}
+
+    async def upsert_changed_cards(self, cards: List[dict]) -> Dict[str, int]:
+        """
+        Insert cards and rewrite the stored ones only if their content hash changed.
+        :param cards: Cards with license_id, content_hash and fields. Ids must be unique.
+        :return: Numbers of inserted, updated and unchanged cards.
+        """
+        # Core insert: ORM-enabled inserts can't return a plain SQL expression
+        stmt = insert(License.__table__).values(cards)
+        columns = [column for column in cards[0] if column != 'license_id']
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[License.license_id],
+            set_={**{column: stmt.excluded[column] for column in columns}, 'updated_at': func.now()},
+            where=stmt.table.c.content_hash.is_distinct_from(stmt.excluded.content_hash)
+        ).returning(literal_column("xmax = 0"))
+        result = await self.db_session.execute(stmt)
+        inserted_flags = result.scalars().all()
+        await self.db_session.commit()
+
+        inserted = sum(inserted_flags)
+        updated = len(inserted_flags) - inserted
+        return {'inserted': inserted, 'updated': updated, 'unchanged': len(cards) - inserted - updated}
+
     async def get_card(self, license_id: str):
         q = await self.db_session.execute(select(License).where(License.license_id == license_id))
         return q.scalars().first()
@@ -36,3 +111,22 @@ class CardDAL:
     async def get_all_cards(self) -> List[License]:
         q = await self.db_session.execute(select(License).order_by(License.id))
         return q.scalars().all()
+
+    async def iter_licenses_ids(self, removed: bool = False, chunk_size: int = 10000) -> AsyncIterator[List[str]]:
+        """Yield chunks of ids of licenses that are present in the registry or, if removed, disappeared from it."""
+        condition = License.removed_at.isnot(None) if removed else License.removed_at.is_(None)
+        stmt = select(License.license_id).where(condition).execution_options(yield_per=chunk_size)
+        result = await self.db_session.stream_scalars(stmt)
+        async for chunk in result.partitions(chunk_size):
+            yield list(chunk)
+
+    async def set_removed(self, licenses_ids: List[str], removed: bool = True) -> None:
+        """Mark licenses as disappeared from the registry or, if not removed, as present again."""
+        stmt = (
+            update(License)
+            .where(License.license_id.in_(licenses_ids))
+            .values(removed_at=func.now() if removed else None)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db_session.execute(stmt)
+        await self.db_session.commit()
@@ -0,0 +1,210 @@
+import re
+from typing import AsyncIterator, Dict, List, Sequence
+
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import text
+
+from db.models.models import License, DBCardFields
+
+
+class SnapshotDAL:
+    """
+    Blue/green snapshots of active_licenses. The cards of a run are copied into an index-less load table.
+    When the run is done they are merged with the live table into a new snapshot table, its indexes
+    are built and it replaces the live table in one transaction. The replaced table is kept
+    as active_licenses_previous, so the last run can be rolled back.
+    """
+    live = License.__tablename__
+    previous = f"{live}_previous"
+    # Columns the cards are loaded with
+    card_columns = ('license_id', *DBCardFields.keys.values(), 'content_hash')
+
+    def __init__(self, db_session: Session):
+        self.db_session = db_session
+
+    @classmethod
+    def load_table(cls, task_id: str) -> str:
+        return f"{cls.live}_load_{cls._check_task_id(task_id)}"
+
+    @classmethod
+    def snapshot_table(cls, task_id: str) -> str:
+        return f"{cls.live}_{cls._check_task_id(task_id)}"
+
+    @staticmethod
+    def _check_task_id(task_id: str) -> str:
+        # Task id becomes part of table names
+        if not task_id.isalnum():
+            raise ValueError(f"Task id '{task_id}' can't be used in a table name")
+        return task_id.lower()
+
+    async def create_load_table(self, task_id: str, resume_from: str = None) -> None:
+        """
+        Create the table a run loads its cards into. It has no indexes, duplicates are dropped when the snapshot
+        is built: the card loaded last wins. A resumed run takes over the load table of the interrupted one,
+        which has the cards already checkpointed as done.
+        """
+        load_table = self.load_table(task_id)
+        if resume_from:
+            await self.db_session.execute(text(
+                f"ALTER TABLE IF EXISTS {self.load_table(resume_from)} RENAME TO {load_table}"
+            ))
+        columns_def = ", ".join(f"{column} VARCHAR" for column in self.card_columns)
+        await self.db_session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {load_table} (seq BIGSERIAL, {columns_def})"
+        ))
+        await self.db_session.commit()
+
+    async def load_cards(self, task_id: str, cards: Sequence[tuple]) -> None:
+        """COPY cards into the load table of the task. Values must be in the order of card_columns."""
+        connection = await (await self.db_session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(self.load_table(task_id), records=cards,
+                                                                 columns=self.card_columns)
+        await self.db_session.commit()
+
+    async def build_snapshot(self, task_id: str) -> Dict[str, int]:
+        """
+        Merge the loaded cards with the live table into the snapshot table of the task.
+        Stored licenses keep their id and created_at, updated_at changes only if their content hash did.
+        Stored licenses that weren't loaded (not fetched in 'delta' mode, removed ones) are copied as they are.
+        :return: Numbers of inserted, updated and unchanged cards compared to the live table.
+        """
+        load_table, snapshot = self.load_table(task_id), self.snapshot_table(task_id)
+        fields = [column for column in self.card_columns if column != 'license_id']
+        all_columns = ", ".join(column.name for column in License.__table__.columns)
+
+        await self.db_session.execute(text(f"DROP TABLE IF EXISTS {snapshot}"))
+        # Defaults only: ids keep coming from the sequence of the live table, indexes are built after loading
+        await self.db_session.execute(text(f"CREATE TABLE {snapshot} (LIKE {self.live} INCLUDING DEFAULTS)"))
+        # Whether a card is new or changed is decided by the join with the live table, in the same statement
+        result = await self.db_session.execute(text(
+            f"WITH loaded AS ("
+            f"  SELECT DISTINCT ON (license_id) * FROM {load_table} ORDER BY license_id, seq DESC"
+            f"), source AS MATERIALIZED ("
+            f"  SELECT COALESCE(l.id, nextval(pg_get_serial_sequence('{self.live}', 'id'))) AS id, c.license_id, "
+            f"  {', '.join(f'c.{field}' for field in fields)}, COALESCE(l.created_at, now()) AS created_at, "
+            f"  CASE WHEN l.id IS NULL THEN NULL "
+            f"  WHEN l.content_hash IS DISTINCT FROM c.content_hash THEN now() ELSE l.updated_at END AS updated_at, "
+            f"  l.removed_at, l.id IS NULL AS inserted, "
+            f"  l.id IS NOT NULL AND l.content_hash IS DISTINCT FROM c.content_hash AS updated "
+            f"  FROM loaded c LEFT JOIN {self.live} l ON l.license_id = c.license_id"
+            f"), merged AS ("
+            f"  INSERT INTO {snapshot} (id, license_id, {', '.join(fields)}, created_at, updated_at, removed_at) "
+            f"  SELECT id, license_id, {', '.join(fields)}, created_at, updated_at, removed_at FROM source"
+            f") "
+            f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE updated), count(*) FROM source"
+        ))
+        inserted, updated, loaded = result.one()
+        await self.db_session.execute(text(
+            f"INSERT INTO {snapshot} ({all_columns}) SELECT {all_columns} FROM {self.live} l "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {load_table} c WHERE c.license_id = l.license_id)"
+        ))
+        await self.db_session.commit()
+        return {'inserted': inserted, 'updated': updated, 'unchanged': loaded - inserted - updated}
+
+    async def set_removed(self, task_id: str, licenses_ids: List[str], removed: bool = True) -> None:
+        """Mark licenses of the snapshot as disappeared from the registry or, if not removed, as present again."""
+        await self.db_session.execute(
+            text(f"UPDATE {self.snapshot_table(task_id)} SET removed_at = {'now()' if removed else 'NULL'} "
+                 f"WHERE license_id = ANY(:ids)"),
+            {'ids': licenses_ids}
+        )
+        await self.db_session.commit()
+
+    async def build_indexes(self, task_id: str) -> None:
+        """Build the constraints and indexes of the live table on the snapshot, then gather its statistics."""
+        snapshot = self.snapshot_table(task_id)
+        constraints = await self.db_session.execute(text(
+            f"SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            f"WHERE conrelid = '{self.live}'::regclass AND contype IN ('p', 'u')"
+        ))
+        constraints = constraints.all()
+        for name, definition in constraints:
+            await self.db_session.execute(text(
+                f"ALTER TABLE {snapshot} ADD CONSTRAINT {self._rename(name, self.live, snapshot)} {definition}"
+            ))
+        async for name, definition in self._plain_indexes(self.live, [name for name, _ in constraints]):
+            definition = re.sub(rf"INDEX {name} ON (\S+\.)?{self.live} ",
+                                f"INDEX {self._rename(name, self.live, snapshot)} ON {snapshot} ", definition)
+            await self.db_session.execute(text(definition))
+        await self.db_session.execute(text(f"ANALYZE {snapshot}"))
+        await self.db_session.commit()
+
+    async def count_licenses(self, table: str) -> Dict[str, int]:
+        """Numbers of present and removed licenses of a table."""
+        result = await self.db_session.execute(text(
+            f"SELECT count(*) FILTER (WHERE removed_at IS NULL), count(*) FILTER (WHERE removed_at IS NOT NULL) "
+            f"FROM {table}"
+        ))
+        present, removed = result.one()
+        return {'present': present, 'removed': removed}
+
+    async def swap(self, task_id: str) -> None:
+        """
+        Replace the live table with the snapshot in one transaction. Readers see either of them, never a mix.
+        The replaced table becomes the previous one, the one before it is dropped.
+        """
+        sequence = await self._id_sequence()
+        await self.db_session.execute(text(f"DROP TABLE IF EXISTS {self.previous}"))
+        await self._rename_table(self.live, self.previous)
+        await self._rename_table(self.snapshot_table(task_id), self.live)
+        # The sequence would be dropped together with the table that owns it
+        await self.db_session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {self.live}.id"))
+        await self.db_session.commit()
+
+    async def rollback(self) -> None:
+        """Swap the live table with the previous one back."""
+        sequence = await self._id_sequence()
+        rolled_back = f"{self.live}_rolled_back"
+        await self.db_session.execute(text(f"DROP TABLE IF EXISTS {rolled_back}"))
+        await self._rename_table(self.live, rolled_back)
+        await self._rename_table(self.previous, self.live)
+        await self._rename_table(rolled_back, self.previous)
+        await self.db_session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {self.live}.id"))
+        await self.db_session.commit()
+
+    async def drop_load_tables(self) -> None:
+        """Drop load tables of every task. Interrupted runs can't be resumed on top of a newer snapshot."""
+        result = await self.db_session.execute(text(
+            f"SELECT tablename FROM pg_tables WHERE schemaname = current_schema() "
+            f"AND tablename LIKE '{self.live}\\_load\\_%'"
+        ))
+        for table in result.scalars().all():
+            await self.db_session.execute(text(f"DROP TABLE {table}"))
+        await self.db_session.commit()
+
+    async def _id_sequence(self) -> str:
+        result = await self.db_session.execute(text(f"SELECT pg_get_serial_sequence('{self.live}', 'id')"))
+        return result.scalar()
+
+    async def _plain_indexes(self, table: str, exclude: List[str]) -> AsyncIterator[tuple]:
+        """Indexes of the table which don't back a constraint."""
+        result = await self.db_session.execute(text(
+            f"SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = '{table}'"
+        ))
+        for name, definition in result.all():
+            if name not in exclude:
+                yield name, definition
+
+    async def _rename_table(self, table: str, new_name: str) -> None:
+        """Rename a table with its constraints and indexes, whose names start with the table name."""
+        constraints = await self.db_session.execute(text(
+            f"SELECT conname FROM pg_constraint WHERE conrelid = '{table}'::regclass AND contype IN ('p', 'u')"
+        ))
+        constraints = constraints.scalars().all()
+        # Listed before renaming, renamed constraints would look like plain indexes
+        indexes = [name async for name, _ in self._plain_indexes(table, constraints)]
+        for name in constraints:
+            if name.startswith(table):
+                await self.db_session.execute(text(
+                    f"ALTER TABLE {table} RENAME CONSTRAINT {name} TO {self._rename(name, table, new_name)}"
+                ))
+        for name in indexes:
+            if name.startswith(table):
+                await self.db_session.execute(text(
+                    f"ALTER INDEX {name} RENAME TO {self._rename(name, table, new_name)}"
+                ))
+        await self.db_session.execute(text(f"ALTER TABLE {table} RENAME TO {new_name}"))
+
+    @staticmethod
+    def _rename(name: str, table: str, new_table: str) -> str:
+        return new_table + name[len(table):] if name.startswith(table) else f"{new_table}_{name}"
@@ -1,23 +1,98 @@
+import datetime
 import logging
+import os
+import threading
+from collections import deque
+from multiprocessing.util import Finalize
+from typing import Union
 
+from settings import env
+from src.embedded import LocalList
 from src.redis import RedisCli
 
 
 class RedisHandler(logging.Handler):
-    def __init__(self, rq_name: str = "logging_queue") -> None:
+    """
+    Non-blocking handler. Records are put into an in-memory ring buffer and a background thread
+    pushes them to the logs queue in batches, so logging doesn't wait for Redis inside the event loop.
+    When the buffer is full the oldest records are dropped and counted, the drops are reported
+    in the logs queue with the next batch.
+    """
+
+    def __init__(self, rq_name: str = "logging_queue", r_client: Union[RedisCli, LocalList] = None,
+                 buffer_size: int = None, batch_size: int = None, flush_interval: float = None) -> None:
         """
         :param rq_name: Name of the list that will be created in Redis and storing logs.
+        :param r_client: Redis client by default. LocalList sends logs through a pipe in the embedded mode.
+        :param buffer_size: Max records waiting in the buffer.
+        :param batch_size: Max records pushed at once. The buffer is flushed as soon as it has that many.
+        :param flush_interval: How often to flush a buffer that doesn't fill up a batch, secs.
         """
         logging.Handler.__init__(self)
         self.rq_name = rq_name
-        self.redis_client = RedisCli()
+        self.redis_client = r_client or RedisCli()
+        self.buffer_size = buffer_size or env.LOG_BUFFER_SIZE
+        self.batch_size = batch_size or env.LOG_BATCH_SIZE
+        self.flush_interval = flush_interval or env.LOG_FLUSH_INTERVAL
+        self.dropped = 0
+        self.pid = None  # Process the flush thread runs in
+
+    def start(self) -> None:
+        """
+        Start the flush thread. Threads don't survive fork, so every process starts its own with the first record.
+        Records a child inherited in the buffer are left to the parent.
+        """
+        self.pid = os.getpid()
+        self.buffer = deque(maxlen=self.buffer_size)
+        self.dropped = 0
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.flush_periodically, name="redis-log-handler", daemon=True).start()
+        # atexit isn't called in multiprocessing children, their finalizers are
+        Finalize(self, self.flush, exitpriority=10)
 
     def emit(self, record) -> None:
-        """Emit a log message on redis queue."""
+        """Put a log message into the buffer."""
+        if self.pid != os.getpid():
+            self.start()
         try:
             bmsg = self.format(record).encode("utf8")
         except Exception:
             self.handleError(record)
             return
 
-        self.redis_client.lpush(self.rq_name, bmsg)
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(bmsg)
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    def flush_periodically(self) -> None:
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Push buffered records to the logs queue in batches. Records of a failed push are counted as dropped."""
+        if self.pid != os.getpid():
+            return
+        with self.flush_lock:
+            while self.buffer:
+                records = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                with self.lock:
+                    dropped, self.dropped = self.dropped, 0
+                notice = []
+                if dropped:
+                    notice = [f"{datetime.datetime.now()} | WARNING  | PID {os.getpid()} dropped {dropped} "
+                              f"log records, the log buffer was full".encode("utf8")]
+                try:
+                    self.redis_client.lpush(self.rq_name, *notice, *records)
+                except Exception:
+                    with self.lock:
+                        self.dropped += dropped + len(records)
+                    return
+
+    def close(self) -> None:
+        self.flush()
+        logging.Handler.close(self)
@@ -8,12 +8,17 @@ from multiprocessing import Event
 
 from loguru import logger
 
-from db.config import engine
+from db.config import engine, AsyncLocalSession
+from db.dals.card_dal import CardDAL
+from db.dals.snapshot_dal import SnapshotDAL
+from db.models.models import create_tables
 from logs.handlers.redis_handler import RedisHandler
 from processes import log_server, db_server, parser_process
 from src.parser import get_num_pages
-from src.redis import RedisCli, ParsingTask
-from src.utils import split_urls
+from settings import env
+from src.embedded import LocalCardsStream, LocalList
+from src import metrics
+from src.redis import RedisCli, ParsingTask, PageQueue, TaskState, CardsStream
 from schemas.statistics_schema import Statistics
 from db.dals.statistics_dal import StatisticsDAL
 
@@ -21,14 +26,67 @@ from db.dals.statistics_dal import StatisticsDAL
 class RlicParserApp:
     NUM_WORKERS = os.cpu_count()
     logs_rq = "logging_queue"  # Name of the Redis list that will store logs
-    db_rq = "db_cards_queue"  # Name of the Redis list that will store parsed cards
+    db_stream = "db_cards_stream"  # Name of the Redis stream that will store parsed cards
 
     def __init__(self):
+        if env.PIPELINE_MODE not in ('redis', 'embedded'):
+            raise ValueError(f"Unknown pipeline mode '{env.PIPELINE_MODE}', expected 'redis' or 'embedded'")
+        # In the embedded mode cards and logs go through pipes between processes of this machine.
+        # Tasks, checkpoints and pages ranges stay in Redis.
+        self.embedded = env.PIPELINE_MODE == 'embedded'
+        self.logs_list = LocalList() if self.embedded else None
         self.stop_log_server = Event()
-        self.log_server = log_server.RedisLogServer(event=self.stop_log_server, rq_name=self.logs_rq)
-        self.stop_db_server = Event()
-        self.db_server = db_server.DBServer(engine=engine, event=self.stop_db_server, rq_name=self.db_rq)
+        self.log_server = log_server.RedisLogServer(event=self.stop_log_server, rq_name=self.logs_rq,
+                                                    r_client=self.logs_list)
+        self.stop_db_servers = None
+        self.db_servers = []
         self.redis_client = RedisCli()
+        self.page_queue = PageQueue(self.redis_client)
+        if self.embedded:
+            self.cards_stream = LocalCardsStream()
+        else:
+            self.cards_stream = CardsStream(self.redis_client, self.db_stream)
+
+    @staticmethod
+    async def prepare_db(task_id: str, resume_from: str = None) -> None:
+        """Create tables once, before DB writers start inserting."""
+        await create_tables(engine)
+        if env.DB_SNAPSHOTS:
+            async with AsyncLocalSession() as session:
+                await SnapshotDAL(session).create_load_table(task_id, resume_from)
+        await engine.dispose()
+
+    def start_db_servers(self, task_id: str, resume_from: str = None) -> None:
+        """A process can be started only once, so every task gets its own DB writers."""
+        asyncio.run(self.prepare_db(task_id, resume_from))
+        self.cards_stream.create_group()
+        self.stop_db_servers = Event()
+        self.db_servers = [
+            db_server.DBServer(engine=engine, event=self.stop_db_servers, consumer=f"writer-{i + 1}",
+                               stream=self.db_stream, task_id=task_id, snapshot=env.DB_SNAPSHOTS,
+                               cards_stream=self.cards_stream if self.embedded else None,
+                               # Read as many stream entries as it takes to fill one DB batch
+                               chunk_size=max(1, env.DB_BATCH_SIZE // env.CARDS_BATCH_SIZE))
+            for i in range(env.DB_WRITERS)
+        ]
+        for server in self.db_servers:
+            server.start()
+
+    def join_db_servers(self) -> None:
+        """Let DB writers write the rest of the cards and wait until they stop."""
+        alive = [server for server in self.db_servers if server.is_alive()]
+        if alive:
+            self.stop_db_servers.set()
+            # Every card is already in the stream, stop entries go after them and wake the writers up.
+            self.cards_stream.stop(len(alive))
+            for server in alive:
+                server.join()
+        if self.db_servers:
+            pending = self.cards_stream.pending()
+            if pending:
+                logger.warning(f"{pending} cards stream entries weren't written. "
+                               f"Their cards stay unfinished in the task checkpoints.")
+        self.db_servers = []
 
     def configure_logger(self, log_format: str = None):
         """Change loguru's default log format and adds RedisHandler for sending log records to Redis queue."""
@@ -39,80 +97,196 @@ class RlicParserApp:
                          "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
         logger.add(sys.stdout, format=log_format)
 
-        logger.add(RedisHandler(), format=log_format)
+        logger.add(RedisHandler(r_client=self.logs_list), format=log_format)
 
     def clear_redis(self):
-        """Delete Redis variables that were using."""
-        self.redis_client.delete(self.db_rq)
-        self.redis_client.delete(self.logs_rq)
+        """Delete Redis variables that were using. Logs queue is left to the log server that outlives tasks."""
+        self.cards_stream.clear()
+        self.page_queue.clear()
+
+    @staticmethod
+    async def load_known_licenses(task_state: TaskState) -> None:
+        """
+        Copy ids of stored licenses into Redis, so workers can tell new licenses from known ones.
+        Errors aren't swallowed: with a partial list known licenses would be taken for new ones.
+        """
+        await create_tables(engine)
+        task_state.clear_known()
+        async with AsyncLocalSession() as session:
+            dal = CardDAL(session)
+            for removed in (False, True):
+                async for licenses_ids in dal.iter_licenses_ids(removed=removed):
+                    task_state.add_known(licenses_ids, removed=removed)
+        await engine.dispose()
+
+    @staticmethod
+    async def update_removed_licenses(task_state: TaskState, chunk_size: int = 1000) -> None:
+        """
+        Mark stored licenses that weren't found in the registry as removed and found again ones as present.
+        Errors aren't swallowed, so the task fails instead of being reported as done.
+        """
+        disappeared = task_state.get_disappeared()
+        reappeared = task_state.get_reappeared()
+        async with AsyncLocalSession() as session:
+            dal = CardDAL(session)
+            for i in range(0, len(disappeared), chunk_size):
+                await dal.set_removed(disappeared[i:i + chunk_size], removed=True)
+            for i in range(0, len(reappeared), chunk_size):
+                await dal.set_removed(reappeared[i:i + chunk_size], removed=False)
+        await engine.dispose()
+        logger.info(f"{len(disappeared)} licenses disappeared from the registry, {len(reappeared)} reappeared.")
+
+    @staticmethod
+    async def publish_snapshot(task_state: TaskState, complete: bool) -> dict:
+        """
+        Merge the cards loaded by the run with active_licenses into a snapshot and swap it in.
+        Errors aren't swallowed: the task fails and keeps the loaded cards, so it can be resumed.
+        :param complete: Whether every page was parsed. Only then disappeared licenses are marked as removed.
+        :return: Numbers of inserted, updated and unchanged cards.
+        """
+        task_id = task_state.task_id
+        async with AsyncLocalSession() as session:
+            dal = SnapshotDAL(session)
+            counts = await dal.build_snapshot(task_id)
+            if complete:
+                await dal.set_removed(task_id, task_state.get_disappeared(), removed=True)
+                await dal.set_removed(task_id, task_state.get_reappeared(), removed=False)
+            await dal.build_indexes(task_id)
+            previous = await dal.count_licenses(SnapshotDAL.live)
+            current = await dal.count_licenses(dal.snapshot_table(task_id))
+            await dal.swap(task_id)
+            await dal.drop_load_tables()
+        await engine.dispose()
+        logger.info(f"Snapshot of task {task_id} replaced {SnapshotDAL.live}: {current['present']} present and "
+                    f"{current['removed']} removed licenses, previously {previous['present']} and "
+                    f"{previous['removed']}. Inserted {counts['inserted']}, updated {counts['updated']}, "
+                    f"unchanged {counts['unchanged']}. The previous table is kept as {SnapshotDAL.previous}.")
+        return counts
+
+    worker_cards_stream = None  # Set in workers processes in the embedded mode
 
     @classmethod
-    def worker(cls, worker_id: int, urls: list):
+    def init_worker(cls, cards_stream: LocalCardsStream = None) -> None:
+        """Initializer of workers processes. A multiprocessing queue can be handed over only when a process starts."""
+        cls.worker_cards_stream = cards_stream
+
+    @classmethod
+    def worker(cls, worker_id: int):
         logger.info(f"Started worker {worker_id}, PID: {os.getpid()}")
-        parser = parser_process.ParserProcess(urls=urls, worker_id=worker_id)
+        parser = parser_process.ParserProcess(worker_id=worker_id, cards_stream=cls.worker_cards_stream)
         asyncio.run(parser.run())
         logger.info(f"Done worker {worker_id}, PID: {os.getpid()}")
 
-    def run(self) -> None:
+    def run(self, task_state: TaskState) -> bool:
+        """Parse the registry. Returns whether every page was parsed."""
         num_pages, num_licenses = (asyncio.run(get_num_pages())).values()
         logger.info(f"Counted {num_pages} pages, {num_licenses} licenses.")
         parsing_task.set_value('num_results', num_licenses)
-        parsing_task.set_value('num_results', num_licenses)
+        parsing_task.set_value('num_pages', num_pages)
+
+        # Skip pages and cards that are already checkpointed if the task resumes an interrupted one
+        pages_done = task_state.get_pages_done()
+        if pages_done:
+            num_cards = task_state.queue_missing_cards()
+            logger.info(f"Resuming task: {len(pages_done)} pages are already parsed, "
+                        f"{num_cards} found cards are not written yet.")
+            # Cards the interrupted task has written aren't counted, they don't have to be written again
+            parsing_task.set_value('pages_done', len(pages_done))
+            parsing_task.set_value('cards_queued', num_cards)
 
-        urls = [f'https://islod.obrnadzor.gov.ru/rlic/search/?page={i}' for i in range(1, num_pages + 1)]
+        asyncio.run(self.load_known_licenses(task_state))
 
-        urls_chunks = split_urls(urls, self.NUM_WORKERS)
+        # Workers claim pages ranges from the queue on demand
+        self.page_queue.fill(num_pages, env.PAGES_RANGE_SIZE, skip=pages_done)
 
         # Create workers
-        with ProcessPoolExecutor(max_workers=self.NUM_WORKERS) as executor:
+        with ProcessPoolExecutor(max_workers=self.NUM_WORKERS, initializer=self.init_worker,
+                                 initargs=(self.cards_stream if self.embedded else None,)) as executor:
             for i in range(self.NUM_WORKERS):
                 try:
-                    executor.submit(self.worker, worker_id=i+1, urls=urls_chunks[i])
+                    executor.submit(self.worker, worker_id=i+1)
 
                 except Exception as e:
                     logger.error(e)
 
+        # Only a complete pass over the registry tells which licenses are gone
+        complete = bool(num_pages) and len(task_state.get_pages_done()) >= num_pages
+        if not complete:
+            logger.warning("Not every page was parsed. Skip marking disappeared licenses.")
+        elif not env.DB_SNAPSHOTS:
+            # Snapshots are marked when they are published
+            asyncio.run(self.update_removed_licenses(task_state))
+        return complete
+
 
 if __name__ == "__main__":
     app = RlicParserApp()
     app.configure_logger()
     app.log_server.start()
     parsing_task = ParsingTask(app.redis_client)
-    parsing_task.init_hash()
+    task_status = parsing_task.get_status()
+    if task_status == 'in_progress':
+        # Previous run was interrupted. Keep its task_id and checkpoints, so it can be resumed.
+        parsing_task.set_value('status', 'failed')
+        parsing_task.set_value('details', 'Interrupted')
+        TaskState(app.redis_client, parsing_task.get_task_id()).expire(env.CHECKPOINT_TTL)
+    elif task_status != 'failed':
+        # A failed task keeps its task_id too, its checkpoints live for CHECKPOINT_TTL after the failure
+        parsing_task.init_hash()
 
     while True:
         if parsing_task.get_value('status') == 'active':
+            task_state = TaskState(app.redis_client, parsing_task.get_task_id())
+            run_started = time.time()
             try:
-                app.db_server.start()
+                resume_from = parsing_task.get_value('resume_from')
+                if resume_from:
+                    task_state = TaskState(app.redis_client, resume_from).move_to(task_state.task_id)
+
+                # Counters start from zero every run and gauges of the previous run's processes go away
+                app.redis_client.delete(metrics.Metrics.hname)
+                app.start_db_servers(task_state.task_id, resume_from)
                 logger.info(f"Main Process PID: {os.getpid()}")
 
                 parsing_task.set_value('status', 'in_progress')
                 parsing_task.set_value('started', str(datetime.datetime.utcnow()))
                 parsing_task.set_value('ended', '')
+                parsing_task.reset_run_stats()
 
-                app.run()
+                complete = app.run(task_state)
 
-                app.stop_db_server.set()
-                app.db_server.join()
-                app.stop_log_server.set()
-                app.log_server.join()
+                app.join_db_servers()
+                if env.DB_SNAPSHOTS:
+                    rows = asyncio.run(app.publish_snapshot(task_state, complete))
+                    for key, value in rows.items():
+                        parsing_task.set_value(f"rows_{key}", value)
                 app.clear_redis()
+                task_state.clear()
 
                 parsing_task.set_value('status', 'done')
             except Exception as e:
+                app.join_db_servers()
+                # Keep checkpoints for a while, so the task can be resumed
+                task_state.expire(env.CHECKPOINT_TTL)
                 app.redis_client.hset('parsing_task', 'status', 'failed')
-                app.redis_client.hset('parsing_task', 'details', e)
+                app.redis_client.hset('parsing_task', 'details', str(e))
             finally:
                 parsing_task.set_value('ended', str(datetime.datetime.utcnow()))
 
                 # Insert to statistics table
                 finished_task = parsing_task.get_hash()
                 finished_task['table'] = 'active_licenses'
+                try:
+                    performance = metrics.summarize(metrics.read(app.redis_client), time.time() - run_started)
+                    logger.info(f"Task {finished_task.get('task_id')} performance: {performance}")
+                    finished_task.update(performance)
+                except Exception as e:
+                    logger.warning(f"Failed to summarize the task performance\n{e}")
                 statistics = StatisticsDAL()
                 print(finished_task)
                 print(Statistics(**finished_task))
                 asyncio.run(statistics.create(Statistics(**finished_task)))
 
         else:
-            # Waiting for active task
-            time.sleep(1)
+            # Waiting for active task. The status is checked again after the timeout in case an event was lost.
+            parsing_task.wait_for_event(env.TASK_WAIT_TIMEOUT)
@@ -1,88 +1,321 @@
 import asyncio
 import multiprocessing as mp
 import os
-from ast import literal_eval
-from typing import List
+import time
+from typing import Dict, List, Tuple, Union
 
 from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncEngine
 
 from db.config import async_session, Base
-from db.dals import card_dal
+from db.dals import card_dal, snapshot_dal
+from db.models import models
 from schemas.card_schema import License
-from src.redis import RedisCli
+from settings import env
+from src.batcher import AdaptiveBatcher
+from src.codec import CardsCodec
+from src.embedded import LocalCardsStream
+from src.extractor import CardRow, content_hash
+from src.metrics import metrics, peak_rss
+from src.redis import CardsStream, ParsingTask, RedisCli, TaskState
 
 
 class DBServer(mp.Process):
-    """Interacts with Postgres database and Redis until the event is set."""
+    """
+    One of the DB writers of the cards stream. Interacts with Postgres database and Redis
+    until the event is set or a stop entry is read.
+    """
 
-    def __init__(self, event: mp.Event, engine: AsyncEngine,
-                 rq_name: str = "db_cards_queue", chunk_size: int = 10) -> None:
+    def __init__(self, event: mp.Event, engine: AsyncEngine, consumer: str = "writer-1",
+                 stream: str = "db_cards_stream", chunk_size: int = 10, task_id: str = None,
+                 claim_idle: float = None, snapshot: bool = False,
+                 cards_stream: Union[CardsStream, LocalCardsStream] = None) -> None:
         """
         :param engine: SQLAlchemy AsyncEngine instance.
         :param event: Flag when to stop interact with db.
-        :param rq_name: Name of the Redis list that will store parsed cards which will be inserted into DB.
-        :param chunk_size: How many rows insert into db at once.
+        :param consumer: Name of this writer in the consumer group. Must be unique among running writers.
+        :param stream: Name of the Redis stream that stores parsed cards which will be inserted into DB.
+        :param chunk_size: How many stream entries (batches of cards) to read at once.
+        :param task_id: Id of the parsing task. Inserted cards are checkpointed under it.
+        :param claim_idle: Entries of other writers not acknowledged for that many secs are taken over.
+        :param snapshot: Load cards into the snapshot load table of the task instead of upserting them
+                         into the live table. Cards are always loaded with COPY then.
+        :param cards_stream: Stream to read instead of the Redis one named `stream`. LocalCardsStream in the
+                             embedded mode.
         """
         super(DBServer, self).__init__()
 
         self.event = event
-        self.rq_name = rq_name
+        self.consumer = consumer
         self.chunk_size = chunk_size
+        self.claim_idle = env.DB_CLAIM_IDLE if claim_idle is None else claim_idle
+        self.codec = CardsCodec()
+        self.stop_received = False
         self.redis_client = RedisCli()
+        self.stream = cards_stream or CardsStream(self.redis_client, stream)
+        self.parsing_task = ParsingTask(self.redis_client)
+        self.task_state = TaskState(self.redis_client, task_id) if task_id else None
+        if env.DB_LOAD_METHOD not in ('copy', 'insert'):
+            raise ValueError(f"Unknown DB load method '{env.DB_LOAD_METHOD}', expected 'copy' or 'insert'")
+        self.snapshot = snapshot
+        if snapshot and not task_id:
+            raise ValueError("Cards are loaded into a snapshot of a task, task_id is required")
+        self.task_id = task_id
+        self.load_method = 'copy' if snapshot else env.DB_LOAD_METHOD
+        # Max cards per transaction
+        self.batch_rows = env.DB_BATCH_SIZE if self.load_method == 'copy' else self.max_insert_rows
+        self.batcher = AdaptiveBatcher(max_rows=self.batch_rows, min_rows=env.DB_BATCH_MIN_SIZE,
+                                       max_bytes=env.DB_BATCH_MAX_BYTES, max_wait=env.DB_BATCH_MAX_WAIT,
+                                       latency_target=env.DB_COMMIT_LATENCY_TARGET)
+        self.stats_key = f"db_writer_stats:{consumer}"
+        self.flushes = 0
+        self.staging = f"{models.License.__tablename__}_staging_{consumer.replace('-', '_')}"
+        self.rows_written = 0
+        self.db_time = 0.0  # Secs spent in committed transactions
+        self.metrics_flushed = 0.0
         if isinstance(engine, AsyncEngine):
             self.engine = engine
 
     async def create_tables(self) -> None:
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        await models.create_tables(self.engine)
 
     async def drop_tables(self) -> None:
         async with self.engine.begin() as conn:
             await conn.run_sync(Base.metadata.drop_all)
 
-    async def get_cards(self) -> List[dict]:
+    # One INSERT can't have more than 32767 parameters, 18 per card
+    max_insert_rows = 1000
+
+    def get_entries(self, block: float = None) -> List[Tuple[bytes, List[CardRow]]]:
+        """
+        Reads up to self.chunk_size new entries of the stream and decodes their cards.
+        :param block: If there are no new entries, wait up to that many seconds for them.
+        :return: Entries ids with their cards.
+        """
+        return self.decode(self.stream.read(self.consumer, self.chunk_size, block=block))
+
+    def claim_entries(self, min_idle: float) -> List[Tuple[bytes, List[CardRow]]]:
+        """Takes over entries other writers didn't acknowledge for `min_idle` secs. They probably died."""
+        entries = self.decode(self.stream.claim(self.consumer, min_idle, self.chunk_size))
+        if entries:
+            logger.warning(f"DB writer {self.consumer} took over {len(entries)} unacknowledged entries")
+        return entries
+
+    def decode(self, entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[Tuple[bytes, List[CardRow]]]:
         """
-        Pops N cards from the redis queue and formats them into dicts.
-        N = self.chunk_size or less if queue length < self.chunk_size.
+        Decode cards of the entries. An entry that can't be decoded (unknown version, corrupt payload)
+        is moved to the dead letters of the stream, so neither this writer nor another one fails on it again.
         """
-        n_inserts = min(self.chunk_size, self.redis_client.llen(self.rq_name))
-        cards = [literal_eval(self.redis_client.rpop(self.rq_name).decode('utf8', 'strict'))
-                 for _ in range(n_inserts)]
-        return cards
+        decoded = []
+        for entry_id, fields in entries:
+            if b'stop' in fields:
+                self.stop_received = True
+                self.stream.ack([entry_id])
+                continue
+            try:
+                decoded.append((entry_id, self.codec.decode(fields[b'cards'])))
+            except Exception as e:
+                logger.error(f"DB writer {self.consumer} failed to decode entry {entry_id}, "
+                             f"moving it to dead letters\n{e!r}")
+                metrics.inc('parser_db_dead_letters_total')
+                self.stream.dead_letter(entry_id, fields.get(b'cards', b''))
+        return decoded
+
+    @async_session
+    async def create_staging_table(self, session) -> None:
+        await card_dal.CardDAL(session).create_staging_table(self.staging, self.columns)
 
     @async_session
-    async def insert_cards(self, session, cards: List[dict]) -> None:
-        """Inserts pack of cards into the database."""
+    async def drop_staging_table(self, session) -> None:
+        await card_dal.CardDAL(session).drop_staging_table(self.staging)
+
+    # Columns of active_licenses the cards are written into
+    columns = (*CardRow._fields, 'content_hash')
+
+    @async_session
+    async def insert_cards(self, session, cards: List[CardRow]) -> Dict[str, int]:
+        """
+        Upserts pack of cards into the database. Stored cards are rewritten only if they changed.
+        Returns numbers of inserted, updated and unchanged cards if the cards were committed,
+        empty numbers for cards loaded into a snapshot and None if the cards weren't committed.
+        """
+        if self.snapshot:
+            # Snapshots are compared with the live table when the run is done
+            await snapshot_dal.SnapshotDAL(session).load_cards(self.task_id,
+                                                               [(*card, content_hash(card)) for card in cards])
+            return {}
+
         CardDAL = card_dal.CardDAL(session)
-        await CardDAL.create_cards([License(**card) for card in cards])
+        if self.load_method == 'copy':
+            return await CardDAL.copy_cards([(*card, content_hash(card)) for card in cards], self.columns,
+                                            self.staging)
+
+        # One statement can't touch a row twice
+        cards = {card.license_id: card for card in cards}.values()
+        return await CardDAL.upsert_changed_cards(
+            [{**License(**card._asdict()).dict(), 'content_hash': content_hash(card)} for card in cards]
+        )
 
-    async def coroutine(self, pause: float = 5) -> None:
+    async def write_cards(self, entries: List[Tuple[bytes, List[CardRow]]]) -> int:
         """
-        Interacts with the database until the event is set. Interactions like: inserting cards, etc.
-        :param pause: How long to sleep if redis queue empty.
+        Inserts cards of the entries, checkpoints them as done and acknowledges the entries if they were committed.
+        Not committed entries stay pending and are retried later by this or another writer.
+        :return: Number of committed cards.
         """
+        committed = 0
+        batch, rows = [], 0
+        for entry in entries:
+            if batch and rows + len(entry[1]) > self.batch_rows:
+                committed += await self.commit_cards(batch)
+                batch, rows = [], 0
+            batch.append(entry)
+            rows += len(entry[1])
+        if batch:
+            committed += await self.commit_cards(batch)
+        return committed
 
-        await self.create_tables()
+    # A failed transaction is retried that many times, waiting commit_retry_delay secs more before each attempt
+    commit_attempts = 3
+    commit_retry_delay = 1.0
 
-        while not self.event.is_set():
-            if self.redis_client.llen(self.rq_name):
-                cards = await self.get_cards()
-                await self.insert_cards(cards)
+    async def commit_cards(self, entries: List[Tuple[bytes, List[CardRow]]]) -> int:
+        """
+        Insert cards of the entries in one transaction, retrying it if it fails.
+        If it keeps failing, Redis stream entries stay pending until they are claimed. Local stream entries
+        can't be claimed, they are put back into the batch.
+        :return: Number of committed cards.
+        """
+        ids = [entry_id for entry_id, _ in entries]
+        cards = [card for _, entry_cards in entries for card in entry_cards]
+        for attempt in range(1, self.commit_attempts + 1):
+            start = time.time()
+            counts = await self.insert_cards(cards)
+            latency = time.time() - start
+            if counts is not None:
+                break
+            logger.warning(f"DB writer {self.consumer} failed to commit {len(cards)} cards of entries "
+                           f"{[entry_id.decode() for entry_id in ids]} (attempt {attempt} of {self.commit_attempts})")
+            metrics.inc('parser_db_commit_failures_total')
+            if attempt < self.commit_attempts:
+                await asyncio.sleep(self.commit_retry_delay * attempt)
+        else:
+            if isinstance(self.stream, LocalCardsStream):
+                logger.error(f"DB writer {self.consumer} puts {len(cards)} not committed cards back into the batch")
+                for entry_id, entry_cards in entries:
+                    self.batcher.add(entry_id, entry_cards)
             else:
-                await asyncio.sleep(pause)
+                logger.error(f"DB writer {self.consumer} leaves entries {[entry_id.decode() for entry_id in ids]} "
+                             f"pending, they are retried once claimed")
+            return 0
+
+        # Rows counts and progress go in one round trip per transaction
+        self.parsing_task.incr_values({'cards_written': len(cards),
+                                       **{f"rows_{key}": value for key, value in counts.items()}})
+        metrics.observe('parser_db_commit_seconds', latency, method='snapshot' if self.snapshot else self.load_method)
+        metrics.inc('parser_db_cards_total', len(cards))
+        for key, value in counts.items():
+            metrics.inc('parser_db_rows_total', value, result=key)
+        self.rows_written += len(cards)
+        self.db_time += latency
+        if self.task_state:
+            self.task_state.mark_cards_done([card.license_id for card in cards])
+        self.stream.ack(ids)
+        return len(cards)
+
+    async def collect(self, entries: List[Tuple[bytes, List[CardRow]]]) -> None:
+        """Add entries to the batch one by one and flush it as soon as it's ready."""
+        for entry_id, cards in entries:
+            self.batcher.add(entry_id, cards)
+            reason = self.batcher.ready()
+            if reason:
+                await self.flush(reason)
+        # The batch could have waited long enough while no entries came
+        reason = self.batcher.ready()
+        if reason:
+            await self.flush(reason)
+
+    async def flush(self, reason: str) -> None:
+        """
+        Write the collected batch and let the batcher adapt to how long it took.
+        :param reason: Why the batch is flushed: 'rows', 'bytes', 'wait' or 'drain'.
+        """
+        entries, rows, size = self.batcher.take()
+        start = time.time()
+        committed = await self.write_cards(entries)
+        latency = time.time() - start
+        self.batcher.record(latency, reason)
+        self.report_flush(rows, committed, size, latency, reason)
+
+    def report_flush(self, rows: int, committed: int, size: int, latency: float, reason: str) -> None:
+        """Log the flush and keep its stats in the writer's Redis hash, so operators can see where writing saturates."""
+        self.flushes += 1
+        logger.info(f"DB writer {self.consumer} flushed {rows} cards ({size} bytes, by {reason}) in {latency:.3f}s "
+                    f"({rows / latency if latency else 0:.0f} rows/s). Committed: {committed}. "
+                    f"Next batch target: {self.batcher.target_rows} cards")
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hset(self.stats_key, mapping={
+            'flushes': self.flushes,
+            'last_rows': rows,
+            'last_committed': committed,
+            'last_bytes': size,
+            'last_latency': f"{latency:.4f}",
+            'last_reason': reason,
+            'target_rows': self.batcher.target_rows,
+            'rows_written': self.rows_written,
+            'db_time': f"{self.db_time:.3f}",
+            'updated': time.time()
+        })
+        pipe.expire(self.stats_key, 24 * 3600)
+        pipe.execute()
+        if time.time() - self.metrics_flushed >= env.METRICS_FLUSH_INTERVAL:
+            self.flush_metrics()
+
+    def flush_metrics(self) -> None:
+        """Set the stream length, the batch target and peak RSS and merge the metrics of the writer into Redis."""
+        metrics.set('parser_cards_stream_length', self.stream.length())
+        metrics.set('parser_db_batch_target_rows', self.batcher.target_rows, writer=self.consumer)
+        metrics.set('parser_peak_rss_bytes', peak_rss(), process=self.consumer)
+        metrics.flush(self.redis_client)
+        self.metrics_flushed = time.time()
+
+    async def coroutine(self, block: float = 1) -> None:
+        """
+        Interacts with the database until the event is set or a stop entry is read.
+        Interactions like: inserting cards, etc. Tables are expected to be created before writers start.
+        :param block: How long to wait for cards in one call if there are no new entries.
+                      The event is checked between the calls.
+        """
+
+        if self.load_method == 'copy' and not self.snapshot:
+            await self.create_staging_table()
+        self.redis_client.delete(self.stats_key)
+
+        last_claim = time.time()
+        while not (self.stop_received or self.event.is_set()):
+            # Don't wait for new entries longer than the collected batch may wait
+            wait = self.batcher.wait_time()
+            entries = self.get_entries(block=block if wait is None else min(block, wait))
+            if time.time() - last_claim > self.claim_idle / 2:
+                entries += self.claim_entries(self.claim_idle)
+                last_claim = time.time()
+            await self.collect(entries)
         else:
-            # Sometimes happens that event is set but redis queue is still not empty.
-            # In that case need to add the rest cards from the queue into the db.
-            while self.redis_client.llen(self.rq_name):
-                cards = await self.get_cards()
-                await self.insert_cards(cards)
+            # Sometimes happens that event is set but the stream still has unread entries.
+            # In that case need to add the rest cards from the stream into the db.
+            while entries := self.get_entries():
+                await self.collect(entries)
+            if self.batcher.rows:
+                await self.flush('drain')
+            if self.load_method == 'copy' and not self.snapshot:
+                await self.drop_staging_table()
+            self.flush_metrics()
             await self.engine.dispose()
+            logger.info(f"DB writer {self.consumer} wrote {self.rows_written} cards in {self.db_time:.1f}s "
+                        f"of transactions ({self.rows_written / self.db_time if self.db_time else 0:.0f} rows/s)")
 
     def run(self) -> None:
         try:
-            logger.info(f"Starting Process for working with the DataBase. PID: {os.getpid()}")
+            logger.info(f"Starting DB writer {self.consumer}. PID: {os.getpid()}")
             asyncio.run(self.coroutine())
         finally:
-            logger.info(f"Stopping Process for working with the DataBase. PID: {os.getpid()}")
-            self.redis_client.delete(self.rq_name)
+            logger.info(f"Stopping DB writer {self.consumer}. PID: {os.getpid()}")
@@ -1,49 +1,64 @@
 import multiprocessing as mp
 import os
-import time
+from typing import Union
 
 from loguru import logger
 
+from settings import env
+from src.embedded import LocalList
+from src.log_file import RotatingLogFile
 from src.redis import RedisCli
 from src.utils import current_date
 
 
 class RedisLogServer(mp.Process):
     def __init__(self, event: mp.Event, output: str = f"./logs/log_files/{current_date()}.log",
-                 rq_name: str = "logging_queue") -> None:
+                 rq_name: str = "logging_queue", batch_size: int = 500,
+                 r_client: Union[RedisCli, LocalList] = None) -> None:
         """
         :param event: Flag when to stop LogServer.
         :param output: Where to save log files.
         :param rq_name: Name of the Redis list that will store logs.
+        :param batch_size: Max number of log records to pop from Redis at once.
+        :param r_client: Redis client by default. LocalList reads logs from a pipe in the embedded mode.
         """
         super(RedisLogServer, self).__init__()
 
         self.event = event
         self.rq_name = rq_name
         self.output = output
-        self.redis_client = RedisCli()
+        self.batch_size = batch_size
+        self.redis_client = r_client or RedisCli()
 
-    def run(self, pause: float = 1.0):
+    def run(self, block: float = 1.0):
         """
-        :param pause: How long to sleep while the redis queue with logs empty to not overload Redis with RPOP requests.
+        Write log records popped from the queue in batches into the rotating log file.
+        The file is flushed whenever the queue is drained.
+        :param block: How long to wait for log records in one call while the redis queue with logs is empty.
+                      The event is checked between the calls.
         """
-        if not os.path.exists('./logs/log_files'):
-            print(os.getcwd())
-            os.makedirs('./logs/log_files')
-
+        output = self.output
+        if env.LOG_JSON:
+            output = f"{os.path.splitext(output)[0]}.jsonl"
+        log_file = RotatingLogFile(output, max_bytes=env.LOG_ROTATE_BYTES, interval=env.LOG_ROTATE_INTERVAL,
+                                   compress=env.LOG_COMPRESS, json_lines=env.LOG_JSON)
 
         try:
             logger.info(f"Starting Process for writing logs. PID: {os.getpid()}")
-            while self.redis_client.llen(self.rq_name) or not self.event.is_set():
-                log_record = self.redis_client.rpop(self.rq_name)
-                if log_record:
-                    log_record = log_record.decode('UTF-8')
-                    if log_record[-2:] != '\n':
-                        log_record = log_record + '\n'
-                    with open(self.output, "a") as file:
-                        file.write(log_record)
+            while True:
+                log_records = self.redis_client.rpop(self.rq_name, self.batch_size)
+                if not log_records and not self.event.is_set():
+                    # Everything is written, the rest can wait in the buffer only while records keep coming
+                    log_file.flush()
+                    log_record = self.redis_client.brpop(self.rq_name, timeout=block)
+                    log_records = [log_record[1]] if log_record else None
+                if log_records:
+                    log_file.write([log_record.decode('UTF-8') for log_record in log_records])
+                elif self.event.is_set():
+                    break
                 else:
-                    time.sleep(pause)
+                    log_file.rotate_if_due()
         finally:
             logger.info(f"Stopping Process for writing logs. PID: {os.getpid()}")
+            log_file.close()
             self.redis_client.delete(self.rq_name)
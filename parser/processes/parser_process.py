@@ -1,133 +1,366 @@
 import asyncio
 import os
-from typing import List
+import random
+import time
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
 
 from loguru import logger
 
-from db.models.models import DBCardFields
+from settings import env
+from src.archive import HtmlArchive
 from src.client import Client
+from src.codec import CardsCodec
+from src.embedded import LocalCardsStream
+from src.extractor import CardExtractor, CardRow
+from src.metrics import metrics, peak_rss
 from src.parser import RlicParser
-from src.redis import RedisCli
+from src.redis import RedisCli, ParsingTask, TokenBucket, PageQueue, TaskState, CardsStream
+from src.scheduler import AIMDController, SlidingWindow, Slots
 from src.utils import ping
 
 
+card_extractor = CardExtractor()
+
+
+def parse_page(kind: str, key: str, html_doc: str) -> Tuple[Union[List[str], Tuple[CardRow, List[str], List[str]]],
+                                                              float]:
+    """
+    Parse a fetched page. Runs in the parse pool, so it must be a module-level function.
+    :param kind: 'table' or 'card'.
+    :param key: Page number of a table or license id of a card.
+    :return: Licenses ids of a table or card row with labels missing on the page and unknown labels,
+    and CPU secs the parsing took. Thread time is counted, so the secs are right in a thread pool too.
+    """
+    start = time.thread_time()
+    if kind == 'table':
+        result = RlicParser.parse_table(html_doc)
+    else:
+        result = card_extractor.extract(html_doc, key)
+    return result, time.thread_time() - start
+
+
 class ParserProcess:
-    def __init__(self, urls: List[str], worker_id: int, rq_name: str = "db_cards_queue") -> None:
+    PAGE_URL = 'https://islod.obrnadzor.gov.ru/rlic/search/?page={}'
+    CARD_URL = 'https://islod.obrnadzor.gov.ru/rlic/details/{}/'
+    PING_ATTEMPTS = 10  # Failed pings before the server is considered down
+    PING_INTERVAL = 30  # Secs between pings
+    SERVER_VERDICT_TTL = 10  # Secs a verdict about the server is reused before it is checked again
+
+    def __init__(self, worker_id: int, stream: str = "db_cards_stream",
+                 max_tables_requests: int = None, max_cards_requests: int = None,
+                 cards_stream: Union[CardsStream, LocalCardsStream] = None) -> None:
+        """
+        Tables pages are claimed in ranges from the shared PageQueue while the worker runs.
+        Coroutines only fetch pages. Fetched pages are handed over to the parse pool through
+        the bounded parse queue, so parsing doesn't block the event loop.
+        :param worker_id: Worker's number.
+        :param stream: Name of the Redis stream that will store parsed cards.
+        :param max_tables_requests: Max number of tables requests in flight.
+        :param max_cards_requests: Max number of cards requests in flight.
+        :param cards_stream: Stream to send cards to instead of the Redis one named `stream`.
+                             LocalCardsStream in the embedded mode.
+        """
         self.tables_queue = asyncio.Queue()
         self.cards_queue = asyncio.Queue()
-        self.rq_name: str = rq_name
-        self.urls = urls
+        # Fetched pages waiting for parsing. Fetchers wait when it's full, so pages don't pile up in memory.
+        self.parse_queue = asyncio.Queue(maxsize=env.PARSE_QUEUE_SIZE)
+        self.parse_pool = None  # Created in run(), so a process pool isn't forked before the worker starts
+        self.codec = CardsCodec(env.CARDS_COMPRESSION, env.CARDS_COMPRESSION_LEVEL)
+        self.cards_buffer: List[CardRow] = []  # Parsed cards waiting to be sent to the DB server in one message
         self.worker_id = worker_id
+        self.max_tables_requests = max_tables_requests or env.PARSER_MAX_TABLES_REQUESTS
+        self.max_cards_requests = max_cards_requests or env.PARSER_MAX_CARDS_REQUESTS
         self.redis_client = RedisCli()
+        self.cards_stream = cards_stream or CardsStream(self.redis_client, stream)
+        self.parsing_task = ParsingTask(self.redis_client)
+        self.page_queue = PageQueue(self.redis_client)
+        self.task_state = TaskState(self.redis_client, self.parsing_task.get_task_id())
+        self.mode = self.parsing_task.get_value('mode') or 'full'
+        self.archive = None
+        if env.ARCHIVE_ENABLED:
+            self.archive = HtmlArchive(env.ARCHIVE_DIR, self.task_state.task_id, worker_id,
+                                       compresslevel=env.ARCHIVE_COMPRESSLEVEL)
+        self.ranges: Dict[str, int] = {}  # Claimed pages ranges and number of their unfinished pages
+        self.page_ranges: Dict[str, str] = {}  # Table url -> pages range it belongs to
+        self.missing_fields = Counter()  # Card labels that weren't found on cards pages
+        self.unknown_fields = Counter()  # Labels on cards pages that aren't in DBCardFields
+        self.progress = Counter()  # Progress counters not added to the parsing_task hash yet
+        self.stopped = False
+        self.client = None  # Pooled HTTP client shared by all coroutines. Created inside the event loop.
+        self.server_lock = None
+        self.server_available = None  # Last verdict of check_server
+        self.server_checked = float('-inf')  # Monotonic time of the last verdict
+        self.controller = None
+        if env.PARSER_ADAPTIVE_CONCURRENCY:
+            self.controller = AIMDController(
+                initial=self.max_cards_requests,
+                min_limit=env.PARSER_MIN_CONCURRENCY,
+                max_limit=env.PARSER_MAX_CONCURRENCY,
+                decrease=env.PARSER_CONCURRENCY_DECREASE,
+                latency_target=env.PARSER_LATENCY_TARGET,
+                on_adjust=self.report_concurrency
+            )
+
+    def report_concurrency(self, old: int, new: int, reason: str) -> None:
+        """Report in-flight limit change into the parsing_task hash."""
+        logger.info(f"Worker {self.worker_id} changed concurrency limit {old} -> {new} ({reason})")
+        self.parsing_task.incr_value('concurrency_limit', new - old)
+        self.parsing_task.incr_value('concurrency_adjustments')
+        self.parsing_task.set_value('last_concurrency_adjustment',
+                                    f"worker {self.worker_id}: {old} -> {new} ({reason})")
+
+    async def handle_table(self, url: str) -> None:
+        """
+        Get one table and hand it over to the parse queue.
+        If the server answered with 5xx, check that it is still alive and put the url back to the queue.
+        """
+        try:
+            res = await self.get_table(self.client, url, archive=self.archive)
+        except Exception:
+            self.page_done(url)
+            raise
+
+        if res['status_code'] == 200:
+            await self.parse_queue.put(('table', res['table_id'], url, res['html']))
+            return
+        self.progress['errors'] += 1
+        if res['status_code'] >= 500:
+            logger.error(f"Failed to parse table {res['table_id']} from {res['url']}. "
+                         f"Response status code -- <{res['status_code']}>. "
+                         f"Is server available?")
+            available = await self.check_server(url='https://islod.obrnadzor.gov.ru/rlic/')
+            if available:
+                # If server is alive then put table url back to queue
+                metrics.inc('parser_retries_total', kind='table')
+                await self.tables_queue.put(res['url'])
+        else:
+            logger.error(f"Failed to parse table {res['table_id']} from {res['url']}. "
+                         f"Response status code -- <{res['status_code']}>")
+            self.page_done(url)
 
-    async def read_tables(self) -> None:
+    def select_cards(self, licenses_ids: List[str]) -> Tuple[List[str], List[str]]:
         """
-        Coroutine for reading tables. Until the self.tables_queue empty, it will be
-        getting pack of urls from the self.tables_queue, creating tasks for getting
-        and parsing each table and after that filling self.cards_queue with parsed
-        cards ids from a table.
+        Decide which cards from a table to fetch. In 'full' mode it's every card. In 'delta' mode
+        it's the cards that aren't stored yet plus a random sample of stored ones to refresh them.
+        :return: Ids to fetch and ids to skip.
         """
+        if self.mode != 'delta':
+            return licenses_ids, []
 
-        try:
-            client = Client()
-            while self.tables_queue.qsize():
-                # Number of simultaneously sent requests. Shouldn't be more than 10 or more than queue size.
-                num_req = min(10, self.tables_queue.qsize())
-
-                urls = [await self.tables_queue.get() for _ in range(num_req)]
-
-                tasks = [asyncio.create_task(self.get_table(client, url)) for url in urls]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                # Handling results and filling cards_queue
-                for res in results:
-                    self.tables_queue.task_done()
-
-                    if isinstance(res, Exception):
-                        continue
-
-                    if res['status_code'] == 200:
-                        # Else fill cards_queue with card's url for each successful result.
-                        for license_id in res['licenses_ids']:
-                            url = f'https://islod.obrnadzor.gov.ru/rlic/details/{license_id}/'
-                            await self.cards_queue.put(url)
-                    elif res['status_code'] >= 500:
-                        logger.error(f"Failed to parse table {res['table_id']} from {res['url']}. "
-                                     f"Response status code -- <{res['status_code']}>. "
-                                     f"Is server available?")
-                        available = await self.check_server(url='https://islod.obrnadzor.gov.ru/rlic/')
-                        if available:
-                            # If server is alive then put table url back to queue
-                            await self.tables_queue.put(res['url'])
-                        else:
-                            break
-                    if res['status_code'] >= 400:
-                        logger.error(f"Failed to parse table {res['table_id']} from {res['url']}. "
-                                     f"Response status code -- <{res['status_code']}>")
-                        continue
-        finally:
-            await client.session.close()
+        to_fetch, to_skip = [], []
+        for license_id, known in zip(licenses_ids, self.task_state.are_known(licenses_ids)):
+            if not known or random.random() < env.DELTA_REFRESH_RATIO:
+                to_fetch.append(license_id)
+            else:
+                to_skip.append(license_id)
+        return to_fetch, to_skip
+
+    def page_done(self, url: str) -> None:
+        """Mark the table as finished and complete its pages range if that was the last page of it."""
+        pages_range = self.page_ranges.pop(url, None)
+        if pages_range is None:
+            return
+        self.ranges[pages_range] -= 1
+        if not self.ranges[pages_range]:
+            del self.ranges[pages_range]
+            self.page_queue.complete(pages_range)
+
+    async def feed_tables(self, poll: float = 0.2) -> None:
+        """
+        Claim pages ranges from the shared PageQueue whenever the local tables queue runs low.
+        Pages urls are generated from a range only when it is claimed. Returns when there is
+        nothing left to claim and no other worker holds a lease on unfinished pages.
+        """
+        while not self.stopped:
+            if self.tables_queue.qsize() >= env.PAGES_RANGE_SIZE:
+                await asyncio.sleep(poll)
+                continue
+
+            pages_range = self.page_queue.claim(env.PAGES_LEASE_TTL)
+            if pages_range:
+                start, end = self.page_queue.parse_range(pages_range)
+                self.ranges[pages_range] = end - start + 1
+                for page in range(start, end + 1):
+                    url = self.PAGE_URL.format(page)
+                    self.page_ranges[url] = pages_range
+                    await self.tables_queue.put(url)
+            elif not self.page_queue.pending():
+                return
+            else:
+                # Other workers still hold leases. If one of them dies its ranges can be taken over.
+                await asyncio.sleep(env.PAGES_LEASE_TTL / 10)
 
-    async def read_cards(self) -> None:
+    async def feed_resumed_cards(self, poll: float = 0.2) -> None:
+        """
+        When resuming a task, take ids of cards that were found but not written into the database
+        by the interrupted task and put their urls to self.cards_queue.
         """
-        Coroutine for reading cards. Until the self.tables_queue and self.cards_queue
-        are empty, it will be getting pack of urls from the self.cards_queue, creating
-        tasks for getting and parsing each card and after that filling the redis queue
-        with parsed cards to write cards into the database in the separate process.
+        while not self.stopped:
+            if self.cards_queue.qsize() >= env.PARSER_MAX_CONCURRENCY:
+                await asyncio.sleep(poll)
+                continue
+
+            licenses_ids = self.task_state.pop_cards_todo(env.PARSER_MAX_CONCURRENCY)
+            if not licenses_ids:
+                return
+            for license_id in licenses_ids:
+                await self.cards_queue.put(self.CARD_URL.format(license_id))
+
+    async def renew_leases(self) -> None:
         """
+        Keep leases of claimed ranges alive. While the worker waits for the server to come back
+        its leases are not renewed, so other workers can take its ranges over.
+        """
+        while True:
+            await asyncio.sleep(env.PAGES_LEASE_TTL / 3)
+            if not self.server_lock.locked():
+                self.page_queue.renew(list(self.ranges), env.PAGES_LEASE_TTL)
+
+    async def handle_card(self, url: str) -> None:
+        """
+        Get one card and hand it over to the parse queue. If the server answered with 5xx,
+        check that it is still alive and put the url back to the queue.
+        """
+        res = await self.get_card(self.client, url, archive=self.archive)
+
+        if res['status_code'] == 200:
+            self.progress['cards_fetched'] += 1
+            await self.parse_queue.put(('card', res['license_id'], url, res['html']))
+            return
+        self.progress['errors'] += 1
+        if res['status_code'] >= 500:
+            logger.error(f"Failed to parse card {res['license_id']} from {res['url']}. "
+                         f"Response status code -- <{res['status_code']}>. "
+                         f"Is server available?")
+            available = await self.check_server(url='https://islod.obrnadzor.gov.ru/rlic/')
+            if available:
+                # If server is alive then put card url back to queue
+                metrics.inc('parser_retries_total', kind='card')
+                await self.cards_queue.put(res['url'])
+        else:
+            logger.error(f"Failed to parse card {res['license_id']} from {res['url']}. "
+                         f"Response status code -- <{res['status_code']}>")
+
+    async def handle_page(self, page: Tuple[str, str, str, str]) -> None:
+        """
+        Parse one fetched page in the parse pool.
+        A table fills self.cards_queue with cards urls from it and is checkpointed as done.
+        A card row is buffered and sent to the cards stream in a batch to write it into the database
+        by DB writers.
+        :param page: Kind ('table' or 'card'), key (page number or license id), url and html of the page.
+        """
+        kind, key, url, html_doc = page
+        loop = asyncio.get_running_loop()
+
+        start = time.time()
+        if kind == 'table':
+            try:
+                all_ids, cpu_seconds = await loop.run_in_executor(self.parse_pool, parse_page, kind, key, html_doc)
+                metrics.observe('parser_parse_seconds', time.time() - start, kind=kind)
+                metrics.inc('parser_parse_cpu_seconds_total', cpu_seconds, kind=kind)
+                # Fill cards_queue with card's url for each successful result.
+                licenses_ids, skipped_ids = self.select_cards(all_ids)
+                for license_id in licenses_ids:
+                    await self.cards_queue.put(self.CARD_URL.format(license_id))
+                self.task_state.page_done(int(key), all_ids, skipped_ids)
+                self.progress.update(pages_done=1, cards_queued=len(licenses_ids))
+            finally:
+                self.page_done(url)
+        else:
+            (card, missing, unknown), cpu_seconds = await loop.run_in_executor(self.parse_pool, parse_page,
+                                                                                kind, key, html_doc)
+            metrics.observe('parser_parse_seconds', time.time() - start, kind=kind)
+            metrics.inc('parser_parse_cpu_seconds_total', cpu_seconds, kind=kind)
+            if missing or unknown:
+                self.count_fields(key, missing, unknown)
+            self.cards_buffer.append(card)
+            if len(self.cards_buffer) >= env.CARDS_BATCH_SIZE:
+                self.flush_cards()
+
+    def flush_cards(self) -> None:
+        """Send buffered cards to the cards stream as one message."""
+        if self.cards_buffer:
+            cards, self.cards_buffer = self.cards_buffer, []
+            self.cards_stream.add(self.codec.encode(cards))
+
+    async def flush_cards_periodically(self) -> None:
+        """Don't let cards wait in a half-full buffer while cards pages come slowly."""
+        while True:
+            await asyncio.sleep(env.CARDS_FLUSH_INTERVAL)
+            self.flush_cards()
+
+    def flush_metrics(self) -> None:
+        """Set queues depths and peak RSS and merge the metrics of the worker into Redis."""
+        for name, queue in (('tables', self.tables_queue), ('cards', self.cards_queue), ('parse', self.parse_queue)):
+            metrics.set('parser_queue_depth', queue.qsize(), queue=name, worker=self.worker_id)
+        metrics.set('parser_cards_buffered', len(self.cards_buffer), worker=self.worker_id)
+        metrics.set('parser_peak_rss_bytes', peak_rss(), process=f"worker-{self.worker_id}")
         try:
-            client = Client()
-            while True:
-                if self.cards_queue.qsize():
-                    num_req = min(10, self.cards_queue.qsize())
-
-                    urls = [await self.cards_queue.get() for _ in range(num_req)]
-
-                    tasks = [asyncio.create_task(self.get_card(client, url)) for url in urls]
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                    for res in results:
-                        if isinstance(res, Exception):
-                            continue
-
-                        if res['status_code'] == 200:
-                            # Change card rus fields to eng in order to write into the database.
-                            card = {v: res['card'][k] for k, v in DBCardFields.keys.items()}
-                            card['license_id'] = res['license_id']
-                            self.redis_client.lpush(self.rq_name, str(card))
-                        elif res['status_code'] >= 500:
-                            logger.error(f"Failed to parse card {res['license_id']} from {res['url']}. "
-                                         f"Response status code -- <{res['status_code']}>. "
-                                         f"Is server available?")
-                            available = await self.check_server(url='https://islod.obrnadzor.gov.ru/rlic/')
-                            if available:
-                                # If server is alive then put table url back to queue
-                                await self.cards_queue.put(res['url'])
-                            else:
-                                break
-                        if res['status_code'] >= 400:
-                            logger.error(f"Failed to parse card {res['license_id']} from {res['url']}. "
-                                         f"Response status code -- <{res['status_code']}>")
-                            continue
-
-                    for _ in results:
-                        self.cards_queue.task_done()
-                else:
-                    # If cards_queue is empty sleep for 3 sec.
-                    await asyncio.sleep(3)
-        except asyncio.CancelledError:
-            await client.session.close()
+            metrics.flush(self.redis_client)
+        except Exception as e:
+            logger.warning(f"Worker {self.worker_id} failed to flush metrics\n{e}")
+
+    async def flush_metrics_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(env.METRICS_FLUSH_INTERVAL)
+            self.flush_metrics()
+
+    def count_error(self, item, e: Exception) -> None:
+        self.progress['errors'] += 1
+
+    def flush_progress(self) -> None:
+        """Add the progress counted since the last flush to the parsing_task hash in one round trip."""
+        if self.progress:
+            progress, self.progress = self.progress, Counter()
+            self.parsing_task.incr_values(progress)
+
+    async def flush_progress_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(env.PROGRESS_FLUSH_INTERVAL)
+            self.flush_progress()
+
+    def count_fields(self, license_id: str, missing: List[str], unknown: List[str]) -> None:
+        """
+        Count card labels that don't match DBCardFields. The card is written anyway.
+        A label is logged the first time the worker sees it, totals per label are logged when the worker ends.
+        Totals of the task go to the parsing_task hash with the batched progress.
+        """
+        new_labels = [label for label in missing if label not in self.missing_fields] + \
+                     [label for label in unknown if label not in self.unknown_fields]
+        if new_labels:
+            logger.warning(f"Card {license_id} doesn't match the schema. Missing: {missing}. Unknown: {unknown}")
+        self.missing_fields.update(missing)
+        self.unknown_fields.update(unknown)
+        if missing:
+            self.progress['missing_card_fields'] += len(missing)
+        if unknown:
+            self.progress['unknown_card_fields'] += len(unknown)
 
     @staticmethod
-    async def get_table(client: Client, url: str, payload: dict = None) -> dict:
+    def make_parse_pool() -> Executor:
         """
-        Send post request and parse table.
+        Pool that parses pages. A process pool takes parsing off the worker's CPU completely.
+        A thread pool is cheaper and is enough for lxml, which releases the GIL while parsing.
+        """
+        if env.PARSE_POOL == 'process':
+            return ProcessPoolExecutor(max_workers=env.PARSE_WORKERS)
+        if env.PARSE_POOL == 'thread':
+            return ThreadPoolExecutor(max_workers=env.PARSE_WORKERS)
+        raise ValueError(f"Unknown parse pool '{env.PARSE_POOL}', expected 'process' or 'thread'")
+
+    @staticmethod
+    async def get_table(client: Client, url: str, payload: dict = None, archive: HtmlArchive = None) -> dict:
+        """
+        Send post request and get table page.
         :param client: Asynchronous client that sends post request.
         :param url: Link page that func parsing.
         :param payload: Searching parameters. E.g., to search for active licenses payload should
                         contain 'licenseStateId' param equals to 1.
+        :param archive: If passed, the raw page is written into it.
         :return: {url: table url, status_code: response status code, table_id: table's page number,
-                  licenses_ids: IDs of licenses that managed to parse}
+                  html: page html or None if the request failed}
         """
 
         if payload is None:
@@ -139,29 +372,51 @@ class ParserProcess:
         page = await client.post(url, payload)
         status_code = page['status_code']
 
+        html_doc = None
         if status_code == 200:
             html_doc = page['response']
-            licenses_ids = RlicParser.parse_table(html_doc)
-        else:
-            licenses_ids = None
+            if archive:
+                archive.write('table', table_id, url, html_doc)
 
-        return {'url': url, 'status_code': status_code, 'table_id': table_id, 'licenses_ids': licenses_ids}
+        return {'url': url, 'status_code': status_code, 'table_id': table_id, 'html': html_doc}
 
     async def check_server(self, url: str = 'https://islod.obrnadzor.gov.ru/rlic/') -> int:
-        """Check if server available by sending requests to the server."""
-        for i in range(10):
-            server_available = await ping(url)
+        """
+        Check if server available by sending requests to the server.
+        Only one coroutine checks at a time, the rest wait for its verdict and get it without checking again.
+        A verdict is reused for SERVER_VERDICT_TTL secs. Once the worker is stopped the server is considered down.
+        """
+        waiting_since = time.monotonic()
+        async with self.server_lock:
+            if self.stopped:
+                return 0
+            if self.server_checked >= waiting_since or \
+                    time.monotonic() - self.server_checked < self.SERVER_VERDICT_TTL:
+                return self.server_available
+            self.server_available = await self._check_server(url)
+            self.server_checked = time.monotonic()
+            return self.server_available
+
+    async def _check_server(self, url: str) -> int:
+        for i in range(self.PING_ATTEMPTS):
+            server_available = await ping(self.client, url)
             if server_available:
                 return 1
             else:
-                if i == 9:
+                if i == self.PING_ATTEMPTS - 1:
                     logger.error(f"Server is not available. Stopping worker {self.worker_id}, "
                                  f"PID: {os.getpid()}")
+                    self.stopped = True
                     await self.clear_queue(self.cards_queue)
                     await self.clear_queue(self.tables_queue)
+                    # Give unfinished pages back, so they can be parsed later.
+                    for pages_range in self.ranges:
+                        self.page_queue.release(pages_range)
+                    self.ranges.clear()
+                    self.page_ranges.clear()
                     return 0
-                logger.warning("Seems like server is not available. Will check again in 30 secs.")
-                await asyncio.sleep(30)
+                logger.warning(f"Seems like server is not available. Will check again in {self.PING_INTERVAL} secs.")
+                await asyncio.sleep(self.PING_INTERVAL)
 
     @staticmethod
     async def clear_queue(queue: asyncio.Queue) -> None:
@@ -170,40 +425,89 @@ class ParserProcess:
             queue.task_done()
 
     @staticmethod
-    async def get_card(client: Client, url: str) -> dict:
+    async def get_card(client: Client, url: str, archive: HtmlArchive = None) -> dict:
         """
-        Send get request and parse card.
+        Send get request and get card page.
         :param client: Asynchronous client that sends get request.
         :param url: Card url
+        :param archive: If passed, the raw page is written into it.
         :return: {url: card url, status_code: response status code, license_id: unique license's id,
-                  card: parsed card}
+                  html: page html or None if the request failed}
         """
         license_id = url[:-1].split('/')[-1]
         page = await client.get(url)
         status_code = page['status_code']
 
+        html_doc = None
         if status_code == 200:
             html_doc = page['response']
-            card = RlicParser.parse_card(html_doc)
-        else:
-            card = None
+            if archive:
+                archive.write('card', license_id, url, html_doc)
 
-        return {'url': url, 'status_code': status_code, 'license_id': license_id, 'card': card}
+        return {'url': url, 'status_code': status_code, 'license_id': license_id, 'html': html_doc}
 
     async def run(self) -> None:
         """
-        Run two coroutines. One for reading tables, other for reading cards.
-        They will run until the tables queue with tables urls and cards queue
-        with cards urls empty."""
-
-        for url in self.urls:
-            await self.tables_queue.put(url)
-
-        read_table_task = asyncio.create_task(self.read_tables())
-        read_cards_task = asyncio.create_task(self.read_cards())
-
-        await self.tables_queue.join()
-        await self.cards_queue.join()
-
-        read_cards_task.cancel()
-        await asyncio.gather(read_table_task, read_cards_task, return_exceptions=True)
+        Run three sliding windows. One for fetching tables, one for fetching cards and one for parsing
+        fetched pages. They will run until there are no pages left in the shared PageQueue
+        and the tables, cards and parse queues are empty."""
+
+        self.server_lock = asyncio.Lock()
+        self.parse_pool = self.make_parse_pool()
+        rate_limiter = None
+        if env.RATE_LIMIT_RPS > 0:
+            rate_limiter = TokenBucket(self.redis_client, rate=env.RATE_LIMIT_RPS,
+                                       capacity=env.RATE_LIMIT_BURST, batch=env.RATE_LIMIT_BATCH)
+        if self.controller:
+            # Tables and cards go to the same server, so both windows follow one controller.
+            self.client = Client(observer=self.controller.record, rate_limiter=rate_limiter)
+            self.parsing_task.incr_value('concurrency_limit', self.controller.limit)
+        else:
+            self.client = Client(rate_limiter=rate_limiter)
+        # With a controller tables and cards requests share its limit, otherwise each kind has its own one
+        requests_slots = Slots(controller=self.controller) if self.controller else None
+        tables_window = SlidingWindow(self.tables_queue, self.handle_table, self.max_tables_requests,
+                                      on_error=self.count_error, slots=requests_slots)
+        cards_window = SlidingWindow(self.cards_queue, self.handle_card, self.max_cards_requests,
+                                     on_error=self.count_error, slots=requests_slots)
+        # Twice as many pages in flight as parsers, so the pool doesn't idle while results are handled.
+        parse_window = SlidingWindow(self.parse_queue, self.handle_page, env.PARSE_WORKERS * 2,
+                                     on_error=self.count_error)
+        try:
+            read_tables_task = asyncio.create_task(tables_window.run())
+            read_cards_task = asyncio.create_task(cards_window.run())
+            parse_pages_task = asyncio.create_task(parse_window.run())
+            renew_leases_task = asyncio.create_task(self.renew_leases())
+            flush_cards_task = asyncio.create_task(self.flush_cards_periodically())
+            flush_metrics_task = asyncio.create_task(self.flush_metrics_periodically())
+            flush_progress_task = asyncio.create_task(self.flush_progress_periodically())
+
+            # Feeders return only after every range is completed, so all tables are already queued.
+            # A table is marked as done only after it's fetched and handed over to the parse queue,
+            # and a parsed table puts its cards urls before it is marked as done. So once tables
+            # and then parse queues are joined cards_queue can't grow anymore.
+            await asyncio.gather(self.feed_tables(), self.feed_resumed_cards())
+            await self.tables_queue.join()
+            await self.parse_queue.join()
+            await self.cards_queue.join()
+            await self.parse_queue.join()
+
+            tasks = (read_tables_task, read_cards_task, parse_pages_task, renew_leases_task, flush_cards_task,
+                     flush_metrics_task, flush_progress_task)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.parse_pool.shutdown(wait=True, cancel_futures=True)
+            self.flush_cards()
+            self.flush_metrics()
+            self.flush_progress()
+            await self.client.close()
+            if self.missing_fields or self.unknown_fields:
+                logger.warning(f"Worker {self.worker_id} cards layout drift. "
+                               f"Missing fields: {dict(self.missing_fields)}. "
+                               f"Unknown fields: {dict(self.unknown_fields)}")
+            if self.archive:
+                self.archive.close()
+            if self.controller:
+                self.parsing_task.incr_value('concurrency_limit', -self.controller.limit)
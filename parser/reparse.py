@@ -0,0 +1,116 @@
+"""
+Parse raw responses archived by a parsing task again and write the cards into the database.
+No requests are sent to the registry, so parser or schema fixes can be applied in minutes.
+
+    $ python reparse.py <task_id> [--workers N] [--batch-size N] [--dry-run]
+
+With --dry-run cards are only parsed, which makes the archive a benchmark of the parser.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Iterator, List, Tuple
+
+from loguru import logger
+
+from db.config import engine, get_async_session
+from db.dals.card_dal import CardDAL
+from db.models.models import create_tables
+from schemas.card_schema import License
+from settings import env
+from src.archive import read_archive
+from src.extractor import CardExtractor, content_hash
+
+
+def parse_batch(pages: List[Tuple[str, str]]) -> Tuple[List[dict], Counter, Counter]:
+    """
+    Parse cards html into db cards. Runs in a separate process.
+    :return: Db cards, counters of labels missing on pages and of labels unknown to the schema.
+    """
+    extractor = CardExtractor()
+    cards, missing_fields, unknown_fields = [], Counter(), Counter()
+    for license_id, html_doc in pages:
+        try:
+            card, missing, unknown = extractor.extract(html_doc, license_id)
+        except Exception as e:
+            logger.error(f"Failed to parse card {license_id}\n{e}")
+            continue
+        cards.append({**card._asdict(), 'content_hash': content_hash(card)})
+        missing_fields.update(missing)
+        unknown_fields.update(unknown)
+    return cards, missing_fields, unknown_fields
+
+
+def iter_batches(task_id: str, batch_size: int) -> Iterator[List[Tuple[str, str]]]:
+    batch = []
+    for record in read_archive(env.ARCHIVE_DIR, task_id, kind='card'):
+        batch.append((record['key'], record['html']))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def write_cards(cards: List[dict]) -> Counter:
+    """Upsert cards, rewriting only the stored ones that changed. Returns numbers of inserted, updated and unchanged."""
+    # A card could be fetched more than once (retries, taken over pages). One upsert can't touch a row twice.
+    cards = {card['license_id']: card for card in cards}
+    async with get_async_session() as session:
+        return Counter(await CardDAL(session).upsert_changed_cards(
+            [{**License(**card).dict(), 'content_hash': card['content_hash']} for card in cards.values()]
+        ))
+
+
+async def reparse(task_id: str, workers: int, batch_size: int, dry_run: bool) -> None:
+    if not dry_run:
+        await create_tables(engine)
+
+    start = time.time()
+    num_cards = 0
+    rows = Counter()
+    missing_fields, unknown_fields = Counter(), Counter()
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: List[Future] = []
+        batches = iter_batches(task_id, batch_size)
+        while True:
+            # Keep a few batches per process in flight, so the archive is streamed, not loaded at once
+            for batch in batches:
+                pending.append(executor.submit(parse_batch, batch))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+
+            cards, missing, unknown = await asyncio.wrap_future(pending.pop(0), loop=loop)
+            missing_fields.update(missing)
+            unknown_fields.update(unknown)
+            if cards and not dry_run:
+                rows += await write_cards(cards) or Counter()
+            num_cards += len(cards)
+
+    elapsed = time.time() - start
+    logger.info(f"Parsed {num_cards} cards of task {task_id} in {elapsed:.1f}s "
+                f"({num_cards / elapsed if elapsed else 0:.1f} cards/s).")
+    if not dry_run:
+        logger.info(f"Inserted {rows['inserted']}, updated {rows['updated']}, unchanged {rows['unchanged']} cards.")
+    if missing_fields or unknown_fields:
+        logger.warning(f"Cards layout drift. Missing fields: {dict(missing_fields)}. "
+                       f"Unknown fields: {dict(unknown_fields)}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Parse archived responses of a task again.")
+    arg_parser.add_argument("task_id", help="Id of the task whose archive to parse.")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of parsing processes.")
+    arg_parser.add_argument("--batch-size", type=int, default=500, help="Cards per parsing batch and DB insert.")
+    arg_parser.add_argument("--dry-run", action="store_true", help="Only parse, don't write into the database.")
+    args = arg_parser.parse_args()
+
+    asyncio.run(reparse(args.task_id, args.workers, args.batch_size, args.dry_run))
@@ -0,0 +1,23 @@
+"""
+Put the licenses table replaced by the last published snapshot back. Running it again undoes the rollback.
+
+    $ python rollback_snapshot.py
+"""
+
+import asyncio
+
+from loguru import logger
+
+from db.config import engine, AsyncLocalSession
+from db.dals.snapshot_dal import SnapshotDAL
+
+
+async def rollback() -> None:
+    async with AsyncLocalSession() as session:
+        await SnapshotDAL(session).rollback()
+    await engine.dispose()
+    logger.info(f"{SnapshotDAL.previous} and {SnapshotDAL.live} were swapped.")
+
+
+if __name__ == "__main__":
+    asyncio.run(rollback())
@@ -13,6 +13,21 @@ class Statistics(BaseModel):
     csv_file: Optional[str]
     started: Optional[datetime]
     ended: Optional[datetime]
+    rows_inserted: Optional[int]
+    rows_updated: Optional[int]
+    rows_unchanged: Optional[int]
+    # Performance of the run
+    pages_per_sec: Optional[float]
+    cards_per_sec: Optional[float]
+    fetch_p50: Optional[float]
+    fetch_p95: Optional[float]
+    fetch_p99: Optional[float]
+    retries: Optional[int]
+    http_5xx: Optional[int]
+    bytes_downloaded: Optional[int]
+    parse_cpu_seconds: Optional[float]
+    db_rows_per_sec: Optional[float]
+    peak_rss_bytes: Optional[int]
 
     class Config:
         orm_mode = True
@@ -13,6 +13,108 @@ class EnvVar(BaseSettings):
     REDIS_DB: str
     REDIS_TIMEOUT: str
 
+    # HTTP client connection pool
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_POOL_LIMIT_PER_HOST: int = 20
+    HTTP_DNS_CACHE_TTL: int = 300
+    HTTP_KEEPALIVE_TIMEOUT: float = 30
+    HTTP_TIMEOUT: float = 60
+
+    # Max number of requests in flight per worker
+    PARSER_MAX_TABLES_REQUESTS: int = 10
+    PARSER_MAX_CARDS_REQUESTS: int = 10
+
+    # Adaptive concurrency (AIMD). Tables and cards requests of a worker share one limit then,
+    # it starts from PARSER_MAX_CARDS_REQUESTS and stays between PARSER_MIN_CONCURRENCY and PARSER_MAX_CONCURRENCY.
+    PARSER_ADAPTIVE_CONCURRENCY: bool = True
+    PARSER_MIN_CONCURRENCY: int = 1
+    PARSER_MAX_CONCURRENCY: int = 50
+    PARSER_CONCURRENCY_DECREASE: float = 0.5
+    PARSER_LATENCY_TARGET: float = 2.0
+
+    # Cluster-wide rate limit of requests to the registry. 0 turns the limiter off.
+    RATE_LIMIT_RPS: float = 0
+    RATE_LIMIT_BURST: int = 0
+    RATE_LIMIT_BATCH: int = 5
+
+    # Pages are handed to workers in ranges of this size on demand
+    PAGES_RANGE_SIZE: int = 5
+    PAGES_LEASE_TTL: float = 60
+
+    # How long (secs) to keep checkpoints of a failed task for resuming it
+    CHECKPOINT_TTL: int = 7 * 24 * 3600
+
+    # Share of already stored licenses that are fetched again in 'delta' mode
+    DELTA_REFRESH_RATIO: float = 0.05
+
+    # Archive of raw responses that can be parsed again offline with reparse.py
+    ARCHIVE_ENABLED: bool = False
+    ARCHIVE_DIR: str = "./archive"
+    ARCHIVE_COMPRESSLEVEL: int = 6
+
+    # Engine for parsing pages: 'lxml', 'soup' (BeautifulSoup, slow) or 'auto' (lxml if installed)
+    HTML_BACKEND: str = "auto"
+
+    # Pages are parsed apart from fetching in a pool of PARSE_WORKERS 'process'es or 'thread's per worker
+    PARSE_POOL: str = "process"
+    PARSE_WORKERS: int = 1
+    PARSE_QUEUE_SIZE: int = 100
+
+    # Compression of cards sent to the DB server: 'none' or 'zstd'
+    CARDS_COMPRESSION: str = "none"
+    CARDS_COMPRESSION_LEVEL: int = 3
+    # Cards are sent in messages of up to CARDS_BATCH_SIZE cards, at least every CARDS_FLUSH_INTERVAL secs
+    CARDS_BATCH_SIZE: int = 100
+    CARDS_FLUSH_INTERVAL: float = 1.0
+
+    # Number of DB writer processes reading the cards stream. Entries a writer didn't acknowledge
+    # for DB_CLAIM_IDLE secs (it died or got stuck) are taken over by another writer.
+    DB_WRITERS: int = 2
+    DB_CLAIM_IDLE: float = 60
+
+    # 'copy' bulk loads cards through an unlogged staging table, DB_BATCH_SIZE cards per transaction.
+    # 'insert' upserts up to 1000 cards per transaction with INSERT ... ON CONFLICT DO UPDATE.
+    DB_LOAD_METHOD: str = "copy"
+    DB_BATCH_SIZE: int = 5000
+
+    # Batches are flushed on DB_BATCH_MAX_BYTES of values or DB_BATCH_MAX_WAIT secs if they don't fill up before.
+    # Their cards target starts at DB_BATCH_MIN_SIZE and adapts to commits time, up to DB_BATCH_SIZE.
+    DB_BATCH_MIN_SIZE: int = 500
+    DB_BATCH_MAX_BYTES: int = 16 * 2 ** 20
+    DB_BATCH_MAX_WAIT: float = 1.0
+    DB_COMMIT_LATENCY_TARGET: float = 1.0
+
+    # Every run loads cards into its own table without indexes. When the run is done they are merged with
+    # active_licenses into a snapshot which replaces it atomically. The replaced table is kept as
+    # active_licenses_previous. Without snapshots cards are upserted into active_licenses right away.
+    DB_SNAPSHOTS: bool = True
+
+    # Log records are buffered in every process and pushed to the logs queue in batches of up to LOG_BATCH_SIZE,
+    # at least every LOG_FLUSH_INTERVAL secs. When LOG_BUFFER_SIZE records wait, the oldest ones are dropped.
+    LOG_BUFFER_SIZE: int = 10000
+    LOG_BATCH_SIZE: int = 500
+    LOG_FLUSH_INTERVAL: float = 0.5
+
+    # The log server starts a new log file after LOG_ROTATE_BYTES or LOG_ROTATE_INTERVAL secs (0 disables either)
+    # and gzips the rotated one. With LOG_JSON records are written as JSON lines into a .jsonl file.
+    LOG_ROTATE_BYTES: int = 100 * 2 ** 20
+    LOG_ROTATE_INTERVAL: float = 24 * 3600
+    LOG_COMPRESS: bool = True
+    LOG_JSON: bool = False
+
+    # Workers and DB writers aggregate metrics in memory and merge them into Redis every METRICS_FLUSH_INTERVAL secs
+    METRICS_FLUSH_INTERVAL: float = 5.0
+
+    # Workers count their progress in memory and add it to the parsing_task hash every PROGRESS_FLUSH_INTERVAL secs
+    PROGRESS_FLUSH_INTERVAL: float = 1.0
+
+    # 'redis' passes cards and logs between processes through Redis, so workers can run on several machines.
+    # 'embedded' passes them through multiprocessing queues, which is cheaper when everything runs on one machine.
+    PIPELINE_MODE: str = "redis"
+
+    # The parser waits for tasks started by the API on a Redis list and re-checks the status after this timeout
+    TASK_WAIT_TIMEOUT: float = 30
+
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,98 @@
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from typing import Iterator
+
+from loguru import logger
+
+from src.metrics import metrics
+
+
+class HtmlArchive:
+    """
+    Append-only archive of raw responses. Every worker of a task writes its own gzip segment
+    into `<directory>/<task_id>/`, one JSON record per line:
+    {"kind": "table" | "card", "key": page number | license id, "url": ..., "fetched_at": ..., "html": ...}
+    Records are serialized and compressed by a writer thread, so writing doesn't stall the worker's event loop.
+    If the disk falls behind and the writer's queue is full, new records are dropped and counted instead of waiting.
+    """
+
+    def __init__(self, directory: str, task_id: str, worker_id: int, compresslevel: int = 6,
+                 max_pending: int = 1000) -> None:
+        """
+        :param directory: Root directory of the archive.
+        :param task_id: Id of the parsing task. Every task gets its own subdirectory.
+        :param worker_id: Worker's number. Used in the segment name together with PID.
+        :param compresslevel: gzip compression level from 1 (fastest) to 9 (smallest).
+        :param max_pending: Max records waiting for the writer thread. More are dropped, so pages don't pile up
+                            in memory and fetching doesn't wait if the disk is slower than the registry.
+        """
+        task_dir = os.path.join(directory, task_id)
+        os.makedirs(task_dir, exist_ok=True)
+        self.path = os.path.join(task_dir, f"worker-{worker_id}-{os.getpid()}.jsonl.gz")
+        self.file = gzip.open(self.path, "at", encoding="utf-8", compresslevel=compresslevel)
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_pending, name="html-archive", daemon=True)
+        self.writer.start()
+
+    def write(self, kind: str, key: str, url: str, html_doc: str) -> None:
+        """Queue the record for the writer thread. Never waits, the record is dropped if the queue is full."""
+        try:
+            self.pending.put_nowait({'kind': kind, 'key': key, 'url': url, 'fetched_at': time.time(),
+                                     'html': html_doc})
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('parser_archive_dropped_total', kind=kind)
+
+    def write_pending(self) -> None:
+        """Write records in batches of everything pending until `close` puts None."""
+        while True:
+            records = [self.pending.get()]
+            try:
+                while True:
+                    records.append(self.pending.get_nowait())
+            except queue.Empty:
+                pass
+            stop = records[-1] is None
+            lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in records if record is not None]
+            try:
+                self.file.write("".join(lines))
+            except Exception as e:
+                logger.error(f"Failed to write {len(lines)} records into archive {self.path}\n{e}")
+            if stop:
+                return
+
+    def close(self) -> None:
+        """Write the pending records and close the segment."""
+        self.pending.put(None)
+        self.writer.join()
+        self.file.close()
+        if self.dropped:
+            logger.warning(f"Archive {self.path} dropped {self.dropped} records, the disk was too slow")
+
+
+def list_segments(directory: str, task_id: str) -> list:
+    task_dir = os.path.join(directory, task_id)
+    return sorted(os.path.join(task_dir, name) for name in os.listdir(task_dir) if name.endswith(".jsonl.gz"))
+
+
+def read_segment(path: str) -> Iterator[dict]:
+    """Yield records of one segment. A segment cut off by a crash is read up to the damaged part."""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+    except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+        logger.warning(f"Segment {path} is damaged, the rest of it is skipped\n{e}")
+
+
+def read_archive(directory: str, task_id: str, kind: str = None) -> Iterator[dict]:
+    """Yield records of every segment of the task. If `kind` is passed, only records of that kind."""
+    for path in list_segments(directory, task_id):
+        for record in read_segment(path):
+            if kind is None or record['kind'] == kind:
+                yield record
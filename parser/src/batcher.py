@@ -0,0 +1,80 @@
+import time
+from typing import List, Optional, Tuple
+
+
+class AdaptiveBatcher:
+    """
+    Collects stream entries with cards into batches. A batch is ready on whichever comes first:
+    `target_rows` cards, `max_bytes` bytes of cards values or `max_wait` secs since its first entry.
+    The rows target follows the commit latency: it grows by `increase` while full batches commit
+    faster than half of `latency_target` and shrinks by `decrease` when a commit takes longer than it.
+    """
+
+    def __init__(self, max_rows: int, min_rows: int = 100, max_bytes: int = 16 * 2 ** 20, max_wait: float = 1.0,
+                 latency_target: float = 1.0, increase: float = 1.5, decrease: float = 0.5) -> None:
+        """
+        :param max_rows: The rows target never goes above this value.
+        :param min_rows: Rows target to start with. It never goes below this value.
+        :param max_bytes: Max size of cards values in a batch.
+        :param max_wait: Max secs between the first entry of a batch and its flush.
+        :param latency_target: Max healthy commit time in secs.
+        :param increase: Factor to multiply the rows target by after a fast commit.
+        :param decrease: Factor to multiply the rows target by after a slow commit.
+        """
+        self.min_rows = min(min_rows, max_rows)
+        self.max_rows = max_rows
+        self.target_rows = self.min_rows
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.entries: List[Tuple[bytes, list]] = []
+        self.rows = 0
+        self.bytes = 0
+        self.first_at = None
+
+    @staticmethod
+    def card_size(card: tuple) -> int:
+        return sum(len(value) for value in card if value)
+
+    def add(self, entry_id: bytes, cards: list) -> None:
+        if not self.entries:
+            self.first_at = time.time()
+        self.entries.append((entry_id, cards))
+        self.rows += len(cards)
+        self.bytes += sum(self.card_size(card) for card in cards)
+
+    def wait_time(self) -> Optional[float]:
+        """Secs left until the batch has to be flushed by time. None if the batch is empty."""
+        if not self.entries:
+            return None
+        return max(0.0, self.max_wait - (time.time() - self.first_at))
+
+    def ready(self) -> Optional[str]:
+        """Return why the batch has to be flushed now: 'rows', 'bytes' or 'wait'. None if it can grow."""
+        if not self.entries:
+            return None
+        if self.rows >= self.target_rows:
+            return 'rows'
+        if self.bytes >= self.max_bytes:
+            return 'bytes'
+        if self.wait_time() == 0:
+            return 'wait'
+        return None
+
+    def take(self) -> Tuple[List[Tuple[bytes, list]], int, int]:
+        """Return entries of the batch, its rows and bytes and start a new batch."""
+        batch = self.entries, self.rows, self.bytes
+        self.entries, self.rows, self.bytes, self.first_at = [], 0, 0, None
+        return batch
+
+    def record(self, latency: float, reason: str) -> None:
+        """
+        Adapt the rows target to the commit time of a flushed batch.
+        Only batches filled up by rows tell that a bigger one would still commit fast.
+        """
+        if latency > self.latency_target:
+            self.target_rows = max(self.min_rows, int(self.target_rows * self.decrease))
+        elif reason == 'rows' and latency < self.latency_target / 2:
+            self.target_rows = min(self.max_rows, int(self.target_rows * self.increase))
@@ -1,13 +1,54 @@
+import asyncio
+import ssl
 import time
+from typing import Callable, Optional
 
 import aiohttp
 
 from loguru import logger
 
+from settings import env
+from src.metrics import metrics, endpoint
+
 
 class Client:
-    def __init__(self, headers: dict = None) -> None:
-        self.session = aiohttp.ClientSession()
+    def __init__(self, headers: dict = None, limit: int = None, limit_per_host: int = None,
+                 ttl_dns_cache: int = None, keepalive_timeout: float = None,
+                 observer: Callable[[float, Optional[int]], None] = None, rate_limiter=None) -> None:
+        """
+        Long-lived HTTP client. One instance is meant to be shared by every coroutine of a worker,
+        so TCP/TLS connections and DNS lookups are reused between requests.
+        :param limit: Max number of simultaneously opened connections.
+        :param limit_per_host: Max number of simultaneously opened connections to the same host.
+        :param ttl_dns_cache: How long (secs) to keep resolved DNS records.
+        :param keepalive_timeout: How long (secs) to keep an idle connection open for reuse.
+        :param observer: Called with response time and status code after every request.
+                         Status code is None if the request timed out or the connection failed.
+        :param rate_limiter: Object with `acquire` coroutine. Every request waits for it before being sent.
+        """
+        self.observer = observer
+        self.rate_limiter = rate_limiter
+        # One SSL context for the whole pool instead of a default one per connection.
+        self.ssl_context = ssl.create_default_context()
+        self.connector = aiohttp.TCPConnector(
+            limit=env.HTTP_POOL_LIMIT if limit is None else limit,
+            limit_per_host=env.HTTP_POOL_LIMIT_PER_HOST if limit_per_host is None else limit_per_host,
+            ttl_dns_cache=env.HTTP_DNS_CACHE_TTL if ttl_dns_cache is None else ttl_dns_cache,
+            use_dns_cache=True,
+            keepalive_timeout=env.HTTP_KEEPALIVE_TIMEOUT if keepalive_timeout is None else keepalive_timeout,
+            ssl=self.ssl_context
+        )
+
+        # Counters of connection reuse versus new connects
+        self.stats = {'connections_created': 0, 'connections_reused': 0, 'dns_cache_hits': 0, 'dns_cache_misses': 0}
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+
+        self.session = aiohttp.ClientSession(connector=self.connector, trace_configs=[trace_config],
+                                             timeout=aiohttp.ClientTimeout(total=env.HTTP_TIMEOUT))
         if not headers:
             self.headers = {
                 # 'content-type': 'application/x-www-form-urlencoded',
@@ -17,18 +58,65 @@ class Client:
         else:
             self.headers = headers
 
+    def _count(self, stat: str) -> None:
+        """Count the event locally for the log and in the metrics, e.g. parser_http_connections_reused_total."""
+        self.stats[stat] += 1
+        metrics.inc(f"parser_http_{stat}_total")
+
+    async def _on_connection_create(self, session, ctx, params) -> None:
+        self._count('connections_created')
+
+    async def _on_connection_reuse(self, session, ctx, params) -> None:
+        self._count('connections_reused')
+
+    async def _on_dns_cache_hit(self, session, ctx, params) -> None:
+        self._count('dns_cache_hits')
+
+    async def _on_dns_cache_miss(self, session, ctx, params) -> None:
+        self._count('dns_cache_misses')
+
+    async def close(self) -> None:
+        """Close the session and log how many connections were reused."""
+        logger.info(f"Closing HTTP client. Connections stats: {self.stats}")
+        await self.session.close()
+
+    def observe(self, url: str, start: float, status_code: Optional[int], size: int = 0) -> None:
+        """Record the response in the process metrics and pass it to the observer."""
+        elapsed = time.time() - start
+        path = endpoint(url)
+        metrics.observe('parser_http_request_seconds', elapsed, endpoint=path)
+        metrics.inc('parser_http_responses_total', endpoint=path, status=status_code or 'error')
+        if size:
+            metrics.inc('parser_http_response_bytes_total', size, endpoint=path)
+        if self.observer:
+            self.observer(elapsed, status_code)
+
     async def post(self, url: str, payload: dict = None, params: dict = None) -> dict:
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
         # logger.info(f"Sending request to {url}")
         start = time.time()
-        async with self.session.post(url, headers=self.headers, params=params, data=payload) as resp:
-            logger.info(f"<{resp.status}> Got response from {url} in {time.time() - start}s.")
-            resp_text = await resp.text()
-            return {'status_code': resp.status, 'response': resp_text}
+        try:
+            async with self.session.post(url, headers=self.headers, params=params, data=payload) as resp:
+                logger.info(f"<{resp.status}> Got response from {url} in {time.time() - start}s.")
+                resp_text = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.observe(url, start, None)
+            raise
+        self.observe(url, start, resp.status, resp.content.total_bytes)
+        return {'status_code': resp.status, 'response': resp_text}
 
     async def get(self, url: str, params: dict = None) -> dict:
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
         # logger.info(f"Sending request to {url}")
         start = time.time()
-        async with self.session.post(url, headers=self.headers, params=params) as resp:
-            logger.info(f"<{resp.status}> Got response from {url} in {time.time() - start}s.")
-            resp_text = await resp.text()
-            return {'status_code': resp.status, 'response': resp_text}
+        try:
+            async with self.session.post(url, headers=self.headers, params=params) as resp:
+                logger.info(f"<{resp.status}> Got response from {url} in {time.time() - start}s.")
+                resp_text = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.observe(url, start, None)
+            raise
+        self.observe(url, start, resp.status, resp.content.total_bytes)
+        return {'status_code': resp.status, 'response': resp_text}
@@ -0,0 +1,69 @@
+"""
+Wire format of cards sent from workers to the DB server through Redis.
+
+    byte 0    -- format version
+    byte 1    -- compression: 0 none, 1 zstd
+    bytes 2.. -- msgpack array of cards, every card is an array of values in CardRow order
+
+Cards carry no field names. The version has to be bumped whenever CardRow columns change,
+so a worker and a DB server of different versions can't silently shift columns.
+"""
+
+from typing import List, Sequence
+
+import msgpack
+
+from src.extractor import CardRow
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, it's needed only if cards are compressed
+    zstandard = None
+
+FORMAT_VERSION = 1
+COMPRESSIONS = {'none': 0, 'zstd': 1}
+
+
+class CardsCodec:
+    """Encodes batches of cards rows into bytes and back."""
+
+    def __init__(self, compression: str = 'none', level: int = 3) -> None:
+        """
+        :param compression: 'none' or 'zstd'. Decoding doesn't depend on it, every message says how it's compressed.
+        :param level: zstd compression level from 1 (fastest) to 22 (smallest).
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cards compression '{compression}', expected one of: {', '.join(COMPRESSIONS)}")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("Cards compression 'zstd' needs zstandard package to be installed")
+
+        self.compression = COMPRESSIONS[compression]
+        self.level = level
+        self.compressor = None
+        self.decompressor = None
+
+    def encode(self, cards: Sequence[tuple]) -> bytes:
+        payload = msgpack.packb(cards, use_bin_type=True)
+        if self.compression:
+            if self.compressor is None:
+                self.compressor = zstandard.ZstdCompressor(level=self.level)
+            payload = self.compressor.compress(payload)
+        return bytes((FORMAT_VERSION, self.compression)) + payload
+
+    def decode(self, data: bytes) -> List[CardRow]:
+        version, compression = data[0], data[1]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Cards message of version {version} can't be decoded, "
+                             f"expected version {FORMAT_VERSION}")
+
+        payload = data[2:]
+        if compression == COMPRESSIONS['zstd']:
+            if zstandard is None:
+                raise ValueError("Cards message is compressed with zstd, but zstandard package is not installed")
+            if self.decompressor is None:
+                self.decompressor = zstandard.ZstdDecompressor()
+            payload = self.decompressor.decompress(payload)
+        elif compression:
+            raise ValueError(f"Cards message has unknown compression {compression}")
+
+        return [CardRow(*card) for card in msgpack.unpackb(payload, use_list=False, raw=False)]
@@ -0,0 +1,112 @@
+import multiprocessing as mp
+import queue
+from typing import Dict, List, Optional, Tuple
+
+
+class LocalCardsStream:
+    """
+    CardsStream over a multiprocessing queue for the embedded mode, when workers and DB writers
+    run on one machine. Messages go through a pipe between the processes instead of Redis.
+    Unlike the Redis stream, entries of a DB writer that died are lost: their cards stay
+    unfinished in the task checkpoints and are fetched again when the task is resumed.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        """
+        :param maxsize: Max messages in the queue. Workers wait when it's full. 0 means no limit.
+        """
+        self.queue = mp.Queue(maxsize)
+        self.unacked = mp.Value('q', 0)  # Added entries that weren't acknowledged yet
+
+    def create_group(self) -> None:
+        pass
+
+    def add(self, message: bytes) -> None:
+        with self.unacked.get_lock():
+            self.unacked.value += 1
+        self.queue.put(message)
+
+    def stop(self, num_consumers: int) -> None:
+        """Add a stop entry for every consumer. They go after the cards, so every card is read before them."""
+        with self.unacked.get_lock():
+            self.unacked.value += num_consumers
+        for _ in range(num_consumers):
+            self.queue.put(None)
+
+    def read(self, consumer: str, count: int, block: float = None) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        """
+        Read up to `count` entries in the CardsStream format. Entries have no ids, they are only counted.
+        :param block: If there are no entries, wait up to that many seconds for them.
+        """
+        messages = []
+        try:
+            messages.append(self.queue.get(timeout=block) if block else self.queue.get_nowait())
+            while len(messages) < count:
+                messages.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return [(b'', {b'stop': b'1'} if message is None else {b'cards': message}) for message in messages]
+
+    def claim(self, consumer: str, min_idle: float, count: int) -> list:
+        """Entries read by one writer can't be taken over by another one."""
+        return []
+
+    def ack(self, ids: List[bytes]) -> None:
+        if ids:
+            with self.unacked.get_lock():
+                self.unacked.value -= len(ids)
+
+    def dead_letter(self, entry_id: bytes, message: bytes) -> None:
+        """There is nowhere to keep a message that can't be decoded, it's only acknowledged."""
+        self.ack([entry_id])
+
+    def pending(self) -> int:
+        """Number of entries added but not acknowledged yet."""
+        return self.unacked.value
+
+    def length(self) -> int:
+        """Number of entries not written yet, like the length of the Redis stream whose written entries are deleted."""
+        return self.unacked.value
+
+    def clear(self) -> None:
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.unacked.value = 0
+
+
+class LocalList:
+    """
+    The part of the Redis lists API the logs queue uses, over a multiprocessing queue.
+    Lets RedisHandler and RedisLogServer pass log records through a pipe in the embedded mode.
+    The list name is ignored, one instance is one list.
+    """
+
+    def __init__(self) -> None:
+        self.queue = mp.Queue()
+
+    def lpush(self, name: str, *values: bytes) -> None:
+        for value in values:
+            self.queue.put(value)
+
+    def rpop(self, name: str, count: int = None) -> Optional[List[bytes]]:
+        values = []
+        try:
+            while len(values) < (count or 1):
+                values.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        if count is None:
+            return values[0] if values else None
+        return values or None
+
+    def brpop(self, name: str, timeout: float = 0) -> Optional[Tuple[str, bytes]]:
+        try:
+            return name, self.queue.get(timeout=timeout or None)
+        except queue.Empty:
+            return None
+
+    def delete(self, name: str) -> None:
+        self.rpop(name, count=2 ** 31)
@@ -0,0 +1,43 @@
+import hashlib
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+from db.models.models import DBCardFields
+from src.parser import HtmlBackend, RlicParser
+
+# Card in the column layout of the licenses table. Module level, so rows can be sent between processes.
+CardRow = namedtuple('CardRow', ('license_id', *DBCardFields.keys.values()))
+
+
+def content_hash(card: CardRow) -> str:
+    """Hash of the card fields except license_id. A missing field and an empty one give different hashes."""
+    return hashlib.md5("\x1f".join("\x00" if value is None else value for value in card[1:]).encode()).hexdigest()
+
+
+class CardExtractor:
+    """
+    Extracts a card page straight into CardRow. Labels are mapped to row positions once,
+    so a card is parsed without intermediate dicts. A label missing on the page leaves None
+    in its column, a label the schema doesn't know is skipped. Both are reported, not raised.
+    """
+
+    def __init__(self, fields: Dict[str, str] = None, backend: HtmlBackend = None) -> None:
+        """
+        :param fields: Card rus labels and their columns. DBCardFields.keys by default.
+        :param backend: HTML backend to parse pages with. RlicParser.backend by default.
+        """
+        fields = fields or DBCardFields.keys
+        self.columns = {label: CardRow._fields.index(column) for label, column in fields.items()}
+        self.backend = backend or RlicParser.backend
+
+    def extract(self, html_doc: str, license_id: str) -> Tuple[CardRow, List[str], List[str]]:
+        """
+        :param html_doc: HTML code of card page.
+        :param license_id: Id of the license the card belongs to.
+        :return: Card row, labels missing on the page and labels unknown to the schema.
+        """
+        values = [None] * len(CardRow._fields)
+        values[0] = license_id
+        unknown = self.backend.extract_card(html_doc, self.columns, values)
+        missing = [label for label, i in self.columns.items() if values[i] is None]
+        return CardRow(*values), missing, unknown
@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import List
+
+# Lines of the parser's log format: "<time> | <level> | <name>:<function>:<line> - <message>"
+LOG_LINE_REGEX = re.compile(r"^(?P<time>\S+ \S+) \| (?P<level>\w+)\s*\| (?P<name>[^:\s]+):(?P<function>[^:\s]+):"
+                            r"(?P<line>\d+) - (?P<message>.*)$", re.DOTALL)
+
+
+def to_json_line(log_record: str) -> str:
+    """Turn a formatted log line into a JSON object. A line in another format becomes its message."""
+    match = LOG_LINE_REGEX.match(log_record)
+    if match:
+        record = match.groupdict()
+        record['line'] = int(record['line'])
+    else:
+        record = {'message': log_record}
+    return json.dumps(record, ensure_ascii=False)
+
+
+class RotatingLogFile:
+    """
+    Log file written through one buffered handle. When it grows over `max_bytes` or gets older than
+    `interval` secs it's renamed to `<name>.<timestamp><ext>` and a new one is started.
+    Rotated segments are gzipped in a background thread, so writing doesn't wait for compression.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0, interval: float = 0, compress: bool = True,
+                 json_lines: bool = False, buffer_size: int = 2 ** 20) -> None:
+        """
+        :param path: Path of the file being written.
+        :param max_bytes: Rotate after that many bytes. 0 disables rotation by size.
+        :param interval: Rotate after that many secs. 0 disables rotation by time.
+        :param compress: Gzip rotated segments.
+        :param json_lines: Write every record as a JSON object with time, level, name, function, line and message.
+        :param buffer_size: Size of the write buffer of the handle.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compress = compress
+        self.json_lines = json_lines
+        self.buffer_size = buffer_size
+        self.compressors: List[threading.Thread] = []
+        self.open()
+
+    def open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "ab", buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened = time.time()
+
+    def write(self, log_records: List[str]) -> None:
+        lines = []
+        for log_record in log_records:
+            if self.json_lines:
+                log_record = to_json_line(log_record.rstrip("\n"))
+            lines.append(log_record if log_record.endswith("\n") else log_record + "\n")
+        data = "".join(lines).encode("utf-8")
+        self.file.write(data)
+        self.size += len(data)
+        self.rotate_if_due()
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def rotate_if_due(self) -> None:
+        if (self.max_bytes and self.size >= self.max_bytes) or \
+                (self.interval and time.time() - self.opened >= self.interval):
+            self.rotate()
+
+    def rotate(self) -> None:
+        self.file.close()
+        name, ext = os.path.splitext(self.path)
+        segment = f"{name}.{datetime.datetime.now():%Y%m%d-%H%M%S-%f}{ext}"
+        os.rename(self.path, segment)
+        if self.compress:
+            compressor = threading.Thread(target=self.compress_segment, args=(segment,), name="log-compressor")
+            compressor.start()
+            self.compressors = [thread for thread in self.compressors if thread.is_alive()] + [compressor]
+        self.open()
+
+    @staticmethod
+    def compress_segment(segment: str) -> None:
+        with open(segment, "rb") as src, gzip.open(f"{segment}.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(segment)
+
+    def close(self) -> None:
+        """Flush the file and wait until rotated segments are compressed."""
+        self.file.close()
+        for compressor in self.compressors:
+            compressor.join()
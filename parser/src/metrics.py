@@ -0,0 +1,151 @@
+import re
+import resource
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Upper bounds of histograms buckets, secs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+SERIES_REGEX = re.compile(r'^(?P<name>[^{]+)(?:\{(?P<labels>.*)\})?$')
+LABEL_REGEX = re.compile(r'(\w+)="([^"]*)"')
+
+
+def series(name: str, labels: dict) -> str:
+    """Series name in the Prometheus text format: name{label="value",...}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+def parse_series(field: str) -> Tuple[str, Dict[str, str]]:
+    """Name and labels of a series in the Prometheus text format."""
+    match = SERIES_REGEX.match(field)
+    return match.group('name'), dict(LABEL_REGEX.findall(match.group('labels') or ''))
+
+
+def endpoint(url: str) -> str:
+    """Endpoint of a registry url without ids, e.g. /rlic/details/ for a card url."""
+    return "/" + "/".join(urlsplit(url).path.strip("/").split("/")[:2]) + "/"
+
+
+class Metrics:
+    """
+    Metrics of one process. Values are aggregated in memory and merged into the Redis hash `metrics`
+    by `flush`, with one pipeline per call, so recording a value never touches Redis.
+    Counters and histograms are added to the values of other processes, gauges are set per process,
+    so they should be labeled with the process they belong to.
+    Fields of the hash are series in the Prometheus text format, e.g. parser_http_responses_total{status="200"}.
+    """
+    hname = "metrics"
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, float] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[series(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[series(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add a value to a histogram. Buckets are cumulative, like Prometheus expects them."""
+        for le in self.buckets:
+            if value <= le:
+                self.counters[series(f"{name}_bucket", {**labels, 'le': le})] += 1
+        self.counters[series(f"{name}_bucket", {**labels, 'le': '+Inf'})] += 1
+        self.counters[series(f"{name}_sum", labels)] += value
+        self.counters[series(f"{name}_count", labels)] += 1
+
+    def flush(self, r_client) -> None:
+        """Merge the values into Redis. Counters are kept until they are merged, so a failed flush loses nothing."""
+        if not (self.counters or self.gauges):
+            return
+        pipe = r_client.pipeline(transaction=False)
+        for field, value in self.counters.items():
+            pipe.hincrbyfloat(self.hname, field, value)
+        if self.gauges:
+            pipe.hset(self.hname, mapping=self.gauges)
+        pipe.execute()
+        self.counters.clear()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the current process, bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read(r_client) -> Dict[str, float]:
+    """Metrics of all processes merged in Redis."""
+    return {field.decode(): float(value) for field, value in r_client.hgetall(Metrics.hname).items()}
+
+
+def histogram_quantile(q: float, buckets: List[Tuple[float, float]]) -> Optional[float]:
+    """
+    Estimate a quantile from cumulative buckets like Prometheus does, interpolating linearly inside a bucket.
+    :param q: Quantile between 0 and 1.
+    :param buckets: Pairs of upper bound and cumulative count, the last bound may be inf.
+    :return: None for an empty histogram. Values in the +Inf bucket are estimated by the highest finite bound.
+    """
+    buckets = sorted(buckets)
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    lower, lower_count = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float('inf'):
+                return lower
+            if count == lower_count:
+                return upper
+            return lower + (upper - lower) * (rank - lower_count) / (count - lower_count)
+        lower, lower_count = upper, count
+    return lower
+
+
+def summarize(values: Dict[str, float], elapsed: float) -> Dict[str, float]:
+    """
+    Performance of a run from its metrics, to be kept in the run statistics.
+    :param values: Metrics merged in Redis, see `read`.
+    :param elapsed: Duration of the run, secs.
+    :return: Throughput in pages and cards per sec, fetch latency percentiles in secs, retried requests,
+    5xx responses, bytes downloaded, CPU secs of parsing, rows written per sec of DB transactions
+    and peak RSS of a worker or a DB writer in bytes.
+    """
+    totals = defaultdict(float)
+    latency = defaultdict(float)  # Buckets of all endpoints
+    peak_rss = 0.0
+    for field, value in values.items():
+        name, labels = parse_series(field)
+        if name == 'parser_parse_seconds_count':
+            totals[labels.get('kind')] += value
+        elif name == 'parser_http_request_seconds_bucket':
+            latency[float(labels['le'])] += value
+        elif name == 'parser_http_responses_total':
+            if labels.get('status', '').startswith('5'):
+                totals['http_5xx'] += value
+        elif name == 'parser_peak_rss_bytes':
+            peak_rss = max(peak_rss, value)
+        else:
+            totals[name] += value
+
+    commit_seconds = totals['parser_db_commit_seconds_sum']
+    summary = {
+        'pages_per_sec': totals['table'] / elapsed if elapsed else None,
+        'cards_per_sec': totals['card'] / elapsed if elapsed else None,
+        'retries': int(totals['parser_retries_total']),
+        'http_5xx': int(totals['http_5xx']),
+        'bytes_downloaded': int(totals['parser_http_response_bytes_total']),
+        'parse_cpu_seconds': totals['parser_parse_cpu_seconds_total'],
+        'db_rows_per_sec': totals['parser_db_cards_total'] / commit_seconds if commit_seconds else None,
+        'peak_rss_bytes': int(peak_rss) or None,
+    }
+    for q in (50, 95, 99):
+        summary[f'fetch_p{q}'] = histogram_quantile(q / 100, list(latency.items()))
+    return summary
+
+
+# Registry of the current process
+metrics = Metrics()
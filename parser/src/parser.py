@@ -1,12 +1,21 @@
 import math
 import re
-from typing import List
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
 
 from bs4 import BeautifulSoup
 
 from loguru import logger
+from settings import env
 from src.client import Client
 
+try:
+    import lxml.html
+except ImportError:  # lxml is optional, BeautifulSoup with html.parser is used instead
+    lxml = None
+
+CARDS_NUM_REGEX = re.compile(r'\((\d+)\)')
+
 
 class Parser:
     @staticmethod
@@ -33,8 +42,7 @@ class RlicParser(Parser):
             return 0
 
         # Достаю числовое значение из заголовка h3
-        regex = re.compile(r'\((\d+)\)')
-        results = regex.findall(h3)
+        results = CARDS_NUM_REGEX.findall(h3)
         results = int(results[0]) if results else 0
 
         return results
@@ -47,17 +55,10 @@ class RlicParser(Parser):
         :return: number of pages and number of licenses.
         """
 
-        main_page_soup = RlicParser.make_soup(html_doc, 'html.parser')
-        # Getting overall number of cards
-        results_num = RlicParser.get_cards_num(main_page_soup)
+        # Getting overall number of cards and number of rows inside table
+        results_num, num_rows = RlicParser.backend.count_results(html_doc)
         logger.info(f"Got number of results -- {results_num}")
 
-        # Getting table body
-        table_rows = RlicParser.get_table_body(main_page_soup)
-
-        # Count all rows inside table
-        num_rows = len(table_rows)
-
         num_pages = math.ceil(results_num / num_rows)
         return {'num_pages': num_pages, 'num_licenses': results_num}
 
@@ -81,7 +82,54 @@ class RlicParser(Parser):
         :param html_doc: HTML code of searching page that contains table with cards.
         :return: cards ids from the table.
         """
+        return RlicParser.backend.parse_table(html_doc)
+
+    @staticmethod
+    def parse_card(html_doc: str) -> dict:
+        """
+        Parse card from a table.
+        :param html_doc: HTML code of card page.
+        :return: Parsed card with its fields and values.
+        """
+        return RlicParser.backend.parse_card(html_doc)
+
+
+class HtmlBackend(ABC):
+    """Engine that extracts data from registry pages. Every backend must return exactly the same data."""
+
+    name = None
+
+    @abstractmethod
+    def count_results(self, html_doc: str) -> Tuple[int, int]:
+        """Return overall number of results (cards) and number of table rows on the search page."""
+
+    @abstractmethod
+    def parse_table(self, html_doc: str) -> List[str]:
+        """Return cards ids from the table of the search page."""
+
+    @abstractmethod
+    def parse_card(self, html_doc: str) -> dict:
+        """Return fields of the card page and their values."""
+
+    @abstractmethod
+    def extract_card(self, html_doc: str, columns: Dict[str, int], values: list) -> List[str]:
+        """
+        Write values of the card page into `values` at positions of their labels in `columns`.
+        Values of labels that aren't in `columns` are not extracted at all.
+        :return: Labels of the page that aren't in `columns`.
+        """
+
+
+class SoupBackend(HtmlBackend):
+    """BeautifulSoup with the pure-Python html.parser. Slow, but needs no compiled dependencies."""
 
+    name = "soup"
+
+    def count_results(self, html_doc: str) -> Tuple[int, int]:
+        soup = RlicParser.make_soup(html_doc, 'html.parser')
+        return RlicParser.get_cards_num(soup), len(RlicParser.get_table_body(soup))
+
+    def parse_table(self, html_doc: str) -> List[str]:
         soup = RlicParser.make_soup(html_doc)
 
         # Getting table body
@@ -92,13 +140,7 @@ class RlicParser(Parser):
 
         return cards_ids
 
-    @staticmethod
-    def parse_card(html_doc: str) -> dict:
-        """
-        Parse card from a table.
-        :param html_doc: HTML code of card page.
-        :return: Parsed card with its fields and values.
-        """
+    def parse_card(self, html_doc: str) -> dict:
         soup = RlicParser.make_soup(html_doc)
 
         card_rows = soup.table.find_all("td")
@@ -110,6 +152,103 @@ class RlicParser(Parser):
 
         return card
 
+    def extract_card(self, html_doc: str, columns: Dict[str, int], values: list) -> List[str]:
+        card_rows = RlicParser.make_soup(html_doc).table.find_all("td")
+        unknown = []
+        for field, value in zip(card_rows[::2], card_rows[1::2]):
+            label = field.text.strip()
+            i = columns.get(label)
+            if i is None:
+                unknown.append(label)
+            else:
+                values[i] = value.text.strip()
+        return unknown
+
+
+class LxmlBackend(HtmlBackend):
+    """libxml2 through lxml. Builds the tree in C, several times faster than SoupBackend."""
+
+    name = "lxml"
+
+    def __init__(self) -> None:
+        # Pages are passed as str; they are encoded back to bytes, so a charset declared inside doesn't matter.
+        self.html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def make_tree(self, html_doc: str):
+        return lxml.html.document_fromstring(html_doc.encode('utf-8'), parser=self.html_parser)
+
+    @staticmethod
+    def get_table_rows(tree) -> list:
+        table = tree.find('.//table')
+        tbody = table.find('.//tbody') if table is not None else None
+        if tbody is None:
+            logger.error("Failed to read table.\nCan't find tbody tag")
+            return []
+        return list(tbody.iter('tr'))
+
+    def count_results(self, html_doc: str) -> Tuple[int, int]:
+        tree = self.make_tree(html_doc)
+
+        h3 = tree.find('.//h3')
+        if h3 is None:
+            logger.error("Can't find h3 tag with num of search results\nh3 object is None")
+            results_num = 0
+        else:
+            results = CARDS_NUM_REGEX.findall(lxml.html.tostring(h3, encoding='unicode', with_tail=False))
+            results_num = int(results[0]) if results else 0
+
+        return results_num, len(self.get_table_rows(tree))
+
+    def parse_table(self, html_doc: str) -> List[str]:
+        return [row.attrib['data-guid'] for row in self.get_table_rows(self.make_tree(html_doc))]
+
+    def parse_card(self, html_doc: str) -> dict:
+        table = self.make_tree(html_doc).find('.//table')
+        if table is None:
+            raise AttributeError("Can't find table tag")
+
+        card_rows = [td.text_content().strip() for td in table.iter('td')]
+        return dict(zip(card_rows[::2], card_rows[1::2]))
+
+    def extract_card(self, html_doc: str, columns: Dict[str, int], values: list) -> List[str]:
+        table = self.make_tree(html_doc).find('.//table')
+        if table is None:
+            raise AttributeError("Can't find table tag")
+
+        card_rows = list(table.iter('td'))
+        unknown = []
+        for field, value in zip(card_rows[::2], card_rows[1::2]):
+            label = field.text_content().strip()
+            i = columns.get(label)
+            if i is None:
+                unknown.append(label)
+            else:
+                values[i] = value.text_content().strip()
+        return unknown
+
+
+BACKENDS = {SoupBackend.name: SoupBackend, LxmlBackend.name: LxmlBackend}
+
+
+def get_backend(name: str = "auto") -> HtmlBackend:
+    """
+    Create HTML backend by its name.
+    :param name: 'lxml', 'soup' or 'auto' to take the fastest installed one.
+    """
+    if name == "auto":
+        name = LxmlBackend.name if lxml else SoupBackend.name
+    elif name not in BACKENDS:
+        raise ValueError(f"Unknown HTML backend '{name}', expected one of: auto, {', '.join(BACKENDS)}")
+
+    if name == LxmlBackend.name and lxml is None:
+        logger.warning("lxml is not installed, falling back to BeautifulSoup HTML backend")
+        name = SoupBackend.name
+
+    return BACKENDS[name]()
+
+
+RlicParser.backend = get_backend(env.HTML_BACKEND)
+
 
 async def get_num_pages() -> dict:
     """
@@ -128,6 +267,6 @@ async def get_num_pages() -> dict:
     else:
         res = {'num_pages': 0, 'num_licenses': 0}
 
-    await client.session.close()  # Закрываю aiohttp.ClientSession()
+    await client.close()  # Закрываю aiohttp.ClientSession()
 
     return res
@@ -1,7 +1,9 @@
+import asyncio
 import random
 import string
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-from redis import Redis, TimeoutError, AuthenticationError, ConnectionPool
+from redis import Redis, TimeoutError, AuthenticationError, ConnectionPool, ResponseError
 from loguru import logger
 
 from settings import env
@@ -9,6 +11,54 @@ from settings import env
 redis_pool = ConnectionPool(host=env.REDIS_HOST, port=env.REDIS_PORT,
                             password=env.REDIS_PASSWORD, db=env.REDIS_DB)
 
+# Refills the bucket according to the time passed since the last call and takes up to ARGV[3] tokens.
+# Redis server time is used, so every worker on every node sees the same clock.
+TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+# Takes the next pages range from the list or, if the list is empty, a range whose lease has expired
+# (its worker died or got stuck). The taken range is leased until now + ARGV[1] secs.
+CLAIM_PAGES_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local item = redis.call('LPOP', KEYS[1])
+if not item then
+    item = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 1)[1]
+end
+if item then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), item)
+end
+return item
+"""
+
+# Extends leases of the ranges passed in ARGV[2..n] to now + ARGV[1] secs. Already completed ranges are skipped.
+RENEW_PAGES_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[1]), ARGV[i])
+end
+return #ARGV - 1
+"""
+
 
 class RedisCli(Redis):
     def __init__(self):
@@ -18,6 +68,15 @@ class RedisCli(Redis):
         )
 
         self.init_redis_connect()
+        self.take_tokens_script = self.register_script(TAKE_TOKENS_SCRIPT)
+
+    def take_tokens(self, key: str, rate: float, capacity: int, requested: int) -> Tuple[int, float]:
+        """
+        Take up to `requested` tokens from the token bucket stored under the key.
+        :return: Number of granted tokens and how long (secs) to wait for the next one if none were granted.
+        """
+        granted, wait = self.take_tokens_script(keys=[key], args=[rate, capacity, requested])
+        return int(granted), float(wait)
 
     def init_redis_connect(self) -> None:
         """
@@ -80,6 +139,26 @@ class RedisHash:
             logger.error(f"Failed to get value to key {key} from Redis database\n{e}")
             self.redis_client.init_redis_connect()
 
+    def incr_value(self, key, amount: int = 1):
+        try:
+            if key in self.hash.keys():
+                return self.redis_client.hincrby(self.hname, key, amount)
+        except Exception as e:
+            logger.error(f"Failed to increment value of key {key} in Redis database\n{e}")
+            self.redis_client.init_redis_connect()
+
+    def incr_values(self, amounts: dict) -> None:
+        """Increment several keys in one round trip."""
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, amount in amounts.items():
+                if key in self.hash.keys():
+                    pipe.hincrby(self.hname, key, amount)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to increment values of keys {list(amounts)} in Redis database\n{e}")
+            self.redis_client.init_redis_connect()
+
 
 class ParsingTask(RedisHash):
     _hash = {
@@ -88,8 +167,30 @@ class ParsingTask(RedisHash):
         'started': None,       # str | None
         'ended': None,         # str | None
         'num_results': None,   # int | None
-        'details': None        # str | None
+        'details': None,       # str | None
+        'resume_from': None,   # str | None. Id of the failed task whose checkpoints this task continues
+        'mode': 'full',        # str. 'full' fetches every card, 'delta' only new ones and a refresh sample
+        'concurrency_limit': 0,              # int. Sum of in-flight limits of all workers
+        'concurrency_adjustments': 0,        # int
+        'last_concurrency_adjustment': None,  # str | None
+        'missing_card_fields': 0,  # int. Card labels not found on pages. Such cards are written with nulls
+        'unknown_card_fields': 0,  # int. Labels on cards pages the schema doesn't know
+        'rows_inserted': 0,        # int. New licenses written into the database
+        'rows_updated': 0,         # int. Stored licenses whose fields changed
+        'rows_unchanged': 0,       # int. Stored licenses fetched again without changes
+        'num_pages': 0,      # int. Search pages of the registry
+        'pages_done': 0,     # int. Parsed search pages, including ones parsed by the resumed task
+        'cards_queued': 0,   # int. Cards found on parsed pages that have to be fetched
+        'cards_fetched': 0,  # int
+        'cards_written': 0,  # int. Cards written into the database
+        'errors': 0          # int. Failed requests and pages that couldn't be handled
     }
+    # The API pushes the id of every started task here, so the parser doesn't have to poll the status
+    events = "parsing_task_events"
+    # Values that describe one run and have to be reset before the next one
+    _run_stats = ('details', 'concurrency_limit', 'concurrency_adjustments', 'last_concurrency_adjustment',
+                  'missing_card_fields', 'unknown_card_fields', 'rows_inserted', 'rows_updated', 'rows_unchanged',
+                  'num_pages', 'pages_done', 'cards_queued', 'cards_fetched', 'cards_written', 'errors')
 
     def __init__(self, r_client):
         super(ParsingTask, self).__init__(
@@ -109,12 +210,23 @@ class ParsingTask(RedisHash):
         try:
             self.set_value("task_id", task_id)
             self.set_value("status", "active")
+            self.redis_client.lpush(self.events, task_id)
         except Exception as e:
             logger.error(f"Failed to set task as started in {self.hname}\n{e}")
             self.redis_client.init_redis_connect()
         finally:
             return task_id
 
+    def wait_for_event(self, timeout: float) -> Optional[str]:
+        """Wait until a task is started. Return its id or None if nothing happened during `timeout` secs."""
+        event = self.redis_client.blpop(self.events, timeout=timeout)
+        return event[1].decode() if event else None
+
+    def reset_run_stats(self):
+        for key in self._run_stats:
+            value = self._hash[key]
+            self.set_value(key, "" if value is None else value)
+
     def get_status(self):
         return self.get_value('status')
 
@@ -123,3 +235,310 @@ class ParsingTask(RedisHash):
 
     def get_task(self):
         return self.get_hash()
+
+
+class PageQueue:
+    """
+    Shared queue of search pages ranges. Workers claim ranges on demand instead of getting
+    a fixed share up front, so a fast worker keeps taking work while a slow one is busy.
+    A claimed range is leased: if the worker doesn't complete or renew it in time,
+    any idle worker can take it over.
+    """
+
+    def __init__(self, r_client: RedisCli, name: str = "pages_queue") -> None:
+        """
+        :param name: Name of the Redis list with ranges. Leases are stored in the sorted set `<name>_leases`.
+        """
+        self.redis_client = r_client
+        self.name = name
+        self.leases = f"{name}_leases"
+        self.claim_script = self.redis_client.register_script(CLAIM_PAGES_SCRIPT)
+        self.renew_script = self.redis_client.register_script(RENEW_PAGES_SCRIPT)
+
+    @staticmethod
+    def make_ranges(num_pages: int, range_size: int, skip: Set[int] = frozenset()) -> Iterator[str]:
+        """Yield ranges of consecutive pages from 1 to num_pages. Pages from `skip` are left out."""
+        start = None
+        for page in range(1, num_pages + 2):
+            if page <= num_pages and page not in skip:
+                if start is None:
+                    start = page
+                if page - start + 1 < range_size:
+                    continue
+                yield f"{start}-{page}"
+                start = None
+            elif start is not None:
+                yield f"{start}-{page - 1}"
+                start = None
+
+    @staticmethod
+    def parse_range(pages_range: str) -> Tuple[int, int]:
+        start, end = pages_range.split('-')
+        return int(start), int(end)
+
+    def fill(self, num_pages: int, range_size: int, skip: Set[int] = frozenset(), chunk_size: int = 1000) -> None:
+        """Replace the queue content with ranges of pages from 1 to num_pages, except pages from `skip`."""
+        self.clear()
+        chunk = []
+        for pages_range in self.make_ranges(num_pages, range_size, skip):
+            chunk.append(pages_range)
+            if len(chunk) == chunk_size:
+                self.redis_client.rpush(self.name, *chunk)
+                chunk.clear()
+        if chunk:
+            self.redis_client.rpush(self.name, *chunk)
+
+    def claim(self, lease_ttl: float) -> Optional[str]:
+        """Take the next range. Return None if there is nothing to take right now."""
+        pages_range = self.claim_script(keys=[self.name, self.leases], args=[lease_ttl])
+        return pages_range.decode("utf-8") if pages_range else None
+
+    def renew(self, pages_ranges: List[str], lease_ttl: float) -> None:
+        if pages_ranges:
+            self.renew_script(keys=[self.leases], args=[lease_ttl, *pages_ranges])
+
+    def complete(self, pages_range: str) -> None:
+        self.redis_client.zrem(self.leases, pages_range)
+
+    def release(self, pages_range: str) -> None:
+        """Give the range back to the queue so another worker can take it."""
+        pipe = self.redis_client.pipeline()
+        pipe.zrem(self.leases, pages_range)
+        pipe.lpush(self.name, pages_range)
+        pipe.execute()
+
+    def pending(self) -> int:
+        """Number of ranges that are either waiting in the queue or leased by some worker."""
+        pipe = self.redis_client.pipeline()
+        pipe.llen(self.name)
+        pipe.zcard(self.leases)
+        return sum(pipe.execute())
+
+    def clear(self) -> None:
+        self.redis_client.delete(self.name, self.leases)
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by all workers on all nodes. The bucket itself is stored in Redis,
+    each worker takes tokens from it in batches and spends them locally, so there is one
+    Redis round trip per `batch` requests instead of one per request.
+    """
+
+    def __init__(self, r_client: RedisCli, rate: float, capacity: int = None, batch: int = 5,
+                 key: str = "rate_limiter") -> None:
+        """
+        :param rate: Requests per second allowed for the whole cluster.
+        :param capacity: Max number of tokens the bucket can save up (burst). Defaults to one second of requests.
+        :param batch: How many tokens to take from Redis at once.
+        :param key: Name of the Redis hash that stores the bucket.
+        """
+        self.redis_client = r_client
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.batch = max(1, min(batch, self.capacity))
+        self.key = key
+        self.tokens = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self.lock:
+            while not self.tokens:
+                # The Redis client is blocking, the event loop keeps serving the requests in flight meanwhile
+                granted, wait = await asyncio.get_running_loop().run_in_executor(None, self.take_tokens)
+                if granted:
+                    self.tokens += granted
+                else:
+                    await asyncio.sleep(wait)
+            self.tokens -= 1
+
+    def take_tokens(self) -> Tuple[int, float]:
+        """
+        Take a batch of tokens from Redis. Runs in a thread of the default executor.
+        :return: Number of granted tokens and how long (secs) to wait if none were granted.
+        """
+        try:
+            return self.redis_client.take_tokens(self.key, self.rate, self.capacity, self.batch)
+        except Exception as e:
+            logger.error(f"Failed to take tokens from {self.key}\n{e}")
+            self.redis_client.init_redis_connect()
+            return 0, 1.0
+
+
+class CardsStream:
+    """
+    Redis Stream of parsed cards messages consumed by a group of DB writers. Every entry is delivered
+    to one writer and stays pending until the writer acknowledges it after the commit. Entries of
+    a writer that died before that are taken over by another one, so every card is written at least once.
+    """
+
+    # Max entries kept in the dead letters list
+    max_dead_letters = 1000
+
+    def __init__(self, r_client: RedisCli, name: str = "db_cards_stream", group: str = "db_writers") -> None:
+        """
+        :param name: Name of the stream. Entries that can't be decoded are moved to the list `<name>_dead_letters`.
+        :param group: Name of the consumer group of DB writers.
+        """
+        self.redis_client = r_client
+        self.name = name
+        self.group = group
+        self.dead_letters = f"{name}_dead_letters"
+
+    def create_group(self) -> None:
+        """Create the stream and the group unless they exist. Entries added before are delivered too."""
+        try:
+            self.redis_client.xgroup_create(self.name, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+
+    def add(self, message: bytes) -> None:
+        self.redis_client.xadd(self.name, {'cards': message})
+
+    def stop(self, num_consumers: int) -> None:
+        """Add a stop entry for every consumer. They go after the cards, so every card is read before them."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for _ in range(num_consumers):
+            pipe.xadd(self.name, {'stop': 1})
+        pipe.execute()
+
+    def read(self, consumer: str, count: int, block: float = None) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        """
+        Read up to `count` entries that weren't delivered to any consumer yet.
+        :param block: If there are no such entries, wait up to that many seconds for them.
+        """
+        response = self.redis_client.xreadgroup(self.group, consumer, {self.name: '>'}, count=count,
+                                                # BLOCK 0 waits forever, so at least 1 ms
+                                                block=max(1, int(block * 1000)) if block else None)
+        return response[0][1] if response else []
+
+    def claim(self, consumer: str, min_idle: float, count: int) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        """Take over up to `count` entries that were delivered to some consumer but not acknowledged for `min_idle` secs."""
+        response = self.redis_client.xautoclaim(self.name, self.group, consumer, int(min_idle * 1000), count=count)
+        return [entry for entry in response[1] if entry[1] is not None]
+
+    def ack(self, ids: List[bytes]) -> None:
+        """Acknowledge written entries and delete them, so the stream doesn't grow."""
+        if ids:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.xack(self.name, self.group, *ids)
+            pipe.xdel(self.name, *ids)
+            pipe.execute()
+
+    def dead_letter(self, entry_id: bytes, message: bytes) -> None:
+        """
+        Move an entry that can't be decoded to the dead letters list and delete it from the stream,
+        so it isn't delivered to another writer. Only the latest `max_dead_letters` messages are kept.
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.lpush(self.dead_letters, message)
+        pipe.ltrim(self.dead_letters, 0, self.max_dead_letters - 1)
+        pipe.xack(self.name, self.group, entry_id)
+        pipe.xdel(self.name, entry_id)
+        pipe.execute()
+
+    def pending(self) -> int:
+        """Number of entries delivered to consumers but not acknowledged yet."""
+        return self.redis_client.xpending(self.name, self.group)['pending']
+
+    def length(self) -> int:
+        """Number of entries not written yet. Acknowledged ones are deleted."""
+        return self.redis_client.xlen(self.name)
+
+    def clear(self) -> None:
+        self.redis_client.delete(self.name)
+
+
+class TaskState:
+    """
+    Checkpoints of one parsing task: which pages are parsed, which cards were found on them
+    and which cards are written into the database. Used to resume an interrupted task
+    without starting from the first page.
+    """
+
+    def __init__(self, r_client: RedisCli, task_id: str) -> None:
+        self.redis_client = r_client
+        self.task_id = task_id
+        self.pages_done = f"task:{task_id}:pages_done"    # Set of parsed pages numbers
+        self.cards_found = f"task:{task_id}:cards_found"  # Set of licenses ids found on parsed pages
+        self.cards_done = f"task:{task_id}:cards_done"    # Set of licenses ids written into the database
+        self.cards_todo = f"task:{task_id}:cards_todo"    # List of licenses ids to fetch when resuming
+        self.known = f"task:{task_id}:known"              # Set of licenses ids stored in the database
+        self.removed = f"task:{task_id}:removed"          # Set of stored licenses ids marked as disappeared
+
+    @property
+    def keys(self) -> Tuple[str, ...]:
+        return self.pages_done, self.cards_found, self.cards_done, self.cards_todo, self.known, self.removed
+
+    def page_done(self, page: int, licenses_ids: List[str], skipped_ids: List[str] = ()) -> None:
+        """
+        :param page: Parsed page number.
+        :param licenses_ids: Ids of licenses found on the page.
+        :param skipped_ids: Ids of found licenses that won't be fetched. They are checkpointed as done right away.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        if licenses_ids:
+            pipe.sadd(self.cards_found, *licenses_ids)
+        if skipped_ids:
+            pipe.sadd(self.cards_done, *skipped_ids)
+        pipe.sadd(self.pages_done, page)
+        pipe.execute()
+
+    def add_known(self, licenses_ids: List[str], removed: bool = False) -> None:
+        if licenses_ids:
+            self.redis_client.sadd(self.removed if removed else self.known, *licenses_ids)
+
+    def clear_known(self) -> None:
+        self.redis_client.delete(self.known, self.removed)
+
+    def are_known(self, licenses_ids: List[str]) -> List[bool]:
+        """For each id tell whether the license is already stored in the database and present in the registry."""
+        if not licenses_ids:
+            return []
+        return [bool(is_member) for is_member in self.redis_client.smismember(self.known, licenses_ids)]
+
+    def get_disappeared(self) -> List[str]:
+        """Ids of stored licenses that weren't found on any parsed page."""
+        return [license_id.decode("utf-8") for license_id in self.redis_client.sdiff(self.known, self.cards_found)]
+
+    def get_reappeared(self) -> List[str]:
+        """Ids of licenses marked as disappeared that were found again."""
+        return [license_id.decode("utf-8") for license_id in self.redis_client.sinter(self.removed, self.cards_found)]
+
+    def mark_cards_done(self, licenses_ids: List[str]) -> None:
+        if licenses_ids:
+            self.redis_client.sadd(self.cards_done, *licenses_ids)
+
+    def get_pages_done(self) -> Set[int]:
+        return {int(page) for page in self.redis_client.smembers(self.pages_done)}
+
+    def queue_missing_cards(self) -> int:
+        """Put ids of cards that were found but not written into the database to the cards_todo list."""
+        self.redis_client.delete(self.cards_todo)
+        missing = self.redis_client.sdiff(self.cards_found, self.cards_done)
+        missing = [license_id.decode("utf-8") for license_id in missing]
+        for i in range(0, len(missing), 1000):
+            self.redis_client.rpush(self.cards_todo, *missing[i:i + 1000])
+        return len(missing)
+
+    def pop_cards_todo(self, count: int) -> List[str]:
+        licenses_ids = self.redis_client.lpop(self.cards_todo, count)
+        return [license_id.decode("utf-8") for license_id in licenses_ids] if licenses_ids else []
+
+    def move_to(self, task_id: str) -> "TaskState":
+        """Hand the checkpoints over to another task. Returns the state of that task."""
+        new_state = TaskState(self.redis_client, task_id)
+        for old_key, new_key in zip(self.keys, new_state.keys):
+            if self.redis_client.exists(old_key):
+                self.redis_client.rename(old_key, new_key)
+                self.redis_client.persist(new_key)
+        return new_state
+
+    def expire(self, ttl: int) -> None:
+        for key in self.keys:
+            self.redis_client.expire(key, ttl)
+
+    def clear(self) -> None:
+        self.redis_client.delete(*self.keys)
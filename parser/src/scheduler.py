@@ -0,0 +1,158 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set
+
+from loguru import logger
+
+
+class Slots:
+    """
+    Number of handlers in flight and their limit. Windows sharing one instance are limited together,
+    e.g. tables and cards requests of a worker that go to the same server.
+    """
+
+    def __init__(self, limit: int = 10, controller: "AIMDController" = None) -> None:
+        """
+        :param limit: Max number of handlers running at the same time.
+        :param controller: If passed, the limit is taken from the controller and may change while running.
+        """
+        self.limit = limit
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    def get_limit(self) -> int:
+        return self.controller.limit if self.controller else self.limit
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.get_limit())
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class SlidingWindow:
+    """
+    Continuously takes items from the queue and processes them with at most `limit` handlers
+    running at the same time. A new handler starts as soon as any running one finishes,
+    so one slow request doesn't hold the free slots.
+    """
+
+    def __init__(self, queue: asyncio.Queue, handler: Callable[..., Awaitable], limit: int = 10,
+                 controller: "AIMDController" = None, on_error: Callable[[object, Exception], None] = None,
+                 slots: Slots = None) -> None:
+        """
+        :param queue: Queue with items to process. Every item is marked as done after its handler finishes.
+        :param handler: Coroutine function that processes one item.
+        :param limit: Max number of handlers running at the same time.
+        :param controller: If passed, the limit is taken from the controller and may change while running.
+        :param on_error: Called with the item and the exception when a handler fails. Failures are logged anyway.
+        :param slots: Slots shared with other windows. `limit` and `controller` are ignored then.
+        """
+        self.queue = queue
+        self.handler = handler
+        self.slots = slots or Slots(limit, controller)
+        self.on_error = on_error
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def run(self) -> None:
+        """Run until cancelled. Waits on the queue, so it wakes up the moment an item is put."""
+        try:
+            while True:
+                await self.slots.acquire()
+                try:
+                    item = await self.queue.get()
+                except BaseException:
+                    await self.slots.release()
+                    raise
+
+                task = asyncio.create_task(self.process(item))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def process(self, item) -> None:
+        try:
+            await self.handler(item)
+        except Exception as e:
+            logger.error(f"Failed to process {item}\n{e}")
+            if self.on_error:
+                self.on_error(item, e)
+        finally:
+            self.queue.task_done()
+            await self.slots.release()
+
+
+class AIMDController:
+    """
+    Additive increase, multiplicative decrease controller of the number of requests in flight.
+    The limit grows by `increase` after every healthy window of samples (no errors and p95 latency
+    under the target) and is multiplied by `decrease` right after a 429 or 5xx response or a timeout.
+    """
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 50, increase: int = 1,
+                 decrease: float = 0.5, latency_target: float = 2.0, window: int = 20,
+                 on_adjust: Callable[[int, int, str], None] = None) -> None:
+        """
+        :param initial: Limit to start with.
+        :param min_limit: The limit never goes below this value.
+        :param max_limit: The limit never goes above this value.
+        :param increase: How much to add to the limit after a healthy window.
+        :param decrease: Factor to multiply the limit by after a failure.
+        :param latency_target: Max healthy p95 latency in seconds.
+        :param window: Number of responses to collect before deciding on an increase.
+        :param on_adjust: Called with old limit, new limit and reason every time the limit changes.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.window = window
+        self.on_adjust = on_adjust
+        self.latencies: List[float] = []
+        self.cooldown = 0  # Responses to ignore after a decrease, they were sent with the old limit.
+
+    @staticmethod
+    def percentile(values: List[float], q: float) -> float:
+        values = sorted(values)
+        return values[int(q * (len(values) - 1))]
+
+    def record(self, latency: float, status_code: Optional[int]) -> None:
+        """
+        Record one response.
+        :param latency: Response time in seconds.
+        :param status_code: Response status code or None if the request failed (timeout, connection error).
+        """
+        if self.cooldown:
+            self.cooldown -= 1
+            return
+
+        if status_code is None or status_code == 429 or status_code >= 500:
+            reason = "timeout" if status_code is None else f"<{status_code}>"
+            self.adjust(int(self.limit * self.decrease), reason)
+            return
+
+        self.latencies.append(latency)
+        if len(self.latencies) >= self.window:
+            p95 = self.percentile(self.latencies, 0.95)
+            if p95 <= self.latency_target:
+                self.adjust(self.limit + self.increase, f"p95 {p95:.2f}s")
+            self.latencies.clear()
+
+    def adjust(self, limit: int, reason: str) -> None:
+        limit = max(self.min_limit, min(limit, self.max_limit))
+        self.latencies.clear()
+        if limit < self.limit:
+            self.cooldown = self.limit
+        if limit != self.limit:
+            old, self.limit = self.limit, limit
+            if self.on_adjust:
+                self.on_adjust(old, limit, reason)
@@ -1,5 +1,4 @@
 from datetime import datetime
-from typing import List
 
 from loguru import logger
 
@@ -12,23 +11,12 @@ def current_date(date_format: str = "%d-%m-%Y_%H.%M.%S") -> str:
     return dt_string
 
 
-def split_urls(urls: List[str], n: int) -> List[List[str]]:
-    """Split list of urls into N even lists."""
-    chunks = [[]]*n
-    for i in range(n):
-        chunks[i] = urls[i::n]
-
-    return chunks
-
-
-async def ping(url: str = 'https://islod.obrnadzor.gov.ru/rlic/') -> int:
-    """Check if server available."""
-    client = Client()
+async def ping(client: Client, url: str = 'https://islod.obrnadzor.gov.ru/rlic/') -> int:
+    """Check if server available using the worker's shared client."""
     page = await client.post(url)
     if page['status_code'] >= 500:
         logger.warning("Server is not available")
         res = 0
     else:
         res = 1
-    await client.session.close()
     return res
@@ -0,0 +1,57 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import asyncpg
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+# settings.EnvVar requires the connection settings, though parsing needs neither Postgres nor Redis
+for name, value in {'DB_HOSTNAME': 'localhost', 'DB_PORT': '5432', 'DB_NAME': 'rlic', 'DB_USERNAME': 'test',
+                    'DB_USER_PASSWORD': 'test', 'REDIS_HOST': 'localhost', 'REDIS_PORT': '6379',
+                    'REDIS_PASSWORD': 'test', 'REDIS_DB': '0', 'REDIS_TIMEOUT': '10'}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def db_session_factory():
+    """
+    Sessions of an empty test database, made next to the configured one. create_tables is run on it.
+    The test is skipped without a Postgres server.
+    """
+    from settings import env
+    from db.models.models import create_tables
+
+    credentials = dict(host=env.DB_HOSTNAME, port=int(env.DB_PORT), user=env.DB_USERNAME, password=env.DB_USER_PASSWORD)
+    database = f"{env.DB_NAME}_test"
+
+    async def reset() -> None:
+        conn = await asyncpg.connect(database='postgres', timeout=2, **credentials)
+        try:
+            if not await conn.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", database):
+                await conn.execute(f'CREATE DATABASE "{database}"')
+        finally:
+            await conn.close()
+        conn = await asyncpg.connect(database=database, timeout=2, **credentials)
+        try:
+            await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        finally:
+            await conn.close()
+
+    try:
+        asyncio.run(reset())
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+        pytest.skip("Postgres is not available")
+
+    @asynccontextmanager
+    async def make_session():
+        # The engine is bound to the event loop of the test, so it's made inside it
+        engine = create_async_engine(f"postgresql+asyncpg://{env.DB_USERNAME}:{env.DB_USER_PASSWORD}@"
+                                     f"{env.DB_HOSTNAME}:{env.DB_PORT}/{database}")
+        try:
+            await create_tables(engine)
+            async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+                yield session
+        finally:
+            await engine.dispose()
+    return make_session
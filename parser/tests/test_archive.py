@@ -0,0 +1,42 @@
+import threading
+import time
+
+from src.archive import HtmlArchive, read_archive
+
+
+def test_records_are_written_in_order(tmp_path):
+    archive = HtmlArchive(str(tmp_path), "TASK0001", worker_id=1)
+    for i in range(10):
+        archive.write('card', f"license-{i}", f"https://example.org/{i}/", f"<html>Карточка {i}</html>")
+    archive.write('table', "1", "https://example.org/?page=1", "<html></html>")
+    archive.close()
+
+    cards = list(read_archive(str(tmp_path), "TASK0001", kind='card'))
+    assert [card['key'] for card in cards] == [f"license-{i}" for i in range(10)]
+    assert cards[3]['html'] == "<html>Карточка 3</html>"
+    assert [record['kind'] for record in read_archive(str(tmp_path), "TASK0001")][-1] == 'table'
+
+
+def test_records_are_dropped_instead_of_waiting(tmp_path):
+    archive = HtmlArchive(str(tmp_path), "TASK0001", worker_id=1, max_pending=2)
+    segment, disk_free = archive.file, threading.Event()
+
+    class SlowDisk:
+        def write(self, data: str) -> None:
+            disk_free.wait()
+            segment.write(data)
+
+    archive.file = SlowDisk()
+    archive.write('card', "license-0", "https://example.org/0/", "<html></html>")
+    # The writer thread takes the first record and waits for the disk
+    while not archive.pending.empty():
+        time.sleep(0.01)
+    for i in range(1, 10):
+        archive.write('card', f"license-{i}", f"https://example.org/{i}/", "<html></html>")
+    assert archive.dropped == 7
+
+    disk_free.set()
+    archive.file = segment
+    archive.close()
+    keys = [card['key'] for card in read_archive(str(tmp_path), "TASK0001")]
+    assert keys == ["license-0", "license-1", "license-2"]
@@ -0,0 +1,41 @@
+import time
+
+from src.batcher import AdaptiveBatcher
+
+
+def test_ready_by_rows():
+    batcher = AdaptiveBatcher(max_rows=1000, min_rows=10)
+    batcher.add(b'1', [('a', 'b')] * 5)
+    assert batcher.ready() is None
+    batcher.add(b'2', [('a', 'b')] * 5)
+    assert batcher.ready() == 'rows'
+    entries, rows, size = batcher.take()
+    assert [entry_id for entry_id, _ in entries] == [b'1', b'2'] and rows == 10 and size == 20
+    assert batcher.ready() is None and batcher.wait_time() is None
+
+
+def test_ready_by_bytes_and_wait():
+    batcher = AdaptiveBatcher(max_rows=1000, min_rows=100, max_bytes=10, max_wait=0.05)
+    batcher.add(b'1', [('12345', None, '678901')])
+    assert batcher.ready() == 'bytes'
+    batcher.take()
+    batcher.add(b'2', [('1',)])
+    assert batcher.ready() is None
+    time.sleep(0.06)
+    assert batcher.ready() == 'wait'
+
+
+def test_target_follows_latency():
+    batcher = AdaptiveBatcher(max_rows=300, min_rows=100, latency_target=1.0)
+    batcher.record(0.1, 'wait')
+    assert batcher.target_rows == 100  # A batch that didn't fill up says nothing about a bigger one
+    batcher.record(0.1, 'rows')
+    batcher.record(0.1, 'rows')
+    batcher.record(0.1, 'rows')
+    assert batcher.target_rows == 300
+    batcher.record(0.7, 'rows')
+    assert batcher.target_rows == 300
+    batcher.record(2.0, 'rows')
+    assert batcher.target_rows == 150
+    batcher.record(2.0, 'rows')
+    assert batcher.target_rows == 100
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from sqlalchemy.sql.expression import text
+
+from db.dals.card_dal import CardDAL
+
+COLUMNS = ('license_id', 'ogrn', 'content_hash')
+STAGING = 'active_licenses_staging_test'
+
+
+async def stored(session) -> dict:
+    result = await session.execute(text("SELECT license_id, ogrn, content_hash FROM active_licenses"))
+    return {row.license_id: (row.ogrn, row.content_hash) for row in result.all()}
+
+
+async def table_exists(session, table: str) -> bool:
+    result = await session.execute(text(f"SELECT to_regclass('{table}') IS NOT NULL"))
+    return result.scalar()
+
+
+def test_staging_table_is_created_and_dropped(db_session_factory):
+    async def scenario():
+        async with db_session_factory() as session:
+            dal = CardDAL(session)
+            await dal.create_staging_table(STAGING, COLUMNS)
+            assert await table_exists(session, STAGING)
+            # A table left by a crashed writer is replaced
+            await dal.create_staging_table(STAGING, COLUMNS)
+            await dal.drop_staging_table(STAGING)
+            assert not await table_exists(session, STAGING)
+            await dal.drop_staging_table(STAGING)
+
+    asyncio.run(scenario())
+
+
+def test_copied_last_duplicate_wins(db_session_factory):
+    async def scenario():
+        async with db_session_factory() as session:
+            dal = CardDAL(session)
+            await dal.create_staging_table(STAGING, COLUMNS)
+            cards = [('B', 'b1', 'h1'), ('A', 'a1', 'h1'), ('B', 'b2', 'h2'), ('A', 'a2', 'h2'), ('B', 'b3', 'h3')]
+            counts = await dal.copy_cards(cards, COLUMNS, STAGING)
+            assert counts == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+            assert await stored(session) == {'A': ('a2', 'h2'), 'B': ('b3', 'h3')}
+
+            # The staging table is emptied before each batch
+            counts = await dal.copy_cards([('C', 'c1', 'h1')], COLUMNS, STAGING)
+            assert counts == {'inserted': 1, 'updated': 0, 'unchanged': 0}
+            await dal.drop_staging_table(STAGING)
+
+    asyncio.run(scenario())
+
+
+async def upsert(session, method: str, cards: list) -> dict:
+    dal = CardDAL(session)
+    if method == 'copy':
+        await dal.create_staging_table(STAGING, COLUMNS)
+        return await dal.copy_cards(cards, COLUMNS, STAGING)
+    return await dal.upsert_changed_cards([dict(zip(COLUMNS, card)) for card in cards])
+
+
+async def updated_at(session) -> dict:
+    result = await session.execute(text("SELECT license_id, updated_at FROM active_licenses"))
+    return dict(result.all())
+
+
+@pytest.mark.parametrize('method', ['copy', 'upsert'])
+def test_only_changed_cards_are_rewritten(db_session_factory, method):
+    async def scenario():
+        async with db_session_factory() as session:
+            cards = [('A', 'a1', 'h1'), ('B', 'b1', 'h1')]
+            assert await upsert(session, method, cards) == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+            assert await updated_at(session) == {'A': None, 'B': None}
+
+            assert await upsert(session, method, cards) == {'inserted': 0, 'updated': 0, 'unchanged': 2}
+            assert await updated_at(session) == {'A': None, 'B': None}
+
+            changed = [('A', 'a1', 'h1'), ('B', 'b2', 'h2'), ('C', 'c1', 'h1')]
+            assert await upsert(session, method, changed) == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+            timestamps = await updated_at(session)
+            assert timestamps['A'] is None and timestamps['C'] is None
+            assert timestamps['B'] is not None
+            assert await stored(session) == {'A': ('a1', 'h1'), 'B': ('b2', 'h2'), 'C': ('c1', 'h1')}
+
+    asyncio.run(scenario())
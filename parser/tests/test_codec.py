@@ -0,0 +1,28 @@
+import pytest
+
+from src.codec import FORMAT_VERSION, CardsCodec
+from src.extractor import CardRow
+
+CARDS = [CardRow(*(f"{field}-{i}" for field in CardRow._fields)) for i in range(3)]
+CARDS.append(CARDS[0]._replace(ogrn=None, address="", fullname="ГБОУ «Школа\xa0№\xa01501»"))
+
+
+@pytest.mark.parametrize("compression", ["none", "zstd"])
+def test_round_trip(compression):
+    pytest.importorskip("zstandard")
+    codec = CardsCodec(compression)
+    message = codec.encode(CARDS)
+    assert message[0] == FORMAT_VERSION
+    # Decoding reads compression from the message, not from the settings of the codec
+    assert CardsCodec().decode(message) == CARDS
+
+
+def test_unknown_version():
+    message = CardsCodec().encode(CARDS)
+    with pytest.raises(ValueError):
+        CardsCodec().decode(bytes((FORMAT_VERSION + 1,)) + message[1:])
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        CardsCodec('gzip')
@@ -0,0 +1,46 @@
+import asyncio
+import multiprocessing as mp
+
+from processes.db_server import DBServer
+from src.codec import CardsCodec
+from src.embedded import LocalCardsStream
+from src.extractor import CardRow
+
+
+def test_undecodable_entries_are_dead_lettered():
+    stream = LocalCardsStream()
+    writer = DBServer(event=mp.Event(), engine=None, cards_stream=stream)
+    card = CardRow(*(f"value {i}" for i in range(len(CardRow._fields))))
+    good = CardsCodec().encode([card])
+    for message in (b'\x7f\x00garbage', good[:1] + b'\x00\xc1', good):
+        stream.add(message)
+    entries = stream.read("writer-1", 10, block=1)
+    while len(entries) < 3:
+        entries += stream.read("writer-1", 10, block=1)
+
+    decoded = writer.decode(entries)
+    assert [cards for _, cards in decoded] == [[card]]
+    # Only the decoded entry waits for its commit
+    assert stream.pending() == 1
+
+
+def test_failed_commit_is_retried_then_put_back_into_batch():
+    stream = LocalCardsStream()
+    writer = DBServer(event=mp.Event(), engine=None, cards_stream=stream)
+    writer.commit_retry_delay = 0
+    attempts = []
+
+    async def insert_cards(cards):
+        # Like an @async_session method whose transaction failed
+        attempts.append(cards)
+        return None
+
+    writer.insert_cards = insert_cards
+    card = CardRow(*(f"value {i}" for i in range(len(CardRow._fields))))
+    stream.add(CardsCodec().encode([card]))
+    entries = writer.get_entries(block=1)
+
+    assert asyncio.run(writer.write_cards(entries)) == 0
+    assert attempts == [[card]] * writer.commit_attempts
+    assert writer.batcher.entries == entries
+    assert stream.pending() == 1
@@ -0,0 +1,38 @@
+import multiprocessing as mp
+
+from src.embedded import LocalCardsStream, LocalList
+
+
+def send(stream, messages):
+    for message in messages:
+        stream.add(message)
+
+
+def test_cards_stream_between_processes():
+    stream = LocalCardsStream()
+    process = mp.Process(target=send, args=(stream, [b'1', b'2', b'3']))
+    process.start()
+    process.join()
+    stream.stop(1)
+    assert stream.pending() == 4
+
+    entries = stream.read("writer-1", 2, block=1)
+    assert [fields for _, fields in entries] == [{b'cards': b'1'}, {b'cards': b'2'}]
+    # Only the first entry is waited for, the rest are taken if they already came through the pipe
+    while len(entries) < 4:
+        entries += stream.read("writer-1", 10, block=1)
+    assert entries[-1][1] == {b'stop': b'1'}
+    stream.ack([entry_id for entry_id, _ in entries])
+    assert stream.pending() == 0
+    assert stream.read("writer-1", 10) == [] and stream.claim("writer-1", 0, 10) == []
+
+
+def test_local_list_like_redis():
+    logs = LocalList()
+    assert logs.rpop("logs", 10) is None and logs.brpop("logs", timeout=0.01) is None
+    for record in (b'a', b'b', b'c'):
+        logs.lpush("logs", record)
+    assert logs.brpop("logs", timeout=1) == ("logs", b'a')
+    assert logs.brpop("logs", timeout=1) == ("logs", b'b')
+    assert logs.brpop("logs", timeout=1) == ("logs", b'c')
+    assert logs.rpop("logs", 10) is None
@@ -0,0 +1,30 @@
+import gzip
+import json
+import os
+
+from src.log_file import RotatingLogFile, to_json_line
+
+LINE = "2023-03-01 12:00:00.12345 | INFO     | processes.db_server:flush:180 - DB writer writer-1 flushed 500 cards"
+
+
+def test_rotation_by_size_compresses_segments(tmp_path):
+    path = os.path.join(tmp_path, "parser.log")
+    log_file = RotatingLogFile(path, max_bytes=200)
+    for _ in range(5):
+        log_file.write([LINE, LINE + "\n"])
+    log_file.close()
+
+    segments = sorted(name for name in os.listdir(tmp_path) if name != "parser.log")
+    assert len(segments) == 5 and all(name.endswith(".log.gz") for name in segments)
+    with gzip.open(os.path.join(tmp_path, segments[0]), "rt", encoding="utf-8") as file:
+        assert file.read() == f"{LINE}\n{LINE}\n"
+    assert os.path.getsize(path) == 0
+
+
+def test_json_lines():
+    record = json.loads(to_json_line(LINE))
+    assert record == {'time': "2023-03-01 12:00:00.12345", 'level': "INFO", 'name': "processes.db_server",
+                      'function': "flush", 'line': 180, 'message': "DB writer writer-1 flushed 500 cards"}
+    multiline = json.loads(to_json_line(LINE + "\nTraceback (most recent call last):"))
+    assert multiline['message'].endswith("\nTraceback (most recent call last):")
+    assert json.loads(to_json_line("PID 10 dropped 5 log records")) == {'message': "PID 10 dropped 5 log records"}
@@ -0,0 +1,57 @@
+import pytest
+
+from src.metrics import Metrics, endpoint, histogram_quantile, parse_series, series, summarize
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 2):
+        metrics.observe('latency_seconds', value, endpoint='/rlic/search/')
+    bucket = lambda le: metrics.counters[series('latency_seconds_bucket', {'endpoint': '/rlic/search/', 'le': le})]
+    assert (bucket(0.1), bucket(1.0), bucket('+Inf')) == (1, 2, 3)
+    assert metrics.counters['latency_seconds_count{endpoint="/rlic/search/"}'] == 3
+    assert metrics.counters['latency_seconds_sum{endpoint="/rlic/search/"}'] == 2.55
+
+
+def test_endpoint_drops_ids():
+    assert endpoint('https://islod.obrnadzor.gov.ru/rlic/details/0f8e4a/') == '/rlic/details/'
+    assert endpoint('https://islod.obrnadzor.gov.ru/rlic/search/?page=10') == '/rlic/search/'
+
+
+def test_parse_series_is_inverse_of_series():
+    labels = {'endpoint': '/rlic/search/', 'le': '0.5'}
+    assert parse_series(series('latency_seconds_bucket', labels)) == ('latency_seconds_bucket', labels)
+    assert parse_series('parser_cards_buffered') == ('parser_cards_buffered', {})
+
+
+def test_histogram_quantile_interpolates_inside_bucket():
+    buckets = [(0.1, 50), (1.0, 100), (float('inf'), 100)]
+    assert histogram_quantile(0.5, buckets) == 0.1
+    assert histogram_quantile(0.75, buckets) == 0.55
+    assert histogram_quantile(0.5, [(0.1, 0), (float('inf'), 0)]) is None
+    # Values over the highest bound are estimated by it
+    assert histogram_quantile(0.99, [(0.1, 10), (float('inf'), 20)]) == 0.1
+
+
+def test_summarize_run():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    for value in (0.05, 0.05, 0.5, 0.5):
+        metrics.observe('parser_http_request_seconds', value, endpoint='/rlic/search/')
+    metrics.observe('parser_http_request_seconds', 0.5, endpoint='/rlic/details/')
+    for kind, count in (('table', 10), ('card', 200)):
+        metrics.inc('parser_parse_seconds_count', count, kind=kind)
+        metrics.inc('parser_parse_cpu_seconds_total', 1.5, kind=kind)
+    metrics.inc('parser_http_responses_total', 3, endpoint='/rlic/details/', status=200)
+    metrics.inc('parser_http_responses_total', 2, endpoint='/rlic/details/', status=503)
+    metrics.inc('parser_retries_total', 2, kind='card')
+    metrics.inc('parser_db_cards_total', 200)
+    metrics.inc('parser_db_commit_seconds_sum', 0.5, method='copy')
+    metrics.set('parser_peak_rss_bytes', 2048, process='worker-1')
+    metrics.set('parser_peak_rss_bytes', 4096, process='writer-1')
+
+    summary = summarize({**metrics.counters, **metrics.gauges}, elapsed=10)
+    assert (summary['pages_per_sec'], summary['cards_per_sec']) == (1, 20)
+    assert (summary['retries'], summary['http_5xx'], summary['parse_cpu_seconds']) == (2, 2, 3)
+    assert summary['db_rows_per_sec'] == 400
+    assert summary['peak_rss_bytes'] == 4096
+    assert summary['fetch_p50'] == pytest.approx(0.25) and summary['fetch_p99'] <= 1.0
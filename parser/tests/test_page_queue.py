@@ -0,0 +1,71 @@
+import time
+import uuid
+
+import pytest
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from settings import env
+from src.redis import PageQueue
+
+
+def ranges(num_pages: int, range_size: int, skip=frozenset()) -> list:
+    return list(PageQueue.make_ranges(num_pages, range_size, skip))
+
+
+def test_last_range_is_shorter():
+    assert ranges(10, 4) == ['1-4', '5-8', '9-10']
+    assert ranges(8, 4) == ['1-4', '5-8']
+
+
+def test_skipped_range_is_left_out():
+    assert ranges(12, 4, skip={5, 6, 7, 8}) == ['1-4', '9-12']
+
+
+def test_partly_skipped_range_is_split():
+    assert ranges(10, 5, skip={3}) == ['1-2', '4-8', '9-10']
+    assert ranges(6, 3, skip={1, 6}) == ['2-4', '5-5']
+
+
+def test_no_pages():
+    assert ranges(0, 10) == []
+    assert ranges(3, 10, skip={1, 2, 3}) == []
+
+
+@pytest.fixture
+def page_queue():
+    """PageQueue with its own keys. The leases scripts need a Redis server, the test is skipped without it."""
+    r_client = Redis(host=env.REDIS_HOST, port=env.REDIS_PORT, password=env.REDIS_PASSWORD, db=env.REDIS_DB,
+                     socket_timeout=1)
+    try:
+        r_client.ping()
+    except ConnectionError:
+        pytest.skip("Redis is not available")
+    queue = PageQueue(r_client, name=f"test_pages_{uuid.uuid4().hex}")
+    yield queue
+    queue.clear()
+
+
+def test_expired_lease_is_taken_over(page_queue):
+    page_queue.fill(4, 4)
+    assert page_queue.claim(lease_ttl=0.2) == '1-4'
+    assert page_queue.claim(lease_ttl=0.2) is None
+    time.sleep(0.3)
+    assert page_queue.claim(lease_ttl=10) == '1-4'
+    assert page_queue.pending() == 1
+
+
+def test_renewed_lease_is_kept(page_queue):
+    page_queue.fill(4, 4)
+    pages_range = page_queue.claim(lease_ttl=0.2)
+    page_queue.renew([pages_range], lease_ttl=10)
+    time.sleep(0.3)
+    assert page_queue.claim(lease_ttl=10) is None
+
+
+def test_completed_range_is_not_renewed(page_queue):
+    page_queue.fill(4, 4)
+    pages_range = page_queue.claim(lease_ttl=10)
+    page_queue.complete(pages_range)
+    page_queue.renew([pages_range], lease_ttl=10)
+    assert page_queue.pending() == 0
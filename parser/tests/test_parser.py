@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from db.models.models import DBCardFields
+from src.archive import read_segment
+from src.extractor import CardExtractor
+from src.parser import HtmlBackend, LxmlBackend, RlicParser, SoupBackend, get_backend
+
+pytest.importorskip("lxml")
+
+# Hand-written pages in the registry's markup with entities, nested tags, comments and empty values
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+# Archive segments with real responses of the registry, see captured/README.md
+CAPTURED_DIR = os.path.join(PAGES_DIR, "captured")
+
+
+def read_page(name: str) -> str:
+    with open(os.path.join(PAGES_DIR, name), encoding="utf-8") as file:
+        return file.read()
+
+
+def captured_pages() -> list:
+    """Records of the captured archive segments as test cases, a skipped one if there are none."""
+    pages = [
+        pytest.param(record, id=f"{record['kind']}-{record['key']}")
+        for name in sorted(os.listdir(CAPTURED_DIR)) if name.endswith(".jsonl.gz")
+        for record in read_segment(os.path.join(CAPTURED_DIR, name))
+    ]
+    return pages or [pytest.param(None, marks=pytest.mark.skip(reason="No captured pages of the registry"))]
+
+
+@pytest.fixture(params=[SoupBackend, LxmlBackend], ids=lambda backend: backend.name)
+def backend(request):
+    return request.param()
+
+
+@pytest.mark.parametrize("page", ["search_page.html", "search_last_page.html"])
+def test_tables_are_equal(page):
+    html_doc = read_page(page)
+    assert LxmlBackend().parse_table(html_doc) == SoupBackend().parse_table(html_doc)
+    assert LxmlBackend().count_results(html_doc) == SoupBackend().count_results(html_doc)
+
+
+@pytest.mark.parametrize("page", ["card_page.html", "card_page_terminated.html"])
+def test_cards_are_equal(page):
+    html_doc = read_page(page)
+    assert LxmlBackend().parse_card(html_doc) == SoupBackend().parse_card(html_doc)
+
+
+@pytest.mark.parametrize("record", captured_pages())
+def test_captured_pages_are_equal(record):
+    html_doc = record['html']
+    if record['kind'] == 'table':
+        cards_ids = LxmlBackend().parse_table(html_doc)
+        assert cards_ids
+        assert cards_ids == SoupBackend().parse_table(html_doc)
+        assert LxmlBackend().count_results(html_doc) == SoupBackend().count_results(html_doc)
+    else:
+        card = LxmlBackend().parse_card(html_doc)
+        assert card
+        assert card == SoupBackend().parse_card(html_doc)
+
+
+def test_parse_table(backend):
+    cards_ids = backend.parse_table(read_page("search_page.html"))
+    assert cards_ids == ["0a5c1f7e-3f1d-4b7a-9a55-%012d" % i for i in range(10)]
+
+
+def test_count_results(backend):
+    assert backend.count_results(read_page("search_page.html")) == (64213, 10)
+    assert backend.count_results(read_page("search_last_page.html")) == (6423, 3)
+
+
+def test_parse_card(backend):
+    card = backend.parse_card(read_page("card_page.html"))
+    assert len(card) == 17
+    assert card['Сокращенное наименование организации'] == "ГБОУ «Школа\xa0№\xa01501»"
+    assert card['Место нахождения организации'].startswith("129344, г. Москва,")
+    assert card['Решение о предоставлении'] == "Распоряжение № 1234 от 01.02.2016"
+    assert card['Решения лицензирующего органа о приостановлении действия'] == ""
+    assert card['Решения лицензирующего органа о возобновлении действия'] == ""
+    assert card['Решения суда об аннулировании лицензии'] == ""
+    assert card['Информация о должностном лице'] == "Иванова Мария Петровна, директор & председатель совета"
+
+
+def test_count_pages(monkeypatch, backend):
+    monkeypatch.setattr(RlicParser, "backend", backend)
+    assert RlicParser.count_pages(read_page("search_page.html")) == {'num_pages': 6422, 'num_licenses': 64213}
+
+
+def test_backend_must_implement_interface():
+    class PartialBackend(HtmlBackend):
+        def parse_table(self, html_doc: str) -> list:
+            return []
+
+    with pytest.raises(TypeError):
+        PartialBackend()
+
+
+def test_get_backend():
+    assert isinstance(get_backend("auto"), LxmlBackend)
+    assert isinstance(get_backend("soup"), SoupBackend)
+    with pytest.raises(ValueError):
+        get_backend("html5lib")
+
+
+def test_extractor_matches_parse_card(backend):
+    html_doc = read_page("card_page.html")
+    card, missing, unknown = CardExtractor(backend=backend).extract(html_doc, "guid")
+    assert missing == [] and unknown == []
+    assert card.license_id == "guid"
+    assert card._asdict() == {'license_id': "guid",
+                              **{DBCardFields.keys[k]: v for k, v in backend.parse_card(html_doc).items()}}
+
+
+def test_extractor_reports_layout_drift(backend):
+    html_doc = read_page("card_page_terminated.html").replace("ОГРН", "ОГРН организации")
+    card, missing, unknown = CardExtractor(backend=backend).extract(html_doc, "guid")
+    assert card.state == "Не действует"
+    assert card.termination_info == "Заявление лицензиатаот 10.03.2021"
+    assert card.ogrn is None and card.inn is None
+    assert unknown == ["ОГРН организации"]
+    assert len(missing) == 13 and "ОГРН" in missing
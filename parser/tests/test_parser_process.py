@@ -0,0 +1,70 @@
+import asyncio
+
+from processes.parser_process import ParserProcess
+
+
+class DownClient:
+    """Client of a server that answers every request with 503."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+
+    async def post(self, url: str, payload: dict = None) -> dict:
+        self.requests += 1
+        return {'status_code': 503, 'response': None}
+
+
+class FakePageQueue:
+    def __init__(self) -> None:
+        self.released = []
+
+    def release(self, pages_range: str) -> None:
+        self.released.append(pages_range)
+
+
+def make_worker(client) -> ParserProcess:
+    """Worker with only the state check_server needs, so neither Redis nor the registry are touched."""
+    worker = ParserProcess.__new__(ParserProcess)
+    worker.worker_id = 1
+    worker.client = client
+    worker.stopped = False
+    worker.server_available = None
+    worker.server_checked = float('-inf')
+    worker.tables_queue, worker.cards_queue = asyncio.Queue(), asyncio.Queue()
+    worker.page_queue = FakePageQueue()
+    worker.ranges, worker.page_ranges = {'1-10': 3}, {}
+    worker.PING_ATTEMPTS, worker.PING_INTERVAL = 3, 0
+    return worker
+
+
+def test_waiters_get_verdict_of_failed_probe():
+    async def check_concurrently(worker):
+        worker.server_lock = asyncio.Lock()
+        return await asyncio.gather(*(worker.check_server() for _ in range(5)))
+
+    client = DownClient()
+    worker = make_worker(client)
+    assert asyncio.run(check_concurrently(worker)) == [0] * 5
+    # Only the first caller probed the server
+    assert client.requests == worker.PING_ATTEMPTS
+    assert worker.stopped
+    assert worker.page_queue.released == ['1-10'] and not worker.ranges
+
+
+def test_verdict_is_reused_until_it_expires():
+    async def check_twice(worker):
+        worker.server_lock = asyncio.Lock()
+        first = await worker.check_server()
+        second = await worker.check_server()
+        worker.server_checked -= worker.SERVER_VERDICT_TTL
+        third = await worker.check_server()
+        return first, second, third
+
+    class UpClient(DownClient):
+        async def post(self, url: str, payload: dict = None) -> dict:
+            self.requests += 1
+            return {'status_code': 200, 'response': ''}
+
+    client = UpClient()
+    assert asyncio.run(check_twice(make_worker(client))) == (1, 1, 1)
+    assert client.requests == 2
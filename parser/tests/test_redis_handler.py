@@ -0,0 +1,45 @@
+import logging
+
+from logs.handlers.redis_handler import RedisHandler
+from src.embedded import LocalList
+
+
+def make_record(message: str) -> logging.LogRecord:
+    return logging.LogRecord("test", logging.INFO, __file__, 0, message, None, None)
+
+
+def pop_all(logs: LocalList, num_records: int) -> list:
+    return [logs.brpop("logs", timeout=1)[1] for _ in range(num_records)]
+
+
+def test_records_are_pushed_in_order():
+    logs = LocalList()
+    handler = RedisHandler("logs", r_client=logs, batch_size=2, flush_interval=60)
+    for i in range(5):
+        handler.handle(make_record(f"record {i}"))
+    handler.flush()
+    assert pop_all(logs, 5) == [f"record {i}".encode() for i in range(5)]
+
+
+def test_overflow_drops_oldest_and_reports():
+    logs = LocalList()
+    handler = RedisHandler("logs", r_client=logs, buffer_size=3, batch_size=100, flush_interval=60)
+    for i in range(5):
+        handler.handle(make_record(f"record {i}"))
+    assert handler.dropped == 2
+    handler.flush()
+    notice, *records = pop_all(logs, 4)
+    assert b"dropped 2 log records" in notice
+    assert records == [b"record 2", b"record 3", b"record 4"]
+    assert handler.dropped == 0
+
+
+def test_failed_push_counts_drops():
+    class Broken:
+        def lpush(self, name, *values):
+            raise ConnectionError
+
+    handler = RedisHandler("logs", r_client=Broken(), batch_size=100, flush_interval=60)
+    handler.handle(make_record("record"))
+    handler.flush()
+    assert handler.dropped == 1 and not handler.buffer
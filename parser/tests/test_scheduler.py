@@ -0,0 +1,152 @@
+import asyncio
+
+from src.scheduler import AIMDController, SlidingWindow, Slots
+
+
+class Handler:
+    """Handler whose calls finish only when the test releases them."""
+
+    def __init__(self) -> None:
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+        self.gates = {}
+
+    async def __call__(self, item) -> None:
+        self.started.append(item)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.gates[item] = asyncio.Event()
+        try:
+            await self.gates[item].wait()
+        finally:
+            self.running -= 1
+
+
+async def settle() -> None:
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_window_caps_in_flight_and_refills():
+    async def scenario():
+        queue, handler = asyncio.Queue(), Handler()
+        for item in range(5):
+            queue.put_nowait(item)
+        window = SlidingWindow(queue, handler, limit=2)
+        runner = asyncio.create_task(window.run())
+        await settle()
+        assert handler.started == [0, 1]
+        # A free slot is taken by the next item right away, without waiting for the other handler
+        handler.gates[0].set()
+        await settle()
+        assert handler.started == [0, 1, 2]
+        for item in range(1, 5):
+            handler.gates[item].set()
+            await settle()
+        await queue.join()
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        return handler.max_running, window.slots.in_flight
+
+    assert asyncio.run(scenario()) == (2, 0)
+
+
+def test_cancelled_window_cancels_handlers_and_frees_slots():
+    async def scenario():
+        queue, handler = asyncio.Queue(), Handler()
+        for item in range(3):
+            queue.put_nowait(item)
+        window = SlidingWindow(queue, handler, limit=2)
+        runner = asyncio.create_task(window.run())
+        await settle()
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        await settle()
+        return handler.running, window.slots.in_flight, queue.qsize()
+
+    # Cancelled handlers are marked as done, the item that wasn't taken stays in the queue
+    assert asyncio.run(scenario()) == (0, 0, 1)
+
+
+def test_failed_handler_is_reported_and_slot_freed():
+    async def scenario():
+        queue, errors = asyncio.Queue(), []
+
+        async def fail(item):
+            raise ValueError(item)
+
+        window = SlidingWindow(queue, fail, limit=1, on_error=lambda item, e: errors.append(item))
+        runner = asyncio.create_task(window.run())
+        for item in range(3):
+            queue.put_nowait(item)
+        await queue.join()
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        return errors
+
+    assert asyncio.run(scenario()) == [0, 1, 2]
+
+
+def test_shared_slots_limit_windows_together():
+    async def scenario():
+        controller = AIMDController(initial=3)
+        slots = Slots(controller=controller)
+        handler = Handler()
+        queues = [asyncio.Queue(), asyncio.Queue()]
+        for i, queue in enumerate(queues):
+            for item in range(3):
+                queue.put_nowait((i, item))
+        runners = [asyncio.create_task(SlidingWindow(queue, handler, slots=slots).run()) for queue in queues]
+        await settle()
+        running = handler.running
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        return running
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_additive_increase_after_healthy_window():
+    adjustments = []
+    controller = AIMDController(initial=5, window=4, latency_target=1.0,
+                                on_adjust=lambda old, new, reason: adjustments.append((old, new)))
+    for _ in range(4):
+        controller.record(0.5, 200)
+    assert controller.limit == 6
+    # A slow window doesn't increase the limit
+    for _ in range(4):
+        controller.record(2.0, 200)
+    assert controller.limit == 6
+    assert adjustments == [(5, 6)]
+
+
+def test_multiplicative_decrease_on_overload():
+    for status_code in (429, 503, None):
+        controller = AIMDController(initial=10, decrease=0.5)
+        controller.record(0.1, status_code)
+        assert controller.limit == 5
+    controller = AIMDController(initial=10, decrease=0.5)
+    controller.record(0.1, 404)
+    assert controller.limit == 10
+
+
+def test_decrease_ignores_responses_sent_with_old_limit():
+    controller = AIMDController(initial=8, decrease=0.5)
+    controller.record(0.1, 503)
+    for _ in range(8):
+        controller.record(0.1, 503)
+    assert controller.limit == 4
+    controller.record(0.1, 503)
+    assert controller.limit == 2
+
+
+def test_limit_is_clamped():
+    assert AIMDController(initial=100, max_limit=20).limit == 20
+    controller = AIMDController(initial=2, min_limit=2, decrease=0.1)
+    controller.record(0.1, 500)
+    assert controller.limit == 2
+    controller = AIMDController(initial=3, max_limit=3, window=1)
+    controller.record(0.1, 200)
+    assert controller.limit == 3
@@ -0,0 +1,102 @@
+import asyncio
+
+from sqlalchemy.sql.expression import text
+
+from db.dals.snapshot_dal import SnapshotDAL
+
+
+def card(license_id: str, content_hash: str, ogrn: str = None) -> tuple:
+    values = dict.fromkeys(SnapshotDAL.card_columns)
+    values.update(license_id=license_id, content_hash=content_hash, ogrn=ogrn)
+    return tuple(values[column] for column in SnapshotDAL.card_columns)
+
+
+async def names(session, table: str) -> dict:
+    constraints = await session.execute(text(
+        f"SELECT conname FROM pg_constraint WHERE conrelid = '{table}'::regclass"
+    ))
+    indexes = await session.execute(text(f"SELECT indexname FROM pg_indexes WHERE tablename = '{table}'"))
+    return {'constraints': set(constraints.scalars().all()), 'indexes': set(indexes.scalars().all())}
+
+
+async def rows(session, table: str) -> dict:
+    result = await session.execute(text(
+        f"SELECT license_id, id, ogrn, content_hash, created_at, updated_at FROM {table}"
+    ))
+    return {row.license_id: row for row in result.all()}
+
+
+def test_snapshot_is_built_swapped_and_rolled_back(db_session_factory):
+    async def scenario():
+        async with db_session_factory() as session:
+            await session.execute(text(
+                "INSERT INTO active_licenses (license_id, ogrn, content_hash, created_at, updated_at) VALUES "
+                "('A', 'a', 'h1', now() - interval '1 day', now() - interval '1 day'), "
+                "('B', 'b', 'h1', now() - interval '1 day', now() - interval '1 day'), "
+                "('C', 'c', 'h1', now() - interval '1 day', now() - interval '1 day')"
+            ))
+            await session.commit()
+            live_before = await rows(session, 'active_licenses')
+            dal = SnapshotDAL(session)
+
+            await dal.create_load_table('Task1')
+            # B is loaded twice, the card loaded last wins
+            await dal.load_cards('Task1', [card('A', 'h1', 'a'), card('B', 'h0', 'b0'), card('D', 'h1', 'd')])
+            await dal.load_cards('Task1', [card('B', 'h2', 'b2')])
+            counts = await dal.build_snapshot('Task1')
+            assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+
+            snapshot = await rows(session, 'active_licenses_task1')
+            assert set(snapshot) == {'A', 'B', 'C', 'D'}
+            assert snapshot['A'] == live_before['A']
+            assert snapshot['C'] == live_before['C']
+            assert (snapshot['B'].ogrn, snapshot['B'].content_hash) == ('b2', 'h2')
+            assert (snapshot['B'].id, snapshot['B'].created_at) == (live_before['B'].id, live_before['B'].created_at)
+            assert snapshot['B'].updated_at > live_before['B'].updated_at
+            assert snapshot['D'].id not in {row.id for row in live_before.values()}
+            assert snapshot['D'].updated_at is None
+
+            await dal.build_indexes('Task1')
+            assert await names(session, 'active_licenses_task1') == {
+                'constraints': {'active_licenses_task1_pkey', 'active_licenses_task1_license_id_key'},
+                'indexes': {'active_licenses_task1_pkey', 'active_licenses_task1_license_id_key'},
+            }
+
+            await dal.swap('Task1')
+            assert set(await rows(session, 'active_licenses')) == {'A', 'B', 'C', 'D'}
+            assert set(await rows(session, 'active_licenses_previous')) == {'A', 'B', 'C'}
+            live_names = {'constraints': {'active_licenses_pkey', 'active_licenses_license_id_key'},
+                          'indexes': {'active_licenses_pkey', 'active_licenses_license_id_key'}}
+            previous_keys = {'active_licenses_previous_pkey', 'active_licenses_previous_license_id_key'}
+            previous_names = {'constraints': previous_keys, 'indexes': previous_keys}
+            assert await names(session, 'active_licenses') == live_names
+            assert await names(session, 'active_licenses_previous') == previous_names
+            assert await dal._id_sequence() is not None
+
+            await dal.rollback()
+            assert await rows(session, 'active_licenses') == live_before
+            assert set(await rows(session, 'active_licenses_previous')) == {'A', 'B', 'C', 'D'}
+            assert await names(session, 'active_licenses') == live_names
+            assert await names(session, 'active_licenses_previous') == previous_names
+            # New ids don't collide with the ones handed out to the rolled back snapshot
+            await session.execute(text("INSERT INTO active_licenses (license_id) VALUES ('E')"))
+            assert (await rows(session, 'active_licenses'))['E'].id > snapshot['D'].id
+
+    asyncio.run(scenario())
+
+
+def test_load_table_is_taken_over_by_resumed_run(db_session_factory):
+    async def scenario():
+        async with db_session_factory() as session:
+            dal = SnapshotDAL(session)
+            await dal.create_load_table('Task1')
+            await dal.load_cards('Task1', [card('A', 'h1')])
+            await dal.create_load_table('Task2', resume_from='Task1')
+            await dal.load_cards('Task2', [card('B', 'h1')])
+            assert await dal.build_snapshot('Task2') == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+
+            await dal.drop_load_tables()
+            tables = await session.execute(text("SELECT tablename FROM pg_tables WHERE tablename LIKE '%load%'"))
+            assert tables.scalars().all() == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import asyncio
+import threading
+import time
+
+from src.redis import TokenBucket
+
+
+class SlowRedis:
+    """take_tokens of RedisCli with a slow round trip."""
+
+    def __init__(self) -> None:
+        self.threads = set()
+
+    def take_tokens(self, key: str, rate: float, capacity: int, requested: int):
+        self.threads.add(threading.get_ident())
+        time.sleep(0.2)
+        return requested, 0.0
+
+
+def test_taking_tokens_does_not_block_event_loop():
+    r_client = SlowRedis()
+    bucket = TokenBucket(r_client, rate=10, batch=2)
+    ticks = []
+
+    async def tick():
+        for _ in range(5):
+            ticks.append(time.time())
+            await asyncio.sleep(0.02)
+
+    async def scenario():
+        start = time.time()
+        await asyncio.gather(bucket.acquire(), bucket.acquire(), tick())
+        return start
+
+    start = asyncio.run(scenario())
+    # Both tokens came from one batch taken in an executor thread while the loop kept ticking
+    assert threading.get_ident() not in r_client.threads
+    assert bucket.tokens == 0
+    assert ticks[0] - start < 0.1